@@ -1,11 +1,13 @@
 import argparse
 import pathlib
-from typing import Dict, List
+from typing import Container, Dict, Iterable, Iterator, List, Optional
 import requests
 import http.cookiejar
+import instrument
 import json
 import logging
 import login
+import session_pool
 import concurrent.futures
 
 import time
@@ -13,27 +15,38 @@ import time
 __URL_TEMPLATE = "https://play.dlsite.com/api/purchases?page={}"
 __PURCHASED_COUNT_URL = "https://play.dlsite.com/api/product_count"
 
+# Looks like 10 is the reasonable amount of parallelism. Increasing this
+# could result in an error or no speed-up.
+MAX_SIMULTANEOUS_CONNECTIONS = 10
+
 
 def GetAllPurchasesFromUsernamePassword(username, password):
     session = login.Login(username, password)
-    return GetAllPurchases(session)
+    return GetAllPurchases(
+        session_pool.SessionPool(session, MAX_SIMULTANEOUS_CONNECTIONS)
+    )
 
 
 def GetAllPurchasesFromCookie(cookie):
     session = requests.session()
     session.cookies.update(cookie)
-    return GetAllPurchases(session)
+    return GetAllPurchases(
+        session_pool.SessionPool(session, MAX_SIMULTANEOUS_CONNECTIONS)
+    )
 
 
 def GetPurchasedItemsInParallel(
-    num_pages: int, max_parallel_tasks: int, session: requests.Session
+    num_pages: int,
+    max_parallel_tasks: int,
+    session: requests.Session | session_pool.SessionPool,
 ) -> List[Dict]:
     """Get purchased items in parallel.
 
     Args:
-        num_pages (int): _description_
-        max_sessions (int): _description_
-        session (requests.Session): _description_
+        num_pages (int): Number of pages to fetch.
+        max_parallel_tasks (int): Upper bound of parallel requests.
+        session: Logged in session. Pass a SessionPool so that each worker
+            thread uses its own session.
 
     Returns:
         List[Dict]: A list of JSON-like dictionaries, from getting all the
@@ -60,12 +73,17 @@ def GetPurchasedItemsInParallel(
         # 'referer': 'https://play.dlsite.com/'
         # are added.
         start_get = time.perf_counter()
-        response = session.get(url)
+        with instrument.Span("purchases.fetch_page"), instrument.Active(
+            "purchases.active"
+        ):
+            response = session_pool.SessionFor(session).get(url)
         end_get = time.perf_counter()
+        session_pool.RecordResponse(response)
         response.raise_for_status()
 
         start_json_parse = time.perf_counter()
-        response_json = response.json()
+        with instrument.Span("purchases.parse_json"):
+            response_json = response.json()
         end_json_parse = time.perf_counter()
 
         logging.info(
@@ -74,10 +92,7 @@ def GetPurchasedItemsInParallel(
 
         return response_json
 
-    # Looks like 10 is the reasonable amount of parallelism. Increasing this
-    # could result in an error or no speed-up.
-    _SIMULTANEOUS_CONNETIONS = 10
-    pool_size = min(max_parallel_tasks, _SIMULTANEOUS_CONNETIONS)
+    pool_size = min(max_parallel_tasks, MAX_SIMULTANEOUS_CONNECTIONS)
     responses = []
     with concurrent.futures.ThreadPoolExecutor(pool_size) as executor:
         future_to_url = {executor.submit(_FetchOne, url): url for url in urls}
@@ -93,12 +108,16 @@ def GetPurchasedItemsInParallel(
     return responses
 
 
-def GetAllPurchases(session: requests.Session) -> List:
+def GetAllPurchases(session: requests.Session | session_pool.SessionPool) -> List:
     """Get all purchased info as dictionary.
 
     The API is used to get all the purchase info as json and converts it to
     python dictionary.
 
+    Args:
+        session: Logged in session or a pool of them. Pages are fetched in
+            parallel, so a pool is preferred.
+
     Returns:
         JSON-like dictionary.
 
@@ -106,7 +125,9 @@ def GetAllPurchases(session: requests.Session) -> List:
         HTTPError when there is a problem.
     """
 
-    response = session.get(__PURCHASED_COUNT_URL)
+    with instrument.Span("purchases.fetch_count"):
+        response = session_pool.SessionFor(session).get(__PURCHASED_COUNT_URL)
+    session_pool.RecordResponse(response)
     response.raise_for_status()
     purchased_json = response.json()
     num_items: int = purchased_json["user"]
@@ -136,6 +157,35 @@ def GetAllPurchases(session: requests.Session) -> List:
     return all_works
 
 
+def FilterPurchases(
+    purchases: Iterable[Dict],
+    age_categories: Optional[Container[str]] = None,
+    work_types: Optional[Container[str]] = None,
+    max_size: Optional[int] = None,
+) -> Iterator[Dict]:
+    """Yields the purchases that match all the specified conditions.
+
+    Args:
+        purchases: Works as returned by GetAllPurchases().
+        age_categories: Allowed "age_category" values, e.g. "adult".
+        work_types: Allowed "work_type" values, e.g. "SOU".
+        max_size: Maximum "file_size" in bytes. Works without a size are kept
+            since their size is not known.
+    """
+    for purchase in purchases:
+        if age_categories is not None:
+            if purchase.get("age_category") not in age_categories:
+                continue
+        if work_types is not None:
+            if purchase.get("work_type") not in work_types:
+                continue
+        if max_size is not None:
+            size = purchase.get("file_size")
+            if size is not None and int(size) > max_size:
+                continue
+        yield purchase
+
+
 def _WriteAllworksToFile(all_works: Dict, output_file: str | pathlib.Path):
     with open(output_file, "w") as f:
         json.dump(all_works, f)
@@ -67,3 +67,42 @@ class AllPurchased(unittest.TestCase):
         response_mock.raise_for_status.side_effect = Exception("test exception!!")
         with self.assertRaises(Exception):
             all_purchased.GetPurchasedItemsInParallel(10, 1, session_mock)
+
+    def testFilterPurchases(self):
+        purchases = [
+            {"workno": "RJ1", "age_category": "adult", "work_type": "SOU"},
+            {"workno": "RJ2", "age_category": "general", "work_type": "SOU"},
+            {
+                "workno": "RJ3",
+                "age_category": "adult",
+                "work_type": "MOV",
+                "file_size": 100,
+            },
+            {
+                "workno": "RJ4",
+                "age_category": "adult",
+                "work_type": "SOU",
+                "file_size": 5000,
+            },
+        ]
+
+        def _Ids(filtered):
+            return [p["workno"] for p in filtered]
+
+        self.assertEqual(
+            _Ids(all_purchased.FilterPurchases(purchases)),
+            ["RJ1", "RJ2", "RJ3", "RJ4"],
+        )
+        self.assertEqual(
+            _Ids(all_purchased.FilterPurchases(purchases, age_categories=["adult"])),
+            ["RJ1", "RJ3", "RJ4"],
+        )
+        self.assertEqual(
+            _Ids(all_purchased.FilterPurchases(purchases, work_types=["MOV"])),
+            ["RJ3"],
+        )
+        # Items without a size are kept.
+        self.assertEqual(
+            _Ids(all_purchased.FilterPurchases(purchases, max_size=1000)),
+            ["RJ1", "RJ2", "RJ3"],
+        )
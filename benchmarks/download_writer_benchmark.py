@@ -0,0 +1,101 @@
+"""Compares the ways downloader can write a response body to a file.
+
+Serves a file from a local HTTP server and downloads it with
+iter_content() (the previous way) and with readinto() into a reusable buffer.
+Reports throughput and the peak memory allocated by Python while copying.
+
+    python benchmarks/download_writer_benchmark.py --size 512M
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import sys
+from tempfile import TemporaryDirectory
+import threading
+import time
+import tracemalloc
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import downloader
+import rate_limit
+
+_BLOCK = bytes(range(256)) * 4096
+
+
+def _MakeHandler(size: int):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            remaining = size
+            while remaining > 0:
+                block = _BLOCK[: min(len(_BLOCK), remaining)]
+                self.wfile.write(block)
+                remaining -= len(block)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def _Run(url: str, copy, chunk_size: int, out_path: Path):
+    response = requests.get(url, stream=True)
+    response.raise_for_status()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(out_path, "wb", buffering=0) as f:
+        downloader._Preallocate(f, int(response.headers["Content-Length"]))
+        copy(response, f, chunk_size, lambda chunk: None)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    response.close()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="256M", type=rate_limit.ParseByteSize)
+    parser.add_argument(
+        "--chunk-size",
+        default=downloader._DOWNLOAD_CHUNK_SIZE,
+        type=rate_limit.ParseByteSize,
+    )
+    parser.add_argument("--repeat", default=3, type=int)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _MakeHandler(args.size))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/file.zip"
+
+    methods = {
+        "iter_content": downloader._CopyByIterContent,
+        "readinto": lambda response, *args: downloader._CopyByReadInto(
+            downloader._RawBody(response), *args
+        ),
+    }
+    try:
+        with TemporaryDirectory() as tmpdir:
+            for name, copy in methods.items():
+                for i in range(args.repeat):
+                    elapsed, peak = _Run(
+                        url, copy, args.chunk_size, Path(tmpdir) / "out"
+                    )
+                    print(
+                        f"{name:>12} run {i + 1}: "
+                        f"{args.size / elapsed / 1024**2:8.1f} MiB/s, "
+                        f"peak allocated {peak / 1024**2:6.1f} MiB"
+                    )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Runs benchmark cases and records their results as JSON.
+
+Each case runs in a fresh process so that its peak RSS is its own and one
+case cannot warm caches for the next.
+"""
+
+from contextlib import redirect_stderr, redirect_stdout
+from dataclasses import asdict, dataclass, field
+import datetime
+import json
+import math
+import multiprocessing
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+@dataclass
+class Benchmark:
+    # Runs one iteration and returns the number of units it processed.
+    run: Callable[[], int]
+    # Called after each iteration. Not timed.
+    cleanup: Optional[Callable[[], None]] = None
+
+
+@dataclass
+class Case:
+    name: str
+    # Creates the data in the given directory and returns the benchmark.
+    setup: Callable[[Path, Dict], Benchmark]
+    # What run() counts, e.g. "bytes" or "items".
+    unit: str
+    params: Dict
+    # Smaller params for a quick run.
+    quick_params: Dict = field(default_factory=dict)
+    # Returns why the case cannot run here, or None if it can.
+    unavailable: Optional[Callable[[], Optional[str]]] = None
+
+
+@dataclass
+class Result:
+    name: str
+    params: Dict
+    unit: str
+    units_per_run: int = 0
+    # Seconds of each timed iteration.
+    runs: List[float] = field(default_factory=list)
+    p50: float = 0.0
+    p90: float = 0.0
+    p99: float = 0.0
+    # Units per second at the median.
+    throughput: float = 0.0
+    peak_rss_bytes: Optional[int] = None
+    skipped: Optional[str] = None
+
+
+def Percentile(values: List[float], percent: float) -> float:
+    """Linearly interpolated percentile of values."""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * percent / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    fraction = position - lower
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * fraction
+
+
+def _PeakRss() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _Measure(
+    setup: Callable[[Path, Dict], Benchmark], params: Dict, repeat: int, warmup: int
+) -> Tuple[List[float], int, Optional[int]]:
+    runs = []
+    units = 0
+    with TemporaryDirectory() as tmpdir, open(os.devnull, "w") as devnull:
+        # Progress bars and messages of the code under test.
+        with redirect_stdout(devnull), redirect_stderr(devnull):
+            benchmark = setup(Path(tmpdir), params)
+            for i in range(warmup + repeat):
+                start = time.perf_counter()
+                units = benchmark.run()
+                elapsed = time.perf_counter() - start
+                if benchmark.cleanup:
+                    benchmark.cleanup()
+                if i >= warmup:
+                    runs.append(elapsed)
+    return runs, units, _PeakRss()
+
+
+def _Child(setup, params: Dict, repeat: int, warmup: int, connection):
+    try:
+        connection.send(_Measure(setup, params, repeat, warmup))
+    except BaseException as e:
+        connection.send(e)
+        raise
+
+
+def RunCase(case: Case, quick: bool, repeat: int, warmup: int) -> Result:
+    """Runs case in a new process and summarizes the timings."""
+    params = {**case.params, **(case.quick_params if quick else {})}
+    result = Result(case.name, params, case.unit)
+    result.skipped = case.unavailable() if case.unavailable else None
+    if result.skipped:
+        return result
+
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_Child, args=(case.setup, params, repeat, warmup, sender)
+    )
+    process.start()
+    sender.close()
+    try:
+        outcome = receiver.recv()
+    except EOFError:
+        outcome = RuntimeError(f"{case.name} exited with {process.exitcode}")
+    process.join()
+    if isinstance(outcome, BaseException):
+        raise outcome
+
+    result.runs, result.units_per_run, result.peak_rss_bytes = outcome
+    result.p50 = Percentile(result.runs, 50)
+    result.p90 = Percentile(result.runs, 90)
+    result.p99 = Percentile(result.runs, 99)
+    if result.p50:
+        result.throughput = result.units_per_run / result.p50
+    return result
+
+
+def _GitCommit() -> Optional[str]:
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=_REPO_DIR, stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def Report(results: List[Result]) -> Dict:
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": _GitCommit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": {r.name: asdict(r) for r in results},
+    }
+
+
+def Save(report: Dict, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def Load(path: Path) -> Dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _Scaled(value: float, unit: str) -> str:
+    if unit == "bytes":
+        return f"{value / 1024**2:,.1f} MiB"
+    return f"{value:,.0f} {unit}"
+
+
+def _Change(new: float, old: float) -> str:
+    if not old:
+        return ""
+    return f" ({(new - old) / old:+.1%})"
+
+
+def Format(report: Dict, baseline: Optional[Dict] = None) -> str:
+    """Human readable summary, with changes from baseline if specified."""
+    lines = []
+    old_results = baseline["results"] if baseline else {}
+    for name, result in report["results"].items():
+        if result["skipped"]:
+            lines.append(f"{name}: skipped, {result['skipped']}")
+            continue
+        old = old_results.get(name)
+        if old and (old["skipped"] or old["params"] != result["params"]):
+            old = None
+        line = (
+            f"{name}: p50 {result['p50'] * 1000:,.1f} ms"
+            + (_Change(result["p50"], old["p50"]) if old else "")
+            + f", p90 {result['p90'] * 1000:,.1f} ms"
+            + f", {_Scaled(result['throughput'], result['unit'])}/s"
+            + (_Change(result["throughput"], old["throughput"]) if old else "")
+        )
+        if result["peak_rss_bytes"] is not None:
+            line += f", peak RSS {result['peak_rss_bytes'] / 1024**2:,.1f} MiB"
+            if old and old["peak_rss_bytes"]:
+                line += _Change(result["peak_rss_bytes"], old["peak_rss_bytes"])
+        lines.append(line)
+    return "\n".join(lines)
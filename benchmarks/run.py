@@ -0,0 +1,270 @@
+"""Benchmarks the hot paths on synthetic data.
+
+Network cases run against fake_dlsite, so they measure this code and the
+local loopback, not DLsite. Results are written as JSON and can be compared
+with an earlier run:
+
+    python benchmarks/run.py --quick
+    python benchmarks/run.py download scan_library --baseline old.json
+
+Cases:
+    fetch_purchases: all_purchased.GetAllPurchases() over paginated pages.
+    download: Downloader.DownloadTo() of one large file, including hashing.
+    group_archives: dlsite_extract.Archive.Create() on a full download dir.
+    extract: dlsite_extract.Unarchive() of a zip. Needs unar.
+    parse_split_page: Finding the files in a split download page.
+    parse_split_page_full: The same with the full BeautifulSoup parse that
+        is the fallback.
+    scan_library: find_id.GetItemsInDir() on a large management dir.
+"""
+
+import argparse
+import datetime
+from pathlib import Path
+import shutil
+import sys
+from typing import Dict
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import all_purchased
+import dlsite_extract
+import downloader
+import fake_dlsite
+import find_id
+import harness
+import login
+import session_pool
+import synthetic
+
+_RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+_USER = "benchmark"
+_PASSWORD = "benchmark"
+
+
+def _StartFake(params: Dict):
+    fake = fake_dlsite.FakeDlsite(
+        latency=params.get("latency", 0.0), bandwidth=params.get("bandwidth")
+    )
+    fake.__enter__()
+    fake.AddUser(_USER, _PASSWORD)
+    return fake
+
+
+def _SetUpFetchPurchases(directory: Path, params: Dict) -> harness.Benchmark:
+    fake = _StartFake(params)
+    fake.page_limit = params["page_limit"]
+    if params.get("purchases_file"):
+        purchases = synthetic.LoadPurchases(Path(params["purchases_file"]))
+    else:
+        purchases = synthetic.Purchases(params["works"])
+    for purchase in purchases:
+        fake.AddWork(purchase["workno"], [1]).purchase = purchase
+    pool = session_pool.SessionPool(
+        login.Login(_USER, _PASSWORD), all_purchased.MAX_SIMULTANEOUS_CONNECTIONS
+    )
+
+    return harness.Benchmark(lambda: len(all_purchased.GetAllPurchases(pool)))
+
+
+def _SetUpDownload(directory: Path, params: Dict) -> harness.Benchmark:
+    fake = _StartFake(params)
+    item_id = synthetic.ItemId(0)
+    fake.AddWork(item_id, [params["size"]])
+    dl = downloader.Downloader(login.Login(_USER, _PASSWORD))
+    out_dir = directory / "downloading"
+
+    def _Run():
+        out_dir.mkdir()
+        dl.DownloadTo(item_id, out_dir)
+        return params["size"]
+
+    return harness.Benchmark(_Run, lambda: shutil.rmtree(out_dir))
+
+
+def _SetUpGroupArchives(directory: Path, params: Dict) -> harness.Benchmark:
+    num_files = synthetic.MakeDownloadDir(directory, params["items"])
+
+    def _Run():
+        dlsite_extract.Archive.Create(directory)
+        return num_files
+
+    return harness.Benchmark(_Run)
+
+
+def _UnarUnavailable():
+    return None if shutil.which("unar") else "unar is not installed"
+
+
+def _SetUpExtract(directory: Path, params: Dict) -> harness.Benchmark:
+    archive_dir = directory / synthetic.ItemId(0)
+    archive_dir.mkdir()
+    size = synthetic.MakeZip(
+        archive_dir / f"{synthetic.ItemId(0)}.zip", params["files"], params["file_size"]
+    )
+
+    def _Run():
+        if not dlsite_extract.Unarchive(archive_dir, keep_archive=True):
+            raise RuntimeError("Extraction failed.")
+        return size
+
+    def _Cleanup():
+        for path in archive_dir.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path)
+
+    return harness.Benchmark(_Run, _Cleanup)
+
+
+def _SplitPage(params: Dict) -> str:
+    if params.get("split_page_file"):
+        return Path(params["split_page_file"]).read_text(encoding="utf-8")
+    return synthetic.SplitPage(params["parts"])
+
+
+def _SetUpParseSplitPage(directory: Path, params: Dict) -> harness.Benchmark:
+    page = _SplitPage(params)
+
+    def _Run():
+        for _ in range(params["pages"]):
+            downloader._ParseSplitPage(page)
+        return params["pages"]
+
+    return harness.Benchmark(_Run)
+
+
+def _SetUpParseSplitPageFull(directory: Path, params: Dict) -> harness.Benchmark:
+    page = _SplitPage(params)
+
+    def _Run():
+        for _ in range(params["pages"]):
+            downloader._ParseSplitPageWithSoup(page)
+        return params["pages"]
+
+    return harness.Benchmark(_Run)
+
+
+def _SetUpScanLibrary(directory: Path, params: Dict) -> harness.Benchmark:
+    synthetic.MakeLibrary(directory, params["items"])
+    return harness.Benchmark(
+        lambda: len(find_id.GetItemsInDir(directory).GetItemsAsList())
+    )
+
+
+CASES = [
+    harness.Case(
+        "fetch_purchases",
+        _SetUpFetchPurchases,
+        "items",
+        params={"works": 5000, "page_limit": 50, "latency": 0.02},
+        quick_params={"works": 500},
+    ),
+    harness.Case(
+        "download",
+        _SetUpDownload,
+        "bytes",
+        params={"size": 512 * 1024**2},
+        quick_params={"size": 32 * 1024**2},
+    ),
+    harness.Case(
+        "group_archives",
+        _SetUpGroupArchives,
+        "files",
+        params={"items": 2000},
+        quick_params={"items": 200},
+    ),
+    harness.Case(
+        "extract",
+        _SetUpExtract,
+        "bytes",
+        params={"files": 200, "file_size": 2 * 1024**2},
+        quick_params={"files": 50, "file_size": 256 * 1024},
+        unavailable=_UnarUnavailable,
+    ),
+    harness.Case(
+        "parse_split_page",
+        _SetUpParseSplitPage,
+        "pages",
+        params={"parts": 10, "pages": 200},
+        quick_params={"pages": 20},
+    ),
+    harness.Case(
+        "parse_split_page_full",
+        _SetUpParseSplitPageFull,
+        "pages",
+        params={"parts": 10, "pages": 200},
+        quick_params={"pages": 20},
+    ),
+    harness.Case(
+        "scan_library",
+        _SetUpScanLibrary,
+        "items",
+        params={"items": 20000},
+        quick_params={"items": 2000},
+    ),
+]
+
+
+def main():
+    names = [case.name for case in CASES]
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "cases", nargs="*", help=f"Cases to run from {', '.join(names)}. Default: all."
+    )
+    parser.add_argument(
+        "--quick", action="store_true", help="Smaller data, e.g. for a smoke test."
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Timed iterations.")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed iterations.")
+    parser.add_argument(
+        "--purchases",
+        type=Path,
+        help="Purchases JSON recorded with `manager.py purchased -o` to serve "
+        "instead of generated ones.",
+    )
+    parser.add_argument(
+        "--split-page",
+        type=Path,
+        help="Saved split download page to parse instead of a generated one.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        help=f"Where to write the results. Default: a new file in {_RESULTS_DIR}.",
+    )
+    parser.add_argument(
+        "--baseline", type=Path, help="Results of an earlier run to compare with."
+    )
+    args = parser.parse_args()
+    unknown = set(args.cases) - set(names)
+    if unknown:
+        parser.error(f"Unknown cases: {', '.join(sorted(unknown))}")
+
+    results = []
+    for case in CASES:
+        if args.cases and case.name not in args.cases:
+            continue
+        if args.purchases and case.name == "fetch_purchases":
+            case.params["purchases_file"] = str(args.purchases)
+        if args.split_page and case.name.startswith("parse_split_page"):
+            case.params["split_page_file"] = str(args.split_page)
+        print(f"Running {case.name}...", flush=True)
+        results.append(harness.RunCase(case, args.quick, args.repeat, args.warmup))
+
+    report = harness.Report(results)
+    output = args.output
+    if not output:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = _RESULTS_DIR / f"{timestamp}.json"
+    harness.Save(report, output)
+
+    baseline = harness.Load(args.baseline) if args.baseline else None
+    print(harness.Format(report, baseline))
+    print(f"Results are written to {output}")
+
+
+if __name__ == "__main__":
+    main()
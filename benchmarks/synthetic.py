@@ -0,0 +1,144 @@
+"""Reproducible synthetic data for the benchmarks.
+
+Everything is generated from a seed, so two runs with the same parameters
+work on the same names and bytes.
+"""
+
+import json
+from pathlib import Path
+import random
+from typing import Dict, List
+import zipfile
+
+_WORK_TYPES = ["SOU", "ICG", "MOV", "ADV", "MNG"]
+_AGE_CATEGORIES = ["all", "r15", "adult"]
+
+# Written in blocks so that large files do not need to be held in memory.
+_BLOCK_SIZE = 1024 * 1024
+
+
+def ItemId(index: int) -> str:
+    return f"RJ{1000000 + index:08d}"
+
+
+def Purchases(count: int, seed: int = 0) -> List[Dict]:
+    """Purchase entries shaped like the ones from the purchases API."""
+    rng = random.Random(seed)
+    purchases = []
+    for i in range(count):
+        purchases.append(
+            {
+                "workno": ItemId(i),
+                "name": {"ja_JP": f"作品 {i}"},
+                "work_type": rng.choice(_WORK_TYPES),
+                "age_category": rng.choice(_AGE_CATEGORIES),
+                "file_size": rng.randrange(1, 4 * 1024**3),
+                "sales_date": f"20{rng.randrange(10, 25)}-"
+                f"{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}"
+                "T00:00:00.000000Z",
+            }
+        )
+    return purchases
+
+
+def LoadPurchases(path: Path) -> List[Dict]:
+    """Reads purchases recorded with `manager.py purchased -o`."""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def MakeLibrary(root: Path, count: int, files_per_item: int = 3, seed: int = 0):
+    """Creates a management dir with count item directories.
+
+    A tenth of the items are in the watched directory and a few have the
+    prefixes that mark them, like the real library. Files are small.
+    """
+    rng = random.Random(seed)
+    watched = root / "視聴済み"
+    watched.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        parent = watched if i % 10 == 0 else root
+        prefix = "#" if i % 50 == 0 else ""
+        item_dir = parent / f"{prefix}{ItemId(i)} 作品 {i}"
+        item_dir.mkdir()
+        for j in range(files_per_item):
+            (item_dir / f"track{j:02d}.mp3").write_bytes(rng.randbytes(64))
+    # Things that are not items.
+    (root / "downloading").mkdir(exist_ok=True)
+    (root / "notes").mkdir(exist_ok=True)
+
+
+def SplitPage(num_parts: int, num_other_works: int = 200) -> str:
+    """A split download page with num_parts files.
+
+    Like the real page, the list of files is near the top and is followed by
+    a long list of other works and scripts, which are not needed.
+    """
+    item_id = ItemId(0)
+    parts = "".join(
+        f'<div class="work_download"><p class="name">{item_id}.part{i}.rar</p>'
+        f'<a class="btn_dl" href="https://www.dlsite.com/maniax/download/split/'
+        f'=/number/{i}/product_id/{item_id}.html">ダウンロード</a></div>\n'
+        for i in range(1, num_parts + 1)
+    )
+    other_works = "".join(
+        f'<li class="work"><a href="https://www.dlsite.com/maniax/work/=/'
+        f'product_id/{ItemId(i)}.html"><img src="/img/{ItemId(i)}.jpg" '
+        f'alt="作品 {i}"><span class="title">作品 {i}</span></a>'
+        f'<span class="price">{i * 10} 円</span></li>\n'
+        for i in range(1, num_other_works + 1)
+    )
+    return (
+        '<!DOCTYPE html><html lang="ja"><head><meta charset="utf-8">'
+        "<title>分割ダウンロード</title>"
+        '<link rel="stylesheet" href="/css/style.css"></head><body>'
+        '<header><nav><ul><li><a href="/">ホーム</a></li></ul></nav></header>'
+        f'<div id="download_division_file">\n{parts}</div>'
+        f'<section class="recommend"><ul>\n{other_works}</ul></section>'
+        "<script>var config = {a: 1, b: [1, 2, 3]};</script>"
+        "<footer><p>&copy; DLsite</p></footer></body></html>"
+    )
+
+
+def MakeZip(path: Path, num_files: int, file_size: int, seed: int = 0) -> int:
+    """Creates a zip archive of incompressible files, like audio and images.
+
+    Returns:
+        Total size of the files in the archive.
+    """
+    rng = random.Random(seed)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as archive:
+        for i in range(num_files):
+            with archive.open(f"{path.stem}/file{i:04d}.bin", "w") as f:
+                remaining = file_size
+                while remaining:
+                    block = rng.randbytes(min(_BLOCK_SIZE, remaining))
+                    f.write(block)
+                    remaining -= len(block)
+    return num_files * file_size
+
+
+def MakeDownloadDir(directory: Path, num_items: int, seed: int = 0) -> int:
+    """Creates the download dir state before extraction.
+
+    Half of the items are zip files and the others are split archives with a
+    .part1.exe and .rar parts. The files are empty since only their names
+    matter for grouping.
+
+    Returns:
+        The number of files created.
+    """
+    rng = random.Random(seed)
+    num_files = 0
+    for i in range(num_items):
+        item_id = ItemId(i)
+        if i % 2 == 0:
+            (directory / f"{item_id}.zip").touch()
+            num_files += 1
+            continue
+        num_parts = rng.randrange(2, 6)
+        (directory / f"{item_id}.part1.exe").touch()
+        for part in range(2, num_parts + 1):
+            (directory / f"{item_id}.part{part}.rar").touch()
+        num_files += num_parts
+    return num_files
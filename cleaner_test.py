@@ -0,0 +1,114 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+import cleaner
+
+
+def _FillItem(item_dir: Path):
+    (item_dir / "sub" / "deeper").mkdir(parents=True)
+    (item_dir / "a.mp3").write_bytes(b"12345")
+    (item_dir / "sub" / "b.png").write_bytes(b"123")
+    (item_dir / "sub" / "deeper" / "c.txt").write_bytes(b"1")
+
+
+class CleanerTest(unittest.TestCase):
+    def testRemoveContents(self):
+        for use_dir_fd in sorted({False, cleaner._USE_DIR_FD}):
+            with self.subTest(use_dir_fd=use_dir_fd), patch(
+                "cleaner._USE_DIR_FD", use_dir_fd
+            ), TemporaryDirectory() as tmpdir:
+                item_dir = Path(tmpdir) / "RJ1"
+                item_dir.mkdir()
+                _FillItem(item_dir)
+
+                stats = cleaner.RemoveContents(item_dir)
+
+                self.assertEqual(os.listdir(item_dir), [])
+                self.assertEqual((stats.files, stats.bytes, stats.items), (3, 9, 1))
+
+    @unittest.skipUnless(hasattr(os, "symlink") and os.name == "posix", "posix only")
+    def testSymlinkedDirectoryIsNotFollowed(self):
+        with TemporaryDirectory() as tmpdir:
+            outside = Path(tmpdir) / "outside"
+            outside.mkdir()
+            (outside / "keep").write_bytes(b"keep")
+            item_dir = Path(tmpdir) / "RJ1"
+            item_dir.mkdir()
+            os.symlink(outside, item_dir / "link")
+
+            cleaner.RemoveContents(item_dir)
+
+            self.assertEqual(os.listdir(item_dir), [])
+            self.assertTrue((outside / "keep").exists())
+
+    def testVanishedMetaFileIsIgnored(self):
+        unlink = os.unlink
+
+        def _Unlink(path, *args, **kwargs):
+            if os.path.basename(path).startswith("._"):
+                # Removed by the server together with "a.mp3".
+                unlink(path, *args, **kwargs)
+                raise FileNotFoundError(path)
+            return unlink(path, *args, **kwargs)
+
+        with TemporaryDirectory() as tmpdir:
+            item_dir = Path(tmpdir)
+            (item_dir / "a.mp3").write_bytes(b"123")
+            (item_dir / "._a.mp3").write_bytes(b"meta")
+            with patch("os.unlink", side_effect=_Unlink):
+                stats = cleaner.RemoveContents(item_dir)
+            self.assertEqual(os.listdir(item_dir), [])
+            self.assertEqual(stats.files, 1)
+
+    def testRemoveContentsOfAll(self):
+        with TemporaryDirectory() as tmpdir:
+            items = [Path(tmpdir) / f"RJ{i}" for i in range(5)]
+            for item_dir in items:
+                item_dir.mkdir()
+                _FillItem(item_dir)
+
+            stats = cleaner.RemoveContentsOfAll(
+                items + [Path(tmpdir) / "missing"], jobs=3
+            )
+
+            for item_dir in items:
+                self.assertEqual(os.listdir(item_dir), [])
+            self.assertEqual(stats.items, 5)
+            self.assertEqual(stats.failed_items, 1)
+            self.assertEqual(stats.files, 15)
+            self.assertEqual(stats.bytes, 45)
+
+    def testMeasureContents(self):
+        with TemporaryDirectory() as tmpdir:
+            _FillItem(Path(tmpdir))
+            stats = cleaner.MeasureContents(Path(tmpdir))
+            self.assertEqual((stats.files, stats.bytes), (3, 9))
+
+
+class CleanedRecordTest(unittest.TestCase):
+    def testRecord(self):
+        with TemporaryDirectory() as tmpdir:
+            record_path = Path(tmpdir) / "cleaned.json"
+            item_dir = Path(tmpdir) / "RJ1"
+            gone_dir = Path(tmpdir) / "RJ2"
+            item_dir.mkdir()
+            gone_dir.mkdir()
+
+            record = cleaner.CleanedRecord(record_path)
+            self.assertFalse(record.IsClean(item_dir))
+            record.MarkClean(item_dir)
+            record.MarkClean(gone_dir)
+            record.Save()
+
+            record = cleaner.CleanedRecord(record_path)
+            self.assertTrue(record.IsClean(item_dir))
+            # Not looked at in this run, so it is dropped.
+            record.Save()
+            self.assertFalse(cleaner.CleanedRecord(record_path).IsClean(gone_dir))
+
+            (item_dir / "new file").write_bytes(b"new")
+            os.utime(item_dir, ns=(0, 0))
+            self.assertFalse(cleaner.CleanedRecord(record_path).IsClean(item_dir))
@@ -0,0 +1,149 @@
+"""Small JSON store for files in the config directory.
+
+Files are written atomically (write to a temporary file then rename) while
+holding a lock, so that several manager processes can share a config
+directory without clobbering or reading half written files.
+"""
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+from pathlib import Path
+import tempfile
+from typing import Any, Dict, List, Optional
+
+from http.cookiejar import CookieJar
+import requests
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+_LOCK_SUFFIX = ".lock"
+
+# Only the owner should be able to read files with credentials.
+PRIVATE_FILE_MODE = 0o600
+
+
+@contextmanager
+def FileLock(path: Path):
+    """Exclusive inter-process lock associated with path.
+
+    The lock is taken on a separate "<path>.lock" file so that path itself can
+    be replaced atomically while the lock is held.
+    """
+    lock_path = path.with_name(path.name + _LOCK_SUFFIX)
+    with open(lock_path, "a+b") as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif msvcrt:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds. Keep waiting.
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def WriteAtomic(path: Path, data: bytes, mode: Optional[int] = None):
+    """Replaces the content of path with data in one step.
+
+    Readers either see the old or the new content, never a partial write.
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def ReadJson(path: Path) -> Optional[Any]:
+    """Returns the parsed content of path, or None if it does not exist."""
+    try:
+        with open(path, "rb") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _Serialize(content: Any) -> bytes:
+    return json.dumps(content, indent=2, sort_keys=True, ensure_ascii=False).encode()
+
+
+def WriteJson(path: Path, content: Any, mode: Optional[int] = None) -> bool:
+    """Writes content as JSON if it differs from what is already stored.
+
+    Args:
+        path: File to write.
+        content: JSON serializable object.
+        mode: Permission bits for the file, e.g. PRIVATE_FILE_MODE.
+
+    Returns:
+        True if the file was written. False if it already had the content.
+    """
+    data = _Serialize(content)
+    with FileLock(path):
+        try:
+            if path.read_bytes() == data:
+                logging.debug(f"{path} is unchanged. Not writing.")
+                return False
+        except FileNotFoundError:
+            pass
+        WriteAtomic(path, data, mode)
+        return True
+
+
+def CookiesToJson(cookies: CookieJar) -> List[Dict[str, Any]]:
+    """Converts cookies to a JSON serializable list.
+
+    The list is sorted so that the same cookies always serialize the same.
+    """
+    serialized = [
+        {
+            "name": c.name,
+            "value": c.value,
+            "domain": c.domain,
+            "path": c.path,
+            "secure": c.secure,
+            "expires": c.expires,
+            "discard": c.discard,
+            "rest": c._rest,  # type: ignore
+        }
+        for c in cookies
+    ]
+    return sorted(serialized, key=lambda c: (c["domain"], c["path"], c["name"]))
+
+
+def CookiesFromJson(
+    serialized: List[Dict[str, Any]],
+) -> requests.cookies.RequestsCookieJar:
+    jar = requests.cookies.RequestsCookieJar()
+    for c in serialized:
+        jar.set_cookie(requests.cookies.create_cookie(**c))
+    return jar
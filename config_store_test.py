@@ -0,0 +1,75 @@
+import json
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import threading
+import unittest
+
+import requests
+
+import config_store
+
+
+class ConfigStoreTest(unittest.TestCase):
+    def testWriteAndReadJson(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "config.json"
+            self.assertTrue(config_store.WriteJson(path, {"a": 1}))
+            self.assertEqual(config_store.ReadJson(path), {"a": 1})
+
+    def testReadJsonNoFile(self):
+        with TemporaryDirectory() as tmpdir:
+            self.assertIsNone(config_store.ReadJson(Path(tmpdir) / "nothing.json"))
+
+    def testWriteJsonUnchanged(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "config.json"
+            self.assertTrue(config_store.WriteJson(path, {"a": 1, "b": 2}))
+            mtime = path.stat().st_mtime_ns
+            self.assertFalse(config_store.WriteJson(path, {"b": 2, "a": 1}))
+            self.assertEqual(path.stat().st_mtime_ns, mtime)
+            self.assertTrue(config_store.WriteJson(path, {"a": 2}))
+
+    def testWriteAtomicLeavesNoTemporaryFiles(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "file"
+            config_store.WriteAtomic(path, b"content")
+            self.assertEqual(os.listdir(tmpdir), ["file"])
+            self.assertEqual(path.read_bytes(), b"content")
+
+    def testFileLockSerializesWriters(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "counter.json"
+            config_store.WriteJson(path, 0)
+
+            def _Increment():
+                for _ in range(20):
+                    with config_store.FileLock(path):
+                        value = config_store.ReadJson(path)
+                        config_store.WriteAtomic(path, json.dumps(value + 1).encode())
+
+            threads = [threading.Thread(target=_Increment) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(config_store.ReadJson(path), 80)
+
+    def testCookiesRoundTrip(self):
+        jar = requests.cookies.RequestsCookieJar()
+        jar.set("PHPSESSID", "abc", domain=".dlsite.com", path="/", expires=12345)
+        jar.set(
+            "XSRF-TOKEN",
+            "token",
+            domain="login.dlsite.com",
+            path="/",
+            secure=True,
+            rest={"HttpOnly": None},
+        )
+
+        serialized = config_store.CookiesToJson(jar)
+        restored = config_store.CookiesFromJson(json.loads(json.dumps(serialized)))
+
+        self.assertEqual(config_store.CookiesToJson(restored), serialized)
+        self.assertEqual(restored.get("PHPSESSID", domain=".dlsite.com"), "abc")
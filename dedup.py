@@ -0,0 +1,205 @@
+"""Finds identical files in the library and replaces them with links.
+
+Candidates are narrowed down in steps so that most files are never read:
+files are grouped by size, then by a hash of their first and last blocks, and
+only the remaining ones are fully hashed.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import manifest
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Bytes hashed from each end of a file before hashing all of it.
+_PARTIAL_HASH_SIZE = 64 * 1024
+
+# ioctl to clone a file on Linux file systems that support it, e.g. btrfs, xfs.
+_FICLONE = 0x40049409
+
+
+class Method(str, Enum):
+    HARDLINK = "hardlink"
+    REFLINK = "reflink"
+
+
+@dataclass
+class DuplicateGroup:
+    size: int
+    # The first one is kept. The others are replaced with links to it.
+    paths: List[Path]
+
+    def ReclaimableBytes(self) -> int:
+        return self.size * (len(self.paths) - 1)
+
+
+def _FilesBySize(roots: Iterable[Path], min_size: int) -> Dict[int, List[Path]]:
+    files_by_size: Dict[int, List[Path]] = {}
+    # Files that are already hard linked to each other are only listed once.
+    seen_inodes = set()
+    for root in roots:
+        for directory, _, file_names in os.walk(root):
+            for name in file_names:
+                if name == manifest.MANIFEST_FILE:
+                    continue
+                path = Path(directory) / name
+                stat = path.lstat()
+                if path.is_symlink() or stat.st_size < min_size:
+                    continue
+                inode = (stat.st_dev, stat.st_ino)
+                if inode in seen_inodes:
+                    continue
+                seen_inodes.add(inode)
+                files_by_size.setdefault(stat.st_size, []).append(path)
+    return files_by_size
+
+
+def _IsSmall(size: int) -> bool:
+    # The partial hash already covers the whole file.
+    return size <= 2 * _PARTIAL_HASH_SIZE
+
+
+def _PartialHash(path: Path) -> str:
+    size = path.stat().st_size
+    if _IsSmall(size):
+        return manifest.HashFile(path)
+    hasher = manifest.NewHasher()
+    with open(path, "rb") as f:
+        hasher.update(f.read(_PARTIAL_HASH_SIZE))
+        f.seek(size - _PARTIAL_HASH_SIZE)
+        hasher.update(f.read(_PARTIAL_HASH_SIZE))
+    return hasher.hexdigest()
+
+
+def _SplitByHash(
+    executor: ThreadPoolExecutor,
+    groups: List[List[Path]],
+    hash_function: Callable[[Path], str],
+) -> List[List[Path]]:
+    """Splits each group into groups of files with the same hash."""
+    paths = [path for group in groups for path in group]
+    hashes = dict(zip(paths, executor.map(hash_function, paths)))
+    split_groups = []
+    for group in groups:
+        by_hash: Dict[str, List[Path]] = {}
+        for path in group:
+            by_hash.setdefault(hashes[path], []).append(path)
+        split_groups.extend(g for g in by_hash.values() if len(g) > 1)
+    return split_groups
+
+
+def FindDuplicates(
+    roots: Iterable[Path], jobs: int = 4, min_size: int = 1
+) -> List[DuplicateGroup]:
+    """Finds files with identical content under roots.
+
+    Args:
+        roots: Directories to search, e.g. find_id.GetAllItemPaths().
+        jobs: Number of files read at the same time.
+        min_size: Smaller files are ignored.
+
+    Returns:
+        Groups of identical files, largest reclaimable size first.
+    """
+    candidates = [
+        sorted(paths)
+        for paths in _FilesBySize(roots, min_size).values()
+        if len(paths) > 1
+    ]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        candidates = _SplitByHash(executor, candidates, _PartialHash)
+        small = [g for g in candidates if _IsSmall(g[0].stat().st_size)]
+        large = [g for g in candidates if not _IsSmall(g[0].stat().st_size)]
+        candidates = small + _SplitByHash(executor, large, manifest.HashFile)
+
+    groups = [DuplicateGroup(group[0].stat().st_size, group) for group in candidates]
+    groups.sort(key=lambda g: g.ReclaimableBytes(), reverse=True)
+    return groups
+
+
+def _Reflink(source: Path, destination: Path):
+    if not fcntl or not hasattr(fcntl, "ioctl"):
+        raise OSError("Reflinks are not supported on this platform.")
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+
+def _ReplaceWithLink(original: Path, duplicate: Path, method: Method):
+    """Replaces duplicate with a link to original in one step."""
+    temp_path = duplicate.with_name(f".{duplicate.name}.dedup")
+    try:
+        if method == Method.HARDLINK:
+            os.link(original, temp_path)
+        else:
+            _Reflink(original, temp_path)
+            # A clone is a separate file. Keep the time of the file it replaces.
+            stat = duplicate.stat()
+            os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(temp_path, duplicate)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def _UpdateManifests(paths: List[Path], roots: Iterable[Path]):
+    """Records the new modification times in the manifests of the items."""
+    paths_by_root: Dict[Path, List[Path]] = {}
+    for path in paths:
+        for root in roots:
+            if path.is_relative_to(root):
+                paths_by_root.setdefault(root, []).append(path)
+                break
+
+    for root, root_paths in paths_by_root.items():
+        manifest_path = root / manifest.MANIFEST_FILE
+        item_manifest = manifest.Manifest.Load(manifest_path)
+        if not item_manifest:
+            continue
+        for path in root_paths:
+            entry = item_manifest.Get(path.relative_to(root).as_posix())
+            if entry:
+                entry.mtime_ns = path.stat().st_mtime_ns
+        item_manifest.Save(manifest_path)
+
+
+def Deduplicate(
+    groups: List[DuplicateGroup], method: Method, roots: Iterable[Path]
+) -> Tuple[int, int]:
+    """Replaces the duplicates in each group with links to its first file.
+
+    Args:
+        groups: From FindDuplicates().
+        method: How the files are linked.
+        roots: The directories that were searched. Manifests in them are
+            updated for the replaced files.
+
+    Returns:
+        The number of bytes reclaimed and the number of files that could not
+        be replaced.
+    """
+    roots = list(roots)
+    reclaimed = 0
+    num_failures = 0
+    replaced = []
+    for group in groups:
+        original = group.paths[0]
+        for duplicate in group.paths[1:]:
+            try:
+                _ReplaceWithLink(original, duplicate, method)
+            except OSError as e:
+                logging.error(f"Failed to replace {duplicate}: {e}")
+                num_failures += 1
+                continue
+            reclaimed += group.size
+            replaced.append(duplicate)
+    _UpdateManifests(replaced, roots)
+    return reclaimed, num_failures
@@ -0,0 +1,92 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+import dedup
+import manifest
+
+
+class DedupTest(unittest.TestCase):
+    def testFindDuplicates(self):
+        with TemporaryDirectory() as tmpdir:
+            first = Path(tmpdir) / "RJ1"
+            second = Path(tmpdir) / "RJ2"
+            first.mkdir()
+            second.mkdir()
+            (first / "bonus.png").write_bytes(b"same")
+            (second / "bonus.png").write_bytes(b"same")
+            (second / "other.png").write_bytes(b"diff")
+            (first / "unique.txt").write_bytes(b"unique content")
+
+            groups = dedup.FindDuplicates([first, second])
+
+            self.assertEqual(len(groups), 1)
+            self.assertEqual(
+                groups[0].paths, [first / "bonus.png", second / "bonus.png"]
+            )
+            self.assertEqual(groups[0].ReclaimableBytes(), 4)
+
+    @patch("dedup._PARTIAL_HASH_SIZE", 2)
+    def testSameEndsDifferentMiddle(self):
+        with TemporaryDirectory() as tmpdir:
+            root = Path(tmpdir)
+            (root / "a").write_bytes(b"ab-1-yz")
+            (root / "b").write_bytes(b"ab-2-yz")
+            (root / "c").write_bytes(b"ab-1-yz")
+
+            groups = dedup.FindDuplicates([root])
+
+            self.assertEqual(len(groups), 1)
+            self.assertEqual(groups[0].paths, [root / "a", root / "c"])
+
+    def testHardLinkedFilesAreNotDuplicates(self):
+        with TemporaryDirectory() as tmpdir:
+            root = Path(tmpdir)
+            (root / "a").write_bytes(b"same")
+            os.link(root / "a", root / "b")
+            self.assertEqual(dedup.FindDuplicates([root]), [])
+
+    def testDeduplicateWithHardLinks(self):
+        with TemporaryDirectory() as tmpdir:
+            first = Path(tmpdir) / "RJ1"
+            second = Path(tmpdir) / "RJ2"
+            for item_dir in [first, second]:
+                item_dir.mkdir()
+                (item_dir / "bonus.png").write_bytes(b"same")
+            os.utime(second / "bonus.png", ns=(0, 0))
+            manifest.Create(second, "RJ2").Save(second / manifest.MANIFEST_FILE)
+
+            groups = dedup.FindDuplicates([first, second])
+            reclaimed, num_failures = dedup.Deduplicate(
+                groups, dedup.Method.HARDLINK, [first, second]
+            )
+
+            self.assertEqual((reclaimed, num_failures), (4, 0))
+            self.assertTrue((first / "bonus.png").samefile(second / "bonus.png"))
+            self.assertEqual(
+                sorted(os.listdir(second)), [manifest.MANIFEST_FILE, "bonus.png"]
+            )
+            item_manifest = manifest.Manifest.Load(second / manifest.MANIFEST_FILE)
+            self.assertEqual(
+                item_manifest.files[0].mtime_ns,
+                (second / "bonus.png").stat().st_mtime_ns,
+            )
+
+    @patch("dedup._Reflink")
+    def testFailedReplacementKeepsFile(self, reflink_mock):
+        reflink_mock.side_effect = OSError("not supported")
+        with TemporaryDirectory() as tmpdir:
+            root = Path(tmpdir)
+            (root / "a").write_bytes(b"same")
+            (root / "b").write_bytes(b"same")
+
+            groups = dedup.FindDuplicates([root])
+            reclaimed, num_failures = dedup.Deduplicate(
+                groups, dedup.Method.REFLINK, [root]
+            )
+
+            self.assertEqual((reclaimed, num_failures), (0, 1))
+            self.assertEqual(sorted(os.listdir(root)), ["a", "b"])
+            self.assertFalse((root / "a").samefile(root / "b"))
@@ -0,0 +1,182 @@
+"""Moves extracted items into the management dir.
+
+On the same file system an item is renamed into place, which does not copy
+anything. shutil.move() silently falls back to copying everything instead,
+e.g. when the download dir is on another mount.
+
+Across file systems the item is copied into a staging dir on the file
+system of the management dir, checked, and only then renamed into place.
+The management dir never has a partially copied item, and an item that it
+already has is only replaced once the new one is complete.
+"""
+
+import concurrent.futures
+import errno
+import logging
+import os
+from pathlib import Path
+import shutil
+from typing import List, Optional
+
+import disk_plan
+import instrument
+
+# Under the destination dir, unless another staging dir is specified.
+DEFAULT_STAGING_DIR_NAME = ".staging"
+
+# Files copied at the same time. Copying is mostly waiting for the disks.
+_DEFAULT_COPY_JOBS = 4
+
+
+class MoveError(Exception):
+    pass
+
+
+def _ReplaceDir(source: Path, destination: Path):
+    """Renames source to destination, replacing destination if it exists.
+
+    Both must be on the same file system. The replaced directory is renamed
+    aside first and deleted after source is in place.
+    """
+    if not os.path.lexists(destination):
+        os.rename(source, destination)
+        return
+
+    # Hidden, so that it is not mistaken for an item if deleting it fails.
+    replaced = destination.with_name(f".{destination.name}.replaced")
+    if os.path.lexists(replaced):
+        shutil.rmtree(replaced)
+    os.rename(destination, replaced)
+    try:
+        os.rename(source, destination)
+    except OSError:
+        os.rename(replaced, destination)
+        raise
+    shutil.rmtree(replaced)
+
+
+def _CopyTree(source: Path, target: Path, jobs: int) -> List[Path]:
+    """Copies the directory tree, with the files in parallel.
+
+    Returns:
+        The paths of the copied files, relative to source.
+    """
+    files: List[Path] = []
+    directories: List[Path] = []
+    target.mkdir()
+    for root, dir_names, file_names in os.walk(source):
+        relative_root = Path(root).relative_to(source)
+        for name in dir_names:
+            relative = relative_root / name
+            if (source / relative).is_symlink():
+                # os.walk() does not go into them, so copy the link itself.
+                files.append(relative)
+                continue
+            (target / relative).mkdir()
+            directories.append(relative)
+        files.extend(relative_root / name for name in file_names)
+
+    def _Copy(relative: Path):
+        source_path = source / relative
+        if source_path.is_symlink():
+            os.symlink(os.readlink(source_path), target / relative)
+            return
+        shutil.copy2(source_path, target / relative)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        # list() to raise the first error, if any.
+        list(executor.map(_Copy, files))
+
+    # After the files, since adding them changes the modification time.
+    for relative in reversed(directories):
+        shutil.copystat(source / relative, target / relative)
+    shutil.copystat(source, target)
+    return files
+
+
+def _Verify(source: Path, target: Path, files: List[Path]) -> int:
+    """Checks that each copied file has the size of the original.
+
+    Returns:
+        The total size of the files.
+
+    Raises:
+        MoveError if a file differs.
+    """
+    total = 0
+    for relative in files:
+        source_size = (source / relative).lstat().st_size
+        target_size = (target / relative).lstat().st_size
+        if source_size != target_size:
+            raise MoveError(
+                f"Copy of {source / relative} has {target_size:,} bytes "
+                f"instead of {source_size:,}."
+            )
+        total += source_size
+    return total
+
+
+def _StagingDir(destination_dir: Path, staging_dir: Optional[Path]) -> Path:
+    default = destination_dir / DEFAULT_STAGING_DIR_NAME
+    if staging_dir:
+        staging_dir.mkdir(parents=True, exist_ok=True)
+        if disk_plan.SameFileSystem(staging_dir, destination_dir):
+            return staging_dir
+        logging.warning(
+            f"Staging dir {staging_dir} is not on the file system of "
+            f"{destination_dir}. Using {default} instead."
+        )
+    default.mkdir(exist_ok=True)
+    return default
+
+
+def MoveDir(
+    source: Path,
+    destination_dir: Path,
+    staging_dir: Optional[Path] = None,
+    jobs: int = _DEFAULT_COPY_JOBS,
+) -> Path:
+    """Moves source into destination_dir, replacing one with the same name.
+
+    Args:
+        source: Directory to move.
+        destination_dir: Directory to move source into.
+        staging_dir: Where source is copied to first when it is on another
+            file system. It must be on the file system of destination_dir.
+            Defaults to DEFAULT_STAGING_DIR_NAME in destination_dir.
+        jobs: Number of files copied at the same time.
+
+    Returns:
+        The moved directory.
+
+    Raises:
+        MoveError if the copy does not match source. source is left as is.
+    """
+    destination = destination_dir / source.name
+    if disk_plan.SameFileSystem(source.parent, destination_dir):
+        try:
+            with instrument.Span("move.rename"):
+                _ReplaceDir(source, destination)
+            return destination
+        except OSError as e:
+            # E.g. two bind mounts of the same file system.
+            if e.errno != errno.EXDEV:
+                raise
+
+    logging.info(f"{source} is on another file system. Copying it.")
+    staged = _StagingDir(destination_dir, staging_dir) / source.name
+    if os.path.lexists(staged):
+        # Left by an interrupted copy.
+        shutil.rmtree(staged)
+    try:
+        with instrument.Span("move.copy"):
+            files = _CopyTree(source, staged, jobs)
+            copied_bytes = _Verify(source, staged, files)
+    except BaseException:
+        shutil.rmtree(staged, ignore_errors=True)
+        raise
+    instrument.Count("move.copied_bytes", copied_bytes)
+
+    _ReplaceDir(staged, destination)
+    shutil.rmtree(source)
+    return destination
@@ -0,0 +1,141 @@
+import errno
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+import dir_move
+
+
+def _MakeItem(path: Path):
+    (path / "disc1").mkdir(parents=True)
+    (path / "disc1" / "track01.mp3").write_bytes(b"track one")
+    (path / "cover.jpg").write_bytes(b"cover")
+
+
+class MoveDirTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.download_dir = Path(tmpdir.name) / "downloading"
+        self.management_dir = Path(tmpdir.name) / "manage"
+        self.download_dir.mkdir()
+        self.management_dir.mkdir()
+        self.source = self.download_dir / "RJ123 title"
+        _MakeItem(self.source)
+
+    def _OtherFileSystem(self, *other_dirs: Path):
+        """Makes other_dirs look like they are on another file system."""
+
+        def _SameFileSystem(a: Path, b: Path) -> bool:
+            return (a in other_dirs) == (b in other_dirs)
+
+        return patch("disk_plan.SameFileSystem", side_effect=_SameFileSystem)
+
+    def _AssertMoved(self, destination: Path):
+        self.assertEqual(destination, self.management_dir / "RJ123 title")
+        self.assertEqual(
+            (destination / "disc1" / "track01.mp3").read_bytes(), b"track one"
+        )
+        self.assertEqual((destination / "cover.jpg").read_bytes(), b"cover")
+        self.assertFalse(self.source.exists())
+
+    def testRenamesOnTheSameFileSystem(self):
+        inode = (self.source / "cover.jpg").stat().st_ino
+
+        destination = dir_move.MoveDir(self.source, self.management_dir)
+
+        self._AssertMoved(destination)
+        self.assertEqual((destination / "cover.jpg").stat().st_ino, inode)
+        self.assertEqual(
+            [p.name for p in self.management_dir.iterdir()], ["RJ123 title"]
+        )
+
+    def testReplacesExistingItem(self):
+        existing = self.management_dir / "RJ123 title"
+        existing.mkdir()
+        (existing / "old.mp3").write_bytes(b"old")
+
+        destination = dir_move.MoveDir(self.source, self.management_dir)
+
+        self._AssertMoved(destination)
+        self.assertFalse((destination / "old.mp3").exists())
+        self.assertEqual(
+            [p.name for p in self.management_dir.iterdir()], ["RJ123 title"]
+        )
+
+    def testCopiesThroughStagingAcrossFileSystems(self):
+        existing = self.management_dir / "RJ123 title"
+        existing.mkdir()
+        (existing / "old.mp3").write_bytes(b"old")
+        mtime = 1_000_000_000
+        os.utime(self.source / "cover.jpg", (mtime, mtime))
+
+        with self._OtherFileSystem(self.download_dir):
+            destination = dir_move.MoveDir(self.source, self.management_dir)
+
+        self._AssertMoved(destination)
+        self.assertFalse((destination / "old.mp3").exists())
+        self.assertEqual((destination / "cover.jpg").stat().st_mtime, mtime)
+        staging_dir = self.management_dir / dir_move.DEFAULT_STAGING_DIR_NAME
+        self.assertEqual(list(staging_dir.iterdir()), [])
+
+    def testConfiguredStagingDir(self):
+        staging_dir = self.management_dir.parent / "staging"
+
+        with self._OtherFileSystem(self.download_dir):
+            with patch("dir_move._CopyTree", wraps=dir_move._CopyTree) as copy_mock:
+                destination = dir_move.MoveDir(
+                    self.source, self.management_dir, staging_dir
+                )
+
+        self._AssertMoved(destination)
+        self.assertEqual(copy_mock.call_args[0][1], staging_dir / "RJ123 title")
+
+    def testStagingDirOnAnotherFileSystemIsNotUsed(self):
+        staging_dir = self.management_dir.parent / "staging"
+
+        with self._OtherFileSystem(self.download_dir, staging_dir):
+            with patch("dir_move._CopyTree", wraps=dir_move._CopyTree) as copy_mock:
+                dir_move.MoveDir(self.source, self.management_dir, staging_dir)
+
+        self.assertEqual(
+            copy_mock.call_args[0][1],
+            self.management_dir / dir_move.DEFAULT_STAGING_DIR_NAME / "RJ123 title",
+        )
+
+    def testBadCopyLeavesEverythingAsIs(self):
+        existing = self.management_dir / "RJ123 title"
+        existing.mkdir()
+        (existing / "old.mp3").write_bytes(b"old")
+
+        def _TruncatedCopy(source, target):
+            Path(target).write_bytes(Path(source).read_bytes()[:1])
+
+        with self._OtherFileSystem(self.download_dir):
+            with patch("shutil.copy2", side_effect=_TruncatedCopy):
+                with self.assertRaises(dir_move.MoveError):
+                    dir_move.MoveDir(self.source, self.management_dir)
+
+        self.assertTrue((self.source / "cover.jpg").exists())
+        self.assertEqual((existing / "old.mp3").read_bytes(), b"old")
+        staging_dir = self.management_dir / dir_move.DEFAULT_STAGING_DIR_NAME
+        self.assertEqual(list(staging_dir.iterdir()), [])
+
+    def testCopiesWhenRenameIsCrossDevice(self):
+        rename = os.rename
+
+        def _Rename(source, destination):
+            if Path(source) == self.source:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            rename(source, destination)
+
+        with patch("os.rename", side_effect=_Rename):
+            destination = dir_move.MoveDir(self.source, self.management_dir)
+
+        self._AssertMoved(destination)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+"""Plans downloads so that they do not run out of disk space.
+
+Items are downloaded, then extracted in the download dir, then moved to the
+management dir. Given the download size of each item, this splits the items
+into batches whose peak disk usage fits in the free space. Each batch is
+downloaded and extracted before the next one starts, so the archives of a
+batch are deleted (and its items moved away, if the management dir is on
+another file system) before the next batch needs the space.
+"""
+
+from dataclasses import dataclass, field
+import os
+from pathlib import Path
+import shutil
+from typing import List, Set
+
+# Extracted works are usually about as large as their archives, because the
+# content (audio, images, video) is already compressed. Leave some room.
+EXTRACTED_SIZE_RATIO = 1.1
+
+# Space that is left free on each file system.
+RESERVED_BYTES = 512 * 1024 * 1024
+
+
+@dataclass
+class ItemSize:
+    item_id: str
+    download_bytes: int
+
+    def ExtractedBytes(self) -> int:
+        return int(self.download_bytes * EXTRACTED_SIZE_RATIO)
+
+
+@dataclass
+class Plan:
+    batches: List[Set[str]] = field(default_factory=list)
+    # Items that do not fit even on their own.
+    too_large: List[ItemSize] = field(default_factory=list)
+
+
+@dataclass
+class Usage:
+    # Peak and final bytes used on the file system of the download dir, and
+    # on the file system of the management dir if it is a different one.
+    download_peak: int = 0
+    download_final: int = 0
+    management_peak: int = 0
+    management_final: int = 0
+
+
+def FreeBytes(path: Path) -> int:
+    return shutil.disk_usage(path).free
+
+
+def SameFileSystem(a: Path, b: Path) -> bool:
+    return os.stat(a).st_dev == os.stat(b).st_dev
+
+
+def BatchUsage(
+    batch: List[ItemSize], same_file_system: bool, extract: bool, keep_archive: bool
+) -> Usage:
+    """Simulates downloading all of batch, then extracting item by item."""
+    download = sum(item.download_bytes for item in batch)
+    usage = Usage(download_peak=download)
+    if not extract:
+        usage.download_final = download
+        return usage
+
+    management = 0
+    for item in batch:
+        download += item.ExtractedBytes()
+        usage.download_peak = max(usage.download_peak, download)
+        if not keep_archive:
+            download -= item.download_bytes
+        if not same_file_system:
+            moved = item.ExtractedBytes()
+            if keep_archive:
+                moved += item.download_bytes
+            management += moved
+            usage.management_peak = max(usage.management_peak, management)
+            download -= moved
+    usage.download_final = download
+    usage.management_final = management
+    return usage
+
+
+def _Fits(usage: Usage, free_download: int, free_management: int) -> bool:
+    return (
+        usage.download_peak <= free_download - RESERVED_BYTES
+        and usage.management_peak <= free_management - RESERVED_BYTES
+    )
+
+
+def MakePlan(
+    items: List[ItemSize],
+    free_download: int,
+    free_management: int,
+    same_file_system: bool,
+    extract: bool,
+    keep_archive: bool,
+) -> Plan:
+    """Splits items into batches that fit in the free space.
+
+    Smaller items go first so that as many items as possible fit.
+
+    Args:
+        items: Items with their download sizes.
+        free_download: Free bytes on the file system of the download dir.
+        free_management: Free bytes on the file system of the management dir.
+            Ignored if same_file_system.
+        same_file_system: Whether the download dir and the management dir are
+            on the same file system.
+        extract: Whether the items are extracted after downloading.
+        keep_archive: Whether the archives are kept after extracting.
+    """
+    plan = Plan()
+    batch: List[ItemSize] = []
+
+    def _Usage(items: List[ItemSize]) -> Usage:
+        return BatchUsage(items, same_file_system, extract, keep_archive)
+
+    def _CloseBatch():
+        nonlocal free_download, free_management
+        usage = _Usage(batch)
+        free_download -= usage.download_final
+        free_management -= usage.management_final
+        plan.batches.append({item.item_id for item in batch})
+
+    if same_file_system:
+        # Only the download dir is counted then.
+        free_management = free_download + RESERVED_BYTES
+
+    for item in sorted(items, key=lambda i: i.download_bytes):
+        if _Fits(_Usage(batch + [item]), free_download, free_management):
+            batch.append(item)
+            continue
+        if batch:
+            _CloseBatch()
+            batch = []
+        if _Fits(_Usage([item]), free_download, free_management):
+            batch.append(item)
+        else:
+            plan.too_large.append(item)
+    if batch:
+        _CloseBatch()
+    return plan
@@ -0,0 +1,101 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+import disk_plan
+
+_GB = 1024**3
+
+
+def _Items(**sizes_in_gb):
+    return [disk_plan.ItemSize(i, int(s * _GB)) for i, s in sizes_in_gb.items()]
+
+
+@patch("disk_plan.RESERVED_BYTES", 0)
+@patch("disk_plan.EXTRACTED_SIZE_RATIO", 1.0)
+class DiskPlanTest(unittest.TestCase):
+    def testAllFit(self):
+        plan = disk_plan.MakePlan(
+            _Items(RJ1=1, RJ2=2), 10 * _GB, 0, True, extract=True, keep_archive=False
+        )
+        self.assertEqual(plan.batches, [{"RJ1", "RJ2"}])
+        self.assertEqual(plan.too_large, [])
+
+    def testSplitsWhenExtractionNeedsMoreSpace(self):
+        # All three archives fit, but extracting the first one needs 3 GB more.
+        # The extracted items are moved away, so the space is free again for
+        # the next batch.
+        plan = disk_plan.MakePlan(
+            _Items(RJ1=3, RJ2=3, RJ3=3),
+            10 * _GB,
+            100 * _GB,
+            False,
+            extract=True,
+            keep_archive=False,
+        )
+        self.assertEqual(plan.batches, [{"RJ1", "RJ2"}, {"RJ3"}])
+
+    def testKeptArchivesUseSpaceOfLaterBatches(self):
+        plan = disk_plan.MakePlan(
+            _Items(RJ1=2, RJ2=2, RJ3=2, RJ4=2),
+            9 * _GB,
+            0,
+            True,
+            extract=True,
+            keep_archive=True,
+        )
+        # Each batch leaves its archives and extracted files behind.
+        self.assertEqual(plan.batches, [{"RJ1", "RJ2"}])
+        self.assertEqual([i.item_id for i in plan.too_large], ["RJ3", "RJ4"])
+
+    def testTooLarge(self):
+        plan = disk_plan.MakePlan(
+            _Items(RJ1=1, RJ2=6), 10 * _GB, 0, True, extract=True, keep_archive=False
+        )
+        self.assertEqual(plan.batches, [{"RJ1"}])
+        self.assertEqual([i.item_id for i in plan.too_large], ["RJ2"])
+
+    def testWithoutExtraction(self):
+        plan = disk_plan.MakePlan(
+            _Items(RJ1=4, RJ2=4, RJ3=4),
+            10 * _GB,
+            0,
+            True,
+            extract=False,
+            keep_archive=False,
+        )
+        self.assertEqual(plan.batches, [{"RJ1", "RJ2"}])
+        self.assertEqual([i.item_id for i in plan.too_large], ["RJ3"])
+
+    def testSeparateManagementFileSystem(self):
+        # Extracted items are moved away, which frees the download dir, but
+        # they fill up the management dir.
+        plan = disk_plan.MakePlan(
+            _Items(RJ1=3, RJ2=3, RJ3=3),
+            7 * _GB,
+            7 * _GB,
+            False,
+            extract=True,
+            keep_archive=False,
+        )
+        self.assertEqual(plan.batches, [{"RJ1"}, {"RJ2"}])
+        self.assertEqual([i.item_id for i in plan.too_large], ["RJ3"])
+
+    def testReservedSpace(self):
+        with patch("disk_plan.RESERVED_BYTES", _GB):
+            plan = disk_plan.MakePlan(
+                _Items(RJ1=5), 10 * _GB, 0, True, extract=True, keep_archive=False
+            )
+        self.assertEqual([i.item_id for i in plan.too_large], ["RJ1"])
+
+    def testSameFileSystem(self):
+        with TemporaryDirectory() as tmpdir:
+            a = Path(tmpdir) / "a"
+            a.mkdir()
+            self.assertTrue(disk_plan.SameFileSystem(Path(tmpdir), a))
+            self.assertGreater(disk_plan.FreeBytes(a), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
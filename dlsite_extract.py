@@ -1,19 +1,23 @@
 #!/usr/bin/env python3
 
 import json
-from typing import List, Set, Tuple
+from typing import Callable, Dict, List, Optional, Set
 import ntpath
 import os
 import urllib.request
 import urllib.error
 import subprocess
+import sys
+import zipfile
 
 import argparse
-import re
-import shutil
 import pathlib
 import logging
 
+import find_id
+import instrument
+import progress
+
 
 # From stackoverflow
 # https://stackoverflow.com/questions/431684/how-do-i-change-directory-cd-in-python
@@ -42,11 +46,16 @@ def _GetPage(url):
     return request.read().decode()
 
 
-def _GetRjCode(file_name) -> str:
-    file_name, ext = os.path.splitext(file_name)
-    while ext:
-        file_name, ext = os.path.splitext(file_name)
-    return file_name
+def _ArchiveWorkCode(file_name: str) -> Optional[str]:
+    """Returns the work code of a downloaded archive file, or None.
+
+    Downloaded archive files are named after the work code, e.g. RJ1234.zip,
+    VJ01234567.part1.exe or BJ1234.part2.rar.
+    """
+    work_code = find_id.MatchItemId(file_name)
+    if work_code and file_name[len(work_code) :].startswith("."):
+        return work_code
+    return None
 
 
 def GetWorkNameFromWorkId(work_id: str) -> str:
@@ -62,7 +71,8 @@ def GetWorkNameFromWorkId(work_id: str) -> str:
         str: Name of work. Empty string on error.
     """
     try:
-        url = f"https://www.dlsite.com/maniax/product/info/ajax?product_id={work_id}"
+        site = find_id.SiteOf(work_id)
+        url = f"https://www.dlsite.com/{site}/product/info/ajax?product_id={work_id}"
         raw_json_response = _GetPage(url)
         work_info = json.loads(raw_json_response)
         return work_info[work_id]["work_name"]
@@ -70,7 +80,17 @@ def GetWorkNameFromWorkId(work_id: str) -> str:
         return ""
 
 
-def Unarchive(archive_dir: pathlib.Path, keep_archive: bool):
+def IsReadableArchive(path: pathlib.Path) -> bool:
+    """Quick structural check of an archive. Does not read the whole file.
+
+    Only zip files are checked. Other formats are assumed to be readable.
+    """
+    if path.suffix.lower() == ".zip":
+        return zipfile.is_zipfile(path)
+    return True
+
+
+def Unarchive(archive_dir: pathlib.Path, keep_archive: bool) -> bool:
     """Extracts the files in the directory.
 
     Unarchives the archives in the specified directory. The output is also
@@ -79,15 +99,23 @@ def Unarchive(archive_dir: pathlib.Path, keep_archive: bool):
     Args:
         archive_dir contains the archives that should be extracted.
         keep_archive specifies whether the archives should be kept after extraction.
+
+    Returns:
+        False if extraction failed. True otherwise, including when there was
+        nothing to extract.
     """
-    archive_files: List[pathlib.Path] = []
-    for file in archive_dir.glob("*"):
-        if file.is_file():
-            archive_files.append(file)
+    # Only the downloaded archives, which are named after the work code. When
+    # extraction is redone (e.g. after a crash) the directory also has
+    # extracted files, which must not be extracted or deleted as archives.
+    archive_files: List[pathlib.Path] = [
+        file
+        for file in archive_dir.glob("*")
+        if file.is_file() and _ArchiveWorkCode(file.name)
+    ]
 
     if len(archive_files) == 0:
         logging.warning(f"No files found in {archive_dir}")
-        return
+        return True
 
     # If there are multiple files, then only the one that says 'part1' has to
     # be extracted.
@@ -101,8 +129,10 @@ def Unarchive(archive_dir: pathlib.Path, keep_archive: bool):
                 target_file = file
                 break
 
-    if not _ExtractZip(archive_dir, target_file):
-        return
+    with instrument.Span("extract.unarchive"):
+        if not _ExtractZip(archive_dir, target_file):
+            return False
+    instrument.Count("extract.archives")
 
     if not keep_archive:
         logging.info(f"Cleaning archive files for {archive_dir}")
@@ -111,6 +141,7 @@ def Unarchive(archive_dir: pathlib.Path, keep_archive: bool):
             if f.exists():
                 logging.info(f"Removing {f}.")
                 os.remove(f)
+    return True
 
 
 def _ExtractZip(archive_dir: pathlib.Path, target_file: pathlib.Path) -> bool:
@@ -137,8 +168,10 @@ def _ExtractZip(archive_dir: pathlib.Path, target_file: pathlib.Path) -> bool:
             str(target_file),
         ]
         logging.debug(cmd)
+        # Keeps the events on stdout parseable.
+        stdout = sys.stderr if progress.StdoutIsReserved() else None
         try:
-            subprocess.check_call(cmd, cwd=archive_dir)
+            subprocess.check_call(cmd, cwd=archive_dir, stdout=stdout)
         except:
             logging.error(f"Failed to extract {target_file}")
             return False
@@ -147,72 +180,67 @@ def _ExtractZip(archive_dir: pathlib.Path, target_file: pathlib.Path) -> bool:
             return True
 
 
-def _PopOneWork(files: List[str]) -> Tuple[List[str], List[str]]:
-    """Get one archive from files list
+def _GroupArchives(files: List[str]) -> List[List[str]]:
+    """Groups the file names into the files of each archive.
 
-    This will remove at least one file from the files list.
+    A zip file is always an archive by itself. Other files with the same
+    work code are one split archive if one of them is a part, e.g.
+    RJ1234.part1.exe and RJ1234.part2.rar. Files that are not named after a
+    work code, and files of a work without any part, are left out.
 
     Args:
-      A list of files.
+      A list of file names.
 
     Returns:
-      Returns a list of files for an archive and the rest of the files that
-      have not been processed.
-      If the first file isn't an archive file, then returns an empty list and
-      a list of files that have not yet been processed (TBC it removes the first
-      file in list).
+      The file names of each archive, in the order of their first file in
+      files.
     """
-    archive_paths = []
-    if len(files) == 0:
-        return [], []
-
-    f = files[0]
-    files.remove(f)
-    pattern = re.compile(r"^(RJ\d+)\.")
-    match = pattern.search(f)
-    if not match:
-        return [], files
-
-    if f.endswith(".zip"):
-        # Zip file is always single file.
-        archive_paths.append(f)
-        return archive_paths, files
-
-    if "part" not in f:
-        return [], files
-
-    # This is a split archive so put it in archive paths immediately.
-    archive_paths.append(f)
-
-    # Split archive.
-    # Find all relevant files.
-    work_name = match[1]
+    # Insertion ordered, so that the archives keep the order of files.
+    groups: Dict[str, List[str]] = {}
     for f in files:
-        if work_name in f:
-            archive_paths.append(f)
-
-    for archive in archive_paths:
-        if archive in files:
-            files.remove(archive)
-
-    return archive_paths, files
+        work_code = _ArchiveWorkCode(f)
+        if not work_code:
+            continue
+        if f.endswith(".zip"):
+            # Keyed by the file name so that it is not grouped with anything.
+            groups[f] = [f]
+            continue
+        groups.setdefault(work_code, []).append(f)
+
+    archives = []
+    for key, archive_files in groups.items():
+        if key.endswith(".zip") or any("part" in f for f in archive_files):
+            archives.append(archive_files)
+    return archives
 
 
 class Archive:
     @classmethod
-    def Create(cls, dir: pathlib.Path):
-        onlyfiles = [f for f in os.listdir(dir) if os.path.isfile(os.path.join(dir, f))]
+    def Create(
+        cls, dir: pathlib.Path, item_filter: Optional[Callable[[str], bool]] = None
+    ):
+        """Groups the archive files in dir into Archive objects.
+
+        Args:
+            dir: Directory with the archive files.
+            item_filter: If specified, only archives whose work code it
+                returns True for are returned.
+        """
+        # scandir() usually knows the file type without a stat per file.
+        with os.scandir(dir) as entries:
+            onlyfiles = [entry.name for entry in entries if entry.is_file()]
 
         # Sometimes there are hidden files. Filter them out.
         onlyfiles = [f for f in onlyfiles if not f.startswith(".")]
 
         archives = []
-        while onlyfiles:
-            archive_paths, onlyfiles = _PopOneWork(onlyfiles)
-            if not archive_paths:
+        for archive_files in _GroupArchives(onlyfiles):
+            archive_paths = [os.path.join(dir, f) for f in archive_files]
+            archive = Archive(archive_paths)
+            if item_filter and not item_filter(archive.WorkCode()):
+                logging.info(f"Skipping {archive.WorkCode()}.")
                 continue
-            archive_paths = [os.path.join(dir, f) for f in archive_paths]
-            archives.append(Archive(archive_paths))
+            archives.append(archive)
 
         return archives
 
@@ -227,13 +255,14 @@ class Archive:
         self.__paths = paths
         self.__work_name = None
         self.__file_name = ntpath.basename(self.__paths[0])
-        self.__rj_code = _GetRjCode(self.__file_name)
+        self.__work_code = _ArchiveWorkCode(self.__file_name)
 
     # The item page is deleted for items removed from the store. However the
     # Download page might have the name. Change it to get it from there.
     def FetchWorkName(self):
         if not self.__work_name:
-            work_name = GetWorkNameFromWorkId(self.__rj_code)
+            with instrument.Span("extract.fetch_work_name"):
+                work_name = GetWorkNameFromWorkId(self.__work_code)
             if not work_name:
                 return ""
 
@@ -251,7 +280,7 @@ class Archive:
         return self.__paths
 
     def WorkCode(self):
-        return self.__rj_code
+        return self.__work_code
 
 
 def _MoveArchiveToDir(archive: Archive, out_dir_name: str) -> pathlib.Path:
@@ -272,14 +301,18 @@ def _MoveArchiveToDir(archive: Archive, out_dir_name: str) -> pathlib.Path:
 
     for f in archive.Paths():
         # Get the file name and move it to out dir. In case if the
-        # file already exists, this will overwrite it.
+        # file already exists, this will overwrite it. out_dir is next to the
+        # file, so this is a rename.
         file_name = ntpath.basename(f)
-        shutil.move(f, out_dir / file_name)
+        os.replace(f, out_dir / file_name)
 
     return out_dir
 
 
-def CreateArchivesDirs(dir_with_archives: pathlib.Path) -> Set[pathlib.Path]:
+def CreateArchivesDirs(
+    dir_with_archives: pathlib.Path,
+    item_filter: Optional[Callable[[str], bool]] = None,
+) -> Set[pathlib.Path]:
     """Creates directories and moves the archives into the directory.
 
     This function takes a directory that contains a bunch of archives.
@@ -289,16 +322,21 @@ def CreateArchivesDirs(dir_with_archives: pathlib.Path) -> Set[pathlib.Path]:
     Args:
         dir_with_archives is the directory containing archives (e.g. zip,
         partial rar files, etc.).
+        item_filter is called with each work code. Archives it returns False
+        for are left untouched.
 
     Returns:
         A set of directories where the archives were moved to.
     """
-    archives = Archive.Create(dir_with_archives)
+    with instrument.Span("extract.group_archives"):
+        archives = Archive.Create(dir_with_archives, item_filter)
 
     new_directories: Set[pathlib.Path] = set()
     for archive in archives:
         work_name = archive.FetchWorkName()
-        print(f"Extracting {archive.Paths()} for {work_name}.")
+        progress.Message(
+            f"Extracting {archive.Paths()} for {work_name}.", archive.WorkCode()
+        )
         if not work_name:
             output_dir_name = archive.WorkCode()
         else:
@@ -3,85 +3,91 @@
 
 from pathlib import Path
 from tempfile import TemporaryDirectory
+import sys
 import unittest
 from unittest.mock import MagicMock, patch
 
 import dlsite_extract
+import progress
 
 
 class ExtractTest(unittest.TestCase):
-    def testPopOneWorkNormal(self):
-        with TemporaryDirectory() as dir_with_archives:
-            dir_with_archives = Path(dir_with_archives)
-            files = [
-                dir_with_archives / "RJ1234.zip",
-                dir_with_archives / "RJ4321.part1.exe",
-                dir_with_archives / "RJ4321.part2.rar",
-            ]
-
-            archives, rest = dlsite_extract._PopOneWork(
-                list(map(lambda f: f.name, files))
-            )
-            self.assertEqual(archives, ["RJ1234.zip"])
-            self.assertEqual(rest, ["RJ4321.part1.exe", "RJ4321.part2.rar"])
-
-            archives, rest = dlsite_extract._PopOneWork(rest)
-            self.assertEqual(archives, ["RJ4321.part1.exe", "RJ4321.part2.rar"])
-            self.assertEqual(len(rest), 0)
-
-    def testPopOneWorkPartsOnly(self):
-        with TemporaryDirectory() as dir_with_archives:
-            # Preparation. Create a bunch of files for testing.
-            dir_with_archives = Path(dir_with_archives)
-            files = [
-                dir_with_archives / "RJ1234.part1.exe",
-                dir_with_archives / "RJ1234.part2.rar",
-                dir_with_archives / "RJ1234.part3.rar",
-                dir_with_archives / "RJ4321.part1.exe",
-                dir_with_archives / "RJ4321.part2.rar",
-            ]
+    def testGroupArchivesNormal(self):
+        self.assertEqual(
+            dlsite_extract._GroupArchives(
+                ["RJ1234.zip", "RJ4321.part1.exe", "RJ4321.part2.rar"]
+            ),
+            [["RJ1234.zip"], ["RJ4321.part1.exe", "RJ4321.part2.rar"]],
+        )
 
-            archives, rest = dlsite_extract._PopOneWork(
-                list(map(lambda f: f.name, files))
-            )
-            self.assertEqual(
-                archives,
+    def testGroupArchivesPartsOnly(self):
+        self.assertEqual(
+            dlsite_extract._GroupArchives(
                 [
                     "RJ1234.part1.exe",
                     "RJ1234.part2.rar",
                     "RJ1234.part3.rar",
-                ],
-            )
-            self.assertEqual(rest, ["RJ4321.part1.exe", "RJ4321.part2.rar"])
-
-            archives, rest = dlsite_extract._PopOneWork(rest)
-            self.assertEqual(archives, ["RJ4321.part1.exe", "RJ4321.part2.rar"])
-            self.assertEqual(len(rest), 0)
-
-    def testPopOneWorkNoMatch(self):
-        with TemporaryDirectory() as dir_with_archives:
-            dir_with_archives = Path(dir_with_archives)
-            files = [
-                dir_with_archives / "somename.txt",
-                dir_with_archives / "RJ1234.part1.exe",
-                dir_with_archives / "RJ1234.part2.rar",
-                dir_with_archives / "RJ1234.part3.rar",
-            ]
+                    "RJ4321.part1.exe",
+                    "RJ4321.part2.rar",
+                ]
+            ),
+            [
+                ["RJ1234.part1.exe", "RJ1234.part2.rar", "RJ1234.part3.rar"],
+                ["RJ4321.part1.exe", "RJ4321.part2.rar"],
+            ],
+        )
 
-            archives, rest = dlsite_extract._PopOneWork(
-                list(map(lambda f: f.name, files))
-            )
-            self.assertEqual(len(archives), 0)
-            self.assertEqual(
-                rest,
+    def testGroupArchivesNoMatch(self):
+        self.assertEqual(
+            dlsite_extract._GroupArchives(
                 [
-                    # The first file that does not match the pattern should
-                    # be ignored.
+                    # Files that do not match the pattern are ignored.
+                    "somename.txt",
                     "RJ1234.part1.exe",
                     "RJ1234.part2.rar",
                     "RJ1234.part3.rar",
-                ],
-            )
+                    # Not a part of a split archive.
+                    "RJ5678.txt",
+                ]
+            ),
+            [["RJ1234.part1.exe", "RJ1234.part2.rar", "RJ1234.part3.rar"]],
+        )
+
+    def testGroupArchivesWorkCodeIsPrefixOfAnother(self):
+        self.assertEqual(
+            dlsite_extract._GroupArchives(
+                [
+                    "RJ12345.part2.rar",
+                    "RJ1234.part1.exe",
+                    "RJ12345.part1.exe",
+                    "RJ1234.zip",
+                    "RJ1234.part2.rar",
+                ]
+            ),
+            [
+                ["RJ12345.part2.rar", "RJ12345.part1.exe"],
+                ["RJ1234.part1.exe", "RJ1234.part2.rar"],
+                ["RJ1234.zip"],
+            ],
+        )
+
+    def testGroupArchivesOtherCategories(self):
+        self.assertEqual(
+            dlsite_extract._GroupArchives(
+                [
+                    "VJ01000001.part1.exe",
+                    "BJ01000002.zip",
+                    "VJ01000001.part2.rar",
+                    "RJ01000001.zip",
+                    "XJ01000001.zip",
+                ]
+            ),
+            [
+                ["VJ01000001.part1.exe", "VJ01000001.part2.rar"],
+                ["BJ01000002.zip"],
+                ["RJ01000001.zip"],
+            ],
+        )
 
     @patch("dlsite_extract.GetWorkNameFromWorkId")
     def testCreateArchiveDirs(self, get_work_name_mock):
@@ -185,3 +191,56 @@ class ExtractTest(unittest.TestCase):
             dlsite_extract.Unarchive(dir_with_archives, False)
 
         self.assertEqual(extract_mock.call_count, 0)
+
+    @patch("dlsite_extract._ExtractZip")
+    def testUnarchiveOnlyExtractsDownloadedArchives(self, extract_mock: MagicMock):
+        with TemporaryDirectory() as dir_with_archives:
+            dir_with_archives = Path(dir_with_archives)
+            # Extracted from the archive, e.g. before a crash.
+            (dir_with_archives / "bonus.zip").touch()
+
+            self.assertTrue(dlsite_extract.Unarchive(dir_with_archives, False))
+            self.assertTrue((dir_with_archives / "bonus.zip").exists())
+        extract_mock.assert_not_called()
+
+    @patch("dlsite_extract._ExtractZip")
+    def testUnarchiveFailure(self, extract_mock: MagicMock):
+        extract_mock.return_value = False
+        with TemporaryDirectory() as dir_with_archives:
+            dir_with_archives = Path(dir_with_archives)
+            archive = dir_with_archives / "RJ4321.zip"
+            archive.touch()
+
+            self.assertFalse(dlsite_extract.Unarchive(dir_with_archives, False))
+            self.assertTrue(archive.exists())
+
+    @patch("subprocess.check_call")
+    def testExtractZipKeepsNdjsonStdout(self, check_call_mock: MagicMock):
+        with TemporaryDirectory() as archive_dir:
+            archive_dir = Path(archive_dir)
+            dlsite_extract._ExtractZip(archive_dir, archive_dir / "RJ1.zip")
+            self.assertIsNone(check_call_mock.call_args.kwargs["stdout"])
+
+            previous = progress.SetSink(progress.NdjsonSink())
+            try:
+                dlsite_extract._ExtractZip(archive_dir, archive_dir / "RJ1.zip")
+            finally:
+                progress.SetSink(previous)
+            self.assertIs(check_call_mock.call_args.kwargs["stdout"], sys.stderr)
+
+    @patch("dlsite_extract._ExtractZip")
+    def testUnarchiveAgainKeepsExtractedFiles(self, extract_mock: MagicMock):
+        """Redoing an interrupted extraction must only remove the archives."""
+        extract_mock.return_value = True
+        with TemporaryDirectory() as dir_with_archives:
+            dir_with_archives = Path(dir_with_archives)
+            archive = dir_with_archives / "RJ4321.zip"
+            extracted = dir_with_archives / "readme.txt"
+            archive.touch()
+            extracted.touch()
+
+            self.assertTrue(dlsite_extract.Unarchive(dir_with_archives, False))
+            self.assertFalse(archive.exists())
+            self.assertTrue(extracted.exists())
+
+        extract_mock.assert_called_once_with(dir_with_archives, archive)
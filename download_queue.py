@@ -0,0 +1,150 @@
+"""Durable record of which items are queued for download and how far they got.
+
+The queue is an append-only journal in the config dir. Every state change is
+one JSON line, so updating an item does not rewrite the whole queue. The
+journal is compacted (rewritten with only the latest state of each item) when
+it is loaded.
+"""
+
+from dataclasses import asdict, dataclass
+from enum import Enum
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import config_store
+
+
+class ItemState(str, Enum):
+    QUEUED = "queued"
+    RESOLVING = "resolving"
+    DOWNLOADING = "downloading"
+    DOWNLOADED = "downloaded"
+    EXTRACTING = "extracting"
+    DONE = "done"
+    FAILED = "failed"
+
+
+# States where the item still has work left.
+_PENDING_STATES = {
+    ItemState.QUEUED,
+    ItemState.RESOLVING,
+    ItemState.DOWNLOADING,
+    ItemState.DOWNLOADED,
+    ItemState.EXTRACTING,
+}
+
+
+@dataclass
+class QueueEntry:
+    """State of an item in the queue.
+
+    part is the 1-based index of the file being downloaded out of num_parts
+    when the state is DOWNLOADING.
+    """
+
+    item_id: str
+    state: ItemState
+    part: int = 0
+    num_parts: int = 0
+    error: str = ""
+
+    def ToJson(self) -> Dict:
+        content = asdict(self)
+        content["state"] = self.state.value
+        return content
+
+    @classmethod
+    def FromJson(cls, content: Dict) -> "QueueEntry":
+        content = dict(content)
+        content["state"] = ItemState(content["state"])
+        return cls(**content)
+
+
+class DownloadQueue:
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._entries: Dict[str, QueueEntry] = {}
+        self._Load()
+
+    def _Load(self):
+        with config_store.FileLock(self._path):
+            try:
+                with open(self._path, "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                return
+
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    entry = QueueEntry.FromJson(json.loads(line))
+                except (ValueError, TypeError, KeyError):
+                    # A crash can leave a truncated last line.
+                    logging.warning(f"Ignoring broken queue entry: {line!r}")
+                    continue
+                self._entries[entry.item_id] = entry
+
+            # Compact. Finished items are dropped.
+            self._entries = {
+                item_id: entry
+                for item_id, entry in self._entries.items()
+                if entry.state != ItemState.DONE
+            }
+            data = "".join(
+                json.dumps(e.ToJson(), ensure_ascii=False) + "\n"
+                for e in self._entries.values()
+            )
+            config_store.WriteAtomic(self._path, data.encode("utf-8"))
+
+    def _Append(self, entries: List[QueueEntry]):
+        if not entries:
+            return
+        data = "".join(
+            json.dumps(e.ToJson(), ensure_ascii=False) + "\n" for e in entries
+        )
+        with config_store.FileLock(self._path):
+            with open(self._path, "a", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+
+    def Add(self, item_ids: Iterable[str], reset: bool = False):
+        """Queues items.
+
+        Items that are already pending keep their state, unless reset. Reset
+        e.g. items that are explicitly asked for again, so that they are not
+        skipped as downloaded.
+        """
+        new_entries = []
+        for item_id in item_ids:
+            entry = self._entries.get(item_id)
+            if not reset and entry and entry.state in _PENDING_STATES:
+                continue
+            entry = QueueEntry(item_id, ItemState.QUEUED)
+            self._entries[item_id] = entry
+            new_entries.append(entry)
+        self._Append(new_entries)
+
+    def Update(
+        self,
+        item_id: str,
+        state: ItemState,
+        part: int = 0,
+        num_parts: int = 0,
+        error: str = "",
+    ):
+        entry = QueueEntry(item_id, state, part, num_parts, error)
+        self._entries[item_id] = entry
+        self._Append([entry])
+
+    def Get(self, item_id: str) -> Optional[QueueEntry]:
+        return self._entries.get(item_id)
+
+    def Pending(self) -> List[QueueEntry]:
+        """Items that have not finished, in the order they were queued.
+
+        Failed items are included so that resuming retries them.
+        """
+        return [e for e in self._entries.values() if e.state != ItemState.DONE]
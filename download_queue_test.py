@@ -0,0 +1,80 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+import download_queue
+from download_queue import ItemState
+
+
+class DownloadQueueTest(unittest.TestCase):
+    def testAddAndReload(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "queue.jsonl"
+            queue = download_queue.DownloadQueue(path)
+            queue.Add(["RJ1", "RJ2"])
+            queue.Update("RJ2", ItemState.DOWNLOADING, part=2, num_parts=3)
+
+            reloaded = download_queue.DownloadQueue(path)
+            self.assertEqual(
+                [e.item_id for e in reloaded.Pending()],
+                ["RJ1", "RJ2"],
+            )
+            entry = reloaded.Get("RJ2")
+            self.assertEqual(entry.state, ItemState.DOWNLOADING)
+            self.assertEqual(entry.part, 2)
+            self.assertEqual(entry.num_parts, 3)
+
+    def testAddKeepsPendingState(self):
+        with TemporaryDirectory() as tmpdir:
+            queue = download_queue.DownloadQueue(Path(tmpdir) / "queue.jsonl")
+            queue.Add(["RJ1"])
+            queue.Update("RJ1", ItemState.DOWNLOADED)
+            queue.Add(["RJ1"])
+            self.assertEqual(queue.Get("RJ1").state, ItemState.DOWNLOADED)
+
+    def testAddWithResetRequeuesPending(self):
+        with TemporaryDirectory() as tmpdir:
+            queue = download_queue.DownloadQueue(Path(tmpdir) / "queue.jsonl")
+            queue.Add(["RJ1"])
+            queue.Update("RJ1", ItemState.DOWNLOADED)
+            queue.Add(["RJ1"], reset=True)
+            self.assertEqual(queue.Get("RJ1").state, ItemState.QUEUED)
+
+    def testAddRequeuesFailed(self):
+        with TemporaryDirectory() as tmpdir:
+            queue = download_queue.DownloadQueue(Path(tmpdir) / "queue.jsonl")
+            queue.Add(["RJ1"])
+            queue.Update("RJ1", ItemState.FAILED, error="something")
+            self.assertEqual([e.item_id for e in queue.Pending()], ["RJ1"])
+            queue.Add(["RJ1"])
+            self.assertEqual(queue.Get("RJ1").state, ItemState.QUEUED)
+
+    def testDoneItemsAreCompactedAway(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "queue.jsonl"
+            queue = download_queue.DownloadQueue(path)
+            queue.Add(["RJ1", "RJ2"])
+            for state in [
+                ItemState.RESOLVING,
+                ItemState.DOWNLOADING,
+                ItemState.DOWNLOADED,
+                ItemState.EXTRACTING,
+                ItemState.DONE,
+            ]:
+                queue.Update("RJ1", state)
+            self.assertEqual(len(path.read_text().splitlines()), 7)
+
+            reloaded = download_queue.DownloadQueue(path)
+            self.assertIsNone(reloaded.Get("RJ1"))
+            self.assertEqual(len(path.read_text().splitlines()), 1)
+
+    def testTruncatedLineIsIgnored(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "queue.jsonl"
+            queue = download_queue.DownloadQueue(path)
+            queue.Add(["RJ1"])
+            with open(path, "a") as f:
+                f.write('{"item_id": "RJ2", "sta')
+
+            reloaded = download_queue.DownloadQueue(path)
+            self.assertEqual([e.item_id for e in reloaded.Pending()], ["RJ1"])
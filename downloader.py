@@ -1,15 +1,54 @@
+import ctypes
+from dataclasses import dataclass
+import html.parser
+import http.client
+import io
 import logging
+import os
 import pathlib
-from typing import List, Union
+import sys
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import urllib.parse
-from tqdm import tqdm
 from sys import path
 from bs4 import BeautifulSoup, NavigableString
+import instrument
+import manifest
+import progress
+import rate_limit
 import requests
+import session_pool
 
 # Too small chunk size doesn't make much sense. 25 megabytes is set here.
 _DOWNLOAD_CHUNK_SIZE = 25 * 1024 * 1024
 
+_TEMP_DOWNLOAD_FILE_SUFFIX = ".downloading"
+
+# The split download page lists the files in this element, one per element
+# with _WORK_DOWNLOAD_CLASS.
+_DIVISION_FILE_ID = "download_division_file"
+_WORK_DOWNLOAD_CLASS = "work_download"
+
+# Elements without an end tag.
+_VOID_ELEMENTS = frozenset(
+    [
+        "area",
+        "base",
+        "br",
+        "col",
+        "embed",
+        "hr",
+        "img",
+        "input",
+        "link",
+        "meta",
+        "source",
+        "track",
+        "wbr",
+    ]
+)
+
+_USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36"
+
 
 # Thrown when the HTTP status is 401.
 class HttpUnauthorizeException(Exception):
@@ -22,6 +61,20 @@ class DownloadError(Exception):
     pass
 
 
+@dataclass
+class RemoteFile:
+    """A file to download for an item.
+
+    size and file_name are known once the file is resolved with
+    Downloader.ResolveFiles(). file_name is None if the server does not name
+    the file.
+    """
+
+    url: str
+    size: Optional[int] = None
+    file_name: Optional[str] = None
+
+
 def FindItemIdFromUrl(item_url):
     parse_result = urllib.parse.urlparse(item_url)
     path = parse_result.path
@@ -47,12 +100,215 @@ def _GetContentDispositionFilename(content_disposition_content: str):
     return ""
 
 
+class _StopParsing(Exception):
+    pass
+
+
+class _SplitPageParser(html.parser.HTMLParser):
+    """Collects the links of the split files from the split download page.
+
+    Unlike BeautifulSoup, no tree is built and parsing stops at the end of the
+    division element, so most of the page is never parsed.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.found = False
+        self.urls: List[str] = []
+        # Whether a work_download element ended without a link. The full parse
+        # decides what such a page means.
+        self.part_without_link = False
+        # Names of the open elements from the division element down.
+        self._open: List[str] = []
+        # Number of open elements with the work_download element, if one is
+        # open.
+        self._part_depth = 0
+        self._part_has_link = False
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        if not self.found:
+            if attributes.get("id") == _DIVISION_FILE_ID:
+                self.found = True
+                self._open = [tag]
+            return
+
+        if tag == "a" and self._part_depth and not self._part_has_link:
+            self._part_has_link = True
+            self.urls.append(attributes.get("href"))
+        if tag in _VOID_ELEMENTS:
+            return
+        self._open.append(tag)
+        classes = (attributes.get("class") or "").split()
+        if not self._part_depth and _WORK_DOWNLOAD_CLASS in classes:
+            self._part_depth = len(self._open)
+            self._part_has_link = False
+
+    def handle_endtag(self, tag):
+        # End tags of void elements and stray end tags do not close anything.
+        if not self.found or tag not in self._open:
+            return
+        # Elements that are left open in it are closed with it.
+        while self._open.pop() != tag:
+            pass
+        if len(self._open) < self._part_depth:
+            self._part_depth = 0
+            if not self._part_has_link:
+                self.part_without_link = True
+        if not self._open:
+            raise _StopParsing()
+
+
+def _ParseSplitPageFast(page: str) -> Optional[List[str]]:
+    """Returns the URLs in the split download page, or None if not sure."""
+    parser = _SplitPageParser()
+    try:
+        parser.feed(page)
+        parser.close()
+    except _StopParsing:
+        pass
+    if not parser.found or not parser.urls or None in parser.urls:
+        return None
+    if parser.part_without_link:
+        return None
+    return parser.urls
+
+
+def _ParseSplitPageWithSoup(page: str) -> List[str]:
+    split_page = BeautifulSoup(page, "html.parser")
+    div_file = split_page.find(id=_DIVISION_FILE_ID)
+    if div_file is None:
+        raise DownloadError(f"Failed to find id={_DIVISION_FILE_ID}")
+    if isinstance(div_file, NavigableString):
+        logging.debug(f"Found id={_DIVISION_FILE_ID} but is a string: {div_file}")
+        raise DownloadError(f"Unexpected string: {div_file}")
+    split_parts = div_file.find_all(class_=_WORK_DOWNLOAD_CLASS)
+
+    return [part.find("a").get("href") for part in split_parts]
+
+
+def _ParseSplitPage(page: str) -> List[str]:
+    """Returns the URLs of the files in the split download page.
+
+    The page is parsed only up to the list of files. If that does not find
+    them, e.g. the page is laid out differently, the whole page is parsed.
+
+    Raises:
+        DownloadError if the page does not have the list.
+    """
+    urls = _ParseSplitPageFast(page)
+    if urls is not None:
+        return urls
+    logging.info("Parsing the whole split download page.")
+    return _ParseSplitPageWithSoup(page)
+
+
+def _IsDownloaded(download_path: pathlib.Path, size: int) -> bool:
+    return download_path.is_file() and download_path.stat().st_size == size
+
+
+def _TempDownloadPath(download_path: pathlib.Path) -> pathlib.Path:
+    return download_path.with_suffix(_TEMP_DOWNLOAD_FILE_SUFFIX)
+
+
+def _LoadFallocate() -> Optional[Callable[..., int]]:
+    """Returns fallocate(2) of libc, which only Linux has."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _LoadFallocate()
+
+# Reserves the blocks without changing the file size.
+_FALLOC_FL_KEEP_SIZE = 0x01
+
+
+def _Preallocate(f: io.FileIO, size: int):
+    """Reserves disk space for the whole file up front, where supported.
+
+    The size of the file is left as is, so that it is still the number of
+    bytes downloaded, which resuming relies on, even if the process is killed
+    before it can truncate the file.
+    """
+    if _fallocate is None or size <= 0:
+        return
+    if _fallocate(f.fileno(), _FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        # Some file systems, e.g. some network shares, do not support it.
+        error = ctypes.get_errno()
+        logging.debug(f"Could not preallocate {size:,} bytes: {os.strerror(error)}")
+
+
+def _RawBody(response: requests.Response) -> Optional[io.IOBase]:
+    """Returns a stream to readinto() the body from, or None if there is none.
+
+    urllib3's readinto() reads into a temporary bytes object and copies it, so
+    the http.client response under it is used when it is there.
+    """
+    # iter_content() decodes Content-Encoding but reading raw does not.
+    if response.headers.get("content-encoding", "identity") not in ("identity", None):
+        return None
+    raw = response.raw
+    if isinstance(getattr(raw, "_fp", None), http.client.HTTPResponse):
+        return raw._fp
+    if isinstance(raw, io.IOBase):
+        return raw
+    return None
+
+
+def _CopyByIterContent(
+    response: requests.Response,
+    f: io.FileIO,
+    chunk_size: int,
+    on_chunk: Callable[[memoryview], None],
+):
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        if not chunk:
+            continue
+        on_chunk(memoryview(chunk))
+        f.write(chunk)
+
+
+def _CopyByReadInto(
+    body: io.IOBase,
+    f: io.FileIO,
+    chunk_size: int,
+    on_chunk: Callable[[memoryview], None],
+):
+    """Copies body to f through one reusable buffer."""
+    buffer = memoryview(bytearray(chunk_size))
+    while True:
+        num_read = body.readinto(buffer)
+        if not num_read:
+            break
+        remaining = buffer[:num_read]
+        on_chunk(remaining)
+        while remaining:
+            remaining = remaining[f.write(remaining) :]
+
+
 def _DownloadWithProgress(
-    response: requests.Response, download_path: pathlib.Path
+    response: requests.Response,
+    download_path: pathlib.Path,
+    resume_from: int = 0,
+    limiter: Optional[rate_limit.ScheduledLimiter] = None,
+    hasher=None,
+    item_id: Optional[str] = None,
+    part: Optional[int] = None,
+    num_parts: Optional[int] = None,
 ) -> pathlib.Path:
     """Downloads a file using streaming response to a path.
 
-    Note that while it is downloading, it will use a temporary name.
+    Note that while it is downloading, it will use a temporary name. The
+    temporary file is preallocated to its final size, and truncated back to
+    the downloaded size when the download stops, so that its size can still
+    be used to resume.
 
     Args:
         response is the Response object from getting the download object. It is
@@ -60,34 +316,94 @@ def _DownloadWithProgress(
 
         download_path is where the downloaded file will be placed on success.
 
+        resume_from is the number of bytes already in the temporary file. The
+        response must then be a partial response starting at that offset.
+
+        limiter limits the download speed. It may be shared with other
+        downloads.
+
+        hasher, e.g. from manifest.NewHasher(), is updated with the whole
+        content of the file, including the part downloaded before resuming.
+
+        item_id, part and num_parts describe the file in the progress events.
+
     Returns:
         A Path object the downloaded file.
     """
-    _TEMP_DOWNLOAD_FILE_SUFFIX = ".downloading"
-    temp_download_path = download_path.with_suffix(_TEMP_DOWNLOAD_FILE_SUFFIX)
-
-    with open(temp_download_path, "wb") as f:
-        progress = tqdm(
-            unit="B", total=int(response.headers["Content-Length"]), unit_scale=True
+    temp_download_path = _TempDownloadPath(download_path)
+    total = resume_from + int(response.headers["Content-Length"])
+    if hasher and resume_from:
+        manifest.HashFile(temp_download_path, hasher)
+
+    with open(temp_download_path, "r+b" if resume_from else "wb", buffering=0) as f:
+        f.seek(resume_from)
+        _Preallocate(f, total)
+        file_progress = progress.StartFile(
+            item_id, download_path.name, total, resume_from, part, num_parts
         )
-        for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
-            if not chunk:
-                continue
-            progress.update(len(chunk))
-            f.write(chunk)
+        chunk_size = _DOWNLOAD_CHUNK_SIZE
+        if limiter:
+            chunk_size = limiter.ChunkSize(chunk_size)
+
+        def _OnChunk(chunk: memoryview):
+            if limiter:
+                limiter.Consume(len(chunk))
+            if hasher:
+                hasher.update(chunk)
+            file_progress.Update(len(chunk))
+            # Counted as it goes so that exported metrics show the progress.
+            instrument.Count("download.bytes", len(chunk))
+
+        body = _RawBody(response)
+        succeeded = False
+        try:
+            with instrument.Span("download.file"), instrument.Active("download.active"):
+                if body is not None:
+                    _CopyByReadInto(body, f, chunk_size, _OnChunk)
+                else:
+                    _CopyByIterContent(response, f, chunk_size, _OnChunk)
+            if f.tell() != total:
+                raise DownloadError(
+                    f"{download_path.name} ended at {f.tell():,} bytes, "
+                    f"expected {total:,}."
+                )
+            succeeded = True
+        finally:
+            # Reading the body under urllib3 does not return the connection to
+            # the pool. A fully read one can be kept alive for the next part,
+            # one with unread data cannot.
+            release_conn = getattr(response.raw, "release_conn", None)
+            if succeeded and release_conn:
+                release_conn()
+            else:
+                response.close()
+            # Drop the preallocated space that was not written.
+            f.truncate(f.tell())
+            file_progress.Finish(succeeded=succeeded)
 
     return temp_download_path.rename(download_path)
 
 
 class Downloader:
-    def __init__(self, session: requests.Session) -> None:
+    def __init__(
+        self,
+        session: requests.Session | session_pool.SessionPool,
+        limiter: Optional[rate_limit.ScheduledLimiter] = None,
+    ) -> None:
         self.session = session
+        self.limiter = limiter
 
-    def _Get(self, url: str) -> requests.Response:
+    def _Get(
+        self, url: str, headers: Optional[Dict[str, str]] = None
+    ) -> requests.Response:
         """Helper function for GETting a URL for downloading.
 
         This redirects and uses streaming.
 
+        Args:
+            url: URL to get.
+            headers: Additional request headers, e.g. Range.
+
         Raises:
             HttpUnauthorizedException is thrown on HTTP unauthorized.
 
@@ -95,14 +411,14 @@ class Downloader:
             response object.
         """
         logging.info(f"Getting {url}.")
-        response = self.session.get(
-            url,
-            allow_redirects=True,
-            stream=True,
-            headers={
-                "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36"
-            },
-        )
+        with instrument.Span("http.request"):
+            response = session_pool.SessionFor(self.session).get(
+                url,
+                allow_redirects=True,
+                stream=True,
+                headers={"User-Agent": _USER_AGENT, **(headers or {})},
+            )
+        session_pool.RecordResponse(response)
         logging.info(f"The downloaded url (after possible redirect) was {response.url}")
         logging.info(f"Response status was: {response.status_code}")
 
@@ -137,7 +453,8 @@ class Downloader:
         url = f"https://play.dlsite.com/api/download?workno={item_id}"
         # It always redirects. stream=True is necessary if it directly goes to
         # download.
-        response = self._Get(url)
+        with instrument.Span("download.resolve_urls"):
+            response = self._Get(url)
         response.raise_for_status()
 
         logging.info(f"Response status was: {response.status_code}")
@@ -151,24 +468,101 @@ class Downloader:
         )
         if "text/html" in content_type:
             # This is a webpage that contains the split files.
-            split_page = BeautifulSoup(response.text, "html.parser")
-            DIVISION_FILE_ID = "download_division_file"
-            div_file = split_page.find(id=DIVISION_FILE_ID)
-            if div_file is None:
-                raise DownloadError(f"Failed to find id={DIVISION_FILE_ID}")
-            if isinstance(div_file, NavigableString):
-                logging.debug(
-                    f"Found id={DIVISION_FILE_ID} but is a string: {div_file}"
-                )
-                raise DownloadError(f"Unexpected string: {div_file}")
-            split_parts = div_file.find_all(class_="work_download")
-
-            return [part.find("a").get("href") for part in split_parts]
+            with instrument.Span("download.parse_split_page"):
+                return _ParseSplitPage(response.text)
 
         return [response.url]
 
+    def _ResolveFile(self, url: str) -> RemoteFile:
+        """Gets the size and the name of the file at url.
+
+        Only the first byte is requested, so that the connection can be kept
+        for the next request. If the server ignores the range, the response is
+        closed without reading its body.
+
+        Raises:
+            HttpUnauthorizedException is thrown on HTTP unauthorized.
+
+            DownloadError is thrown if the size is not known.
+        """
+        response = self._Get(url, headers={"Range": "bytes=0-0"})
+        try:
+            response.raise_for_status()
+            size = None
+            if response.status_code == requests.codes.partial_content:
+                # E.g. "bytes 0-0/12345". The total may be "*" if unknown.
+                total = response.headers.get("content-range", "").rpartition("/")[2]
+                if total.isdigit():
+                    size = int(total)
+                # Read the byte so that the connection goes back to the pool.
+                response.content
+            elif (content_length := response.headers.get("content-length")) is not None:
+                size = int(content_length)
+            if size is None:
+                raise DownloadError(f"Unknown size of {response.url}")
+            file_name = _GetContentDispositionFilename(
+                response.headers.get("content-disposition", "")
+            )
+            return RemoteFile(url, size, file_name or None)
+        finally:
+            response.close()
+
+    def ResolveFiles(self, item_id: str) -> List[RemoteFile]:
+        """Returns the files to download for the item with their sizes.
+
+        The bodies of the files are not downloaded. Pass the result to
+        DownloadTo() so that the item is not resolved again.
+
+        Args:
+            item_id is the ID of the item. Also called work ID.
+
+        Raises:
+            HttpUnauthorizedException is thrown on HTTP unauthorized.
+
+            DownloadError is thrown if the size of a file is not known.
+        """
+        return [self._ResolveFile(url) for url in self.GetDownloadUrls(item_id)]
+
+    def _ResumeOrRestart(
+        self, url: str, response: requests.Response, download_path: pathlib.Path
+    ) -> Tuple[requests.Response, int]:
+        """Continues a download that was interrupted before, if possible.
+
+        Args:
+            url: URL that response was fetched from.
+            response: Response for the whole file.
+            download_path: Where the file will be placed.
+
+        Returns:
+            The response to read the rest of the file from and the number of
+            bytes that are already downloaded.
+        """
+        temp_download_path = _TempDownloadPath(download_path)
+        if not temp_download_path.exists():
+            return response, 0
+        if response.headers.get("accept-ranges") != "bytes":
+            logging.info(f"Server does not support resuming {download_path.name}.")
+            return response, 0
+
+        offset = temp_download_path.stat().st_size
+        if offset == 0 or offset >= int(response.headers["content-length"]):
+            return response, 0
+
+        response.close()
+        partial_response = self._Get(url, headers={"Range": f"bytes={offset}-"})
+        if partial_response.status_code != requests.codes.partial_content:
+            logging.info(f"Range request was ignored. Restarting {download_path.name}.")
+            return partial_response, 0
+
+        progress.Message(f"Resuming {download_path.name} from {offset:,} bytes.")
+        return partial_response, offset
+
     def DownloadTo(
-        self, item_id: str, dir: Union[str, pathlib.Path]
+        self,
+        item_id: str,
+        dir: Union[str, pathlib.Path],
+        on_part: Optional[Callable[[int, int], None]] = None,
+        files: Optional[List[RemoteFile]] = None,
     ) -> List[pathlib.Path]:
         """Downloads item to a directory.
 
@@ -177,12 +571,25 @@ class Downloader:
         The file names of the downloaded files would be the names specified
         by the server.
 
+        Files left over from an interrupted download are reused. Complete files
+        are not downloaded again and partial files are resumed if the server
+        supports range requests.
+
+        The files are hashed while downloading and recorded in a manifest next
+        to them, see manifest.ArchiveManifestPath().
+
         Args:
             item_id: The ID of the item. Also called work ID. Or this could be the
             store URL of the item.
 
             dir: where the downoloaded items will be placed.
 
+            on_part: Called with the 1-based index of the file and the number
+            of files before each file is downloaded.
+
+            files: The files of the item from ResolveFiles(), if it is already
+            resolved. Complete files are then skipped without a request.
+
         Raises:
             HttpUnauthorizedException is thrown on HTTP unauthorized.
 
@@ -195,27 +602,88 @@ class Downloader:
         logging.debug(f"Processing item: {item_id}")
         downloaded_item_paths = []
 
-        urls = self.GetDownloadUrls(item_id)
+        if files is None:
+            files = [RemoteFile(url) for url in self.GetDownloadUrls(item_id)]
+        num_parts = len(files)
+        progress.Emit(progress.ITEM_STARTED, item_id=item_id, num_parts=num_parts)
         dir_path = pathlib.Path(dir)
-        for index, url in enumerate(urls):
-            response = self._Get(url)
-            disposition = response.headers["content-disposition"]
-            file_name = _GetContentDispositionFilename(disposition)
-            if not file_name:
-                file_name = f"{item_id}.part{index + 1}"
-                logging.debug(
-                    f"Could not find file name from the server. "
-                    f"Naming it {file_name}"
+        manifest_path = manifest.ArchiveManifestPath(dir_path, item_id)
+        item_manifest = manifest.Manifest.Load(manifest_path) or manifest.Manifest(
+            item_id
+        )
+        for index, remote in enumerate(files):
+            if on_part:
+                on_part(index + 1, num_parts)
+            response = None
+            file_name = remote.file_name
+            content_length = remote.size
+            if not (
+                file_name
+                and content_length is not None
+                and _IsDownloaded(dir_path / file_name, content_length)
+            ):
+                response = self._Get(remote.url)
+                disposition = response.headers["content-disposition"]
+                file_name = _GetContentDispositionFilename(disposition)
+                if not file_name:
+                    file_name = f"{item_id}.part{index + 1}"
+                    logging.debug(
+                        f"Could not find file name from the server. "
+                        f"Naming it {file_name}"
+                    )
+                content_length = int(response.headers["content-length"])
+
+            download_path = dir_path / file_name
+            if _IsDownloaded(download_path, content_length):
+                progress.Emit(
+                    progress.FILE_DONE,
+                    item_id=item_id,
+                    file_name=file_name,
+                    done=content_length,
+                    total=content_length,
+                    part=index + 1,
+                    num_parts=num_parts,
+                    message=f"{file_name} is already downloaded.",
                 )
+                if response is not None:
+                    response.close()
+                downloaded_item_paths.append(download_path)
+                entry = item_manifest.Get(file_name)
+                if not entry or entry.size != content_length:
+                    item_manifest.Set(
+                        manifest.FileEntry(
+                            file_name, content_length, manifest.HashFile(download_path)
+                        )
+                    )
+                    item_manifest.Save(manifest_path)
+                continue
 
-            print(
-                f"Downloading {file_name}: "
-                f'{int(response.headers["content-length"]):,} bytes.'
+            progress.Message(
+                f"Downloading {file_name}: {content_length:,} bytes.", item_id
             )
 
+            response, resume_from = self._ResumeOrRestart(
+                remote.url, response, download_path
+            )
+            hasher = manifest.NewHasher()
             downloaded_item_paths.append(
-                _DownloadWithProgress(response, dir_path / file_name)
+                _DownloadWithProgress(
+                    response,
+                    download_path,
+                    resume_from,
+                    self.limiter,
+                    hasher,
+                    item_id,
+                    index + 1,
+                    num_parts,
+                )
             )
+            item_manifest.Set(
+                manifest.FileEntry(file_name, content_length, hasher.hexdigest())
+            )
+            item_manifest.Save(manifest_path)
 
-        print(f"{item_id} download complete.")
+        progress.Emit(
+            progress.ITEM_DONE, item_id=item_id, message=f"{item_id} download complete."
+        )
         return downloaded_item_paths
@@ -1,7 +1,11 @@
+import hashlib
+import io
+import pathlib
 import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
 import downloader
+import manifest
 
 
 class DownloaderTest(unittest.TestCase):
@@ -60,6 +64,75 @@ class DownloaderTest(unittest.TestCase):
             dl.GetDownloadUrls("RJ123"),
         )
 
+    def testParseSplitPage(self):
+        page = """
+            <html><head><meta charset="utf-8"><title>DL</title></head>
+            <body>
+              <div class="work_download"><a href="https://other/ad">ad</a></div>
+              <div id="download_division_file">
+                <p>Files<br>for this work</p>
+                <div class="work_download">
+                  <img src="icon.png"><span>part 1</span>
+                  <a href="https://download.url/get?file=1&amp;n=2">file1</a>
+                  <a href="https://download.url/ignored">mirror</a>
+                </div>
+                <div class="work_download item">
+                  <div><input type="hidden" value="x"/></div>
+                  <a href="https://download.url/file2.rar">file2</a>
+                </div>
+              </div>
+              <div class="work_download"><a href="https://other/after">x</a></div>
+              <p>Unclosed <b>markup
+        """
+        expected = [
+            "https://download.url/get?file=1&n=2",
+            "https://download.url/file2.rar",
+        ]
+        self.assertEqual(downloader._ParseSplitPageFast(page), expected)
+        self.assertEqual(downloader._ParseSplitPageWithSoup(page), expected)
+
+        # Stray end tags do not end the part or the division early, and
+        # unclosed elements end with the element they are in.
+        page = """
+            <div id="download_division_file">
+              <div class="work_download"><a href="u1">1</a></span></div>
+              <div class="work_download"><p><a href="u2">2</a></div>
+              <div class="work_download"><a href="u3">3</a></b></div>
+            </div>
+            <div class="work_download"><a href="after">x</a></div>
+        """
+        expected = ["u1", "u2", "u3"]
+        self.assertEqual(downloader._ParseSplitPageFast(page), expected)
+        self.assertEqual(downloader._ParseSplitPageWithSoup(page), expected)
+
+        # A part without a link is left to the full parse instead of the
+        # other parts being returned as if they were all.
+        page = """
+            <div id="download_division_file">
+              <div class="work_download"><a href="u1">1</a></div>
+              <div class="work_download"><span>soon</span></div>
+              <div class="work_download"><a href="u3">3</a></div>
+            </div>
+        """
+        self.assertIsNone(downloader._ParseSplitPageFast(page))
+        with patch("downloader._ParseSplitPageWithSoup") as soup_mock:
+            downloader._ParseSplitPage(page)
+        soup_mock.assert_called_once_with(page)
+
+    @patch("downloader._ParseSplitPageWithSoup")
+    def testParseSplitPageFallsBackToFullParse(self, soup_mock):
+        soup_mock.return_value = ["https://download.url/file1.rar"]
+        page = '<div id="download_division_file"><p>No links here.</p></div>'
+
+        self.assertEqual(
+            downloader._ParseSplitPage(page), ["https://download.url/file1.rar"]
+        )
+        soup_mock.assert_called_once_with(page)
+
+    def testParseSplitPageWithoutDivision(self):
+        with self.assertRaises(downloader.DownloadError):
+            downloader._ParseSplitPage("<html><p>Maintenance</p></html>")
+
     def testGetContentDispositionFilename(self):
         self.assertEqual(
             "something.jpg",
@@ -106,3 +179,269 @@ class DownloaderTest(unittest.TestCase):
         # Assert that an exception is raised when GetDownloadUrls is called
         with self.assertRaises(Exception):
             dl.GetDownloadUrls("RJ30123")
+
+    @patch("downloader.Downloader._Get")
+    @patch("downloader.Downloader.GetDownloadUrls")
+    def testDownloadToSkipsCompleteFile(self, get_download_urls_mock, get_mock):
+        get_download_urls_mock.return_value = ["https://download.url/1.zip"]
+        response_mock = MagicMock()
+        response_mock.headers = {
+            "content-length": 5,
+            "content-disposition": 'inline; filename="RJ30123.zip"',
+        }
+        get_mock.return_value = response_mock
+        dl = downloader.Downloader(MagicMock())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            existing = pathlib.Path(tmpdir) / "RJ30123.zip"
+            existing.write_bytes(b"12345")
+            self.assertEqual([existing], dl.DownloadTo("RJ30123", tmpdir))
+
+        response_mock.iter_content.assert_not_called()
+
+    @patch("downloader.Downloader._Get")
+    @patch("downloader.Downloader.GetDownloadUrls")
+    def testResolveFiles(self, get_download_urls_mock, get_mock):
+        get_download_urls_mock.return_value = [
+            "https://download.url/1.rar",
+            "https://download.url/2.rar",
+        ]
+        first, second = MagicMock(), MagicMock()
+        first.status_code = 206
+        first.headers = {
+            "content-length": "1",
+            "content-range": "bytes 0-0/100",
+            "content-disposition": 'attachment; filename="RJ30123.part1.rar"',
+        }
+        # The range is ignored.
+        second.status_code = 200
+        second.headers = {"content-length": "23"}
+        get_mock.side_effect = [first, second]
+        dl = downloader.Downloader(MagicMock())
+
+        self.assertEqual(
+            dl.ResolveFiles("RJ30123"),
+            [
+                downloader.RemoteFile(
+                    "https://download.url/1.rar", 100, "RJ30123.part1.rar"
+                ),
+                downloader.RemoteFile("https://download.url/2.rar", 23, None),
+            ],
+        )
+        get_mock.assert_called_with(
+            "https://download.url/2.rar", headers={"Range": "bytes=0-0"}
+        )
+        first.close.assert_called_once()
+        second.close.assert_called_once()
+        second.iter_content.assert_not_called()
+
+    @patch("downloader.Downloader._Get")
+    @patch("downloader.Downloader.GetDownloadUrls")
+    def testResolveFilesWithoutSize(self, get_download_urls_mock, get_mock):
+        get_download_urls_mock.return_value = ["https://download.url/1.zip"]
+        response_mock = MagicMock()
+        response_mock.status_code = 206
+        response_mock.headers = {"content-range": "bytes 0-0/*"}
+        get_mock.return_value = response_mock
+        dl = downloader.Downloader(MagicMock())
+        with self.assertRaises(downloader.DownloadError):
+            dl.ResolveFiles("RJ30123")
+
+    @patch("downloader.Downloader._Get")
+    @patch("downloader.Downloader.GetDownloadUrls")
+    def testDownloadToSkipsResolvedCompleteFile(self, get_download_urls_mock, get_mock):
+        dl = downloader.Downloader(MagicMock())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            existing = pathlib.Path(tmpdir) / "RJ30123.zip"
+            existing.write_bytes(b"12345")
+            files = [
+                downloader.RemoteFile("https://download.url/1.zip", 5, existing.name)
+            ]
+            self.assertEqual([existing], dl.DownloadTo("RJ30123", tmpdir, files=files))
+
+        get_download_urls_mock.assert_not_called()
+        get_mock.assert_not_called()
+
+    @patch("downloader.Downloader._Get")
+    @patch("downloader.Downloader.GetDownloadUrls")
+    def testDownloadToResumesPartialFile(self, get_download_urls_mock, get_mock):
+        get_download_urls_mock.return_value = ["https://download.url/1.zip"]
+        full_response = MagicMock()
+        full_response.headers = {
+            "content-length": 10,
+            "accept-ranges": "bytes",
+            "content-disposition": 'inline; filename="RJ30123.zip"',
+        }
+        partial_response = MagicMock()
+        partial_response.status_code = 206
+        partial_response.headers = {"Content-Length": 6}
+        partial_response.iter_content.return_value = [b"567890"]
+        get_mock.side_effect = [full_response, partial_response]
+        on_part = MagicMock()
+
+        dl = downloader.Downloader(MagicMock())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            (pathlib.Path(tmpdir) / "RJ30123.downloading").write_bytes(b"1234")
+            paths = dl.DownloadTo("RJ30123", tmpdir, on_part=on_part)
+            self.assertEqual(paths[0].read_bytes(), b"1234567890")
+
+        get_mock.assert_called_with(
+            "https://download.url/1.zip", headers={"Range": "bytes=4-"}
+        )
+        on_part.assert_called_once_with(1, 1)
+
+    @patch("downloader.Downloader._Get")
+    @patch("downloader.Downloader.GetDownloadUrls")
+    def testDownloadToResumesAfterKillWithPreallocatedFile(
+        self, get_download_urls_mock, get_mock
+    ):
+        get_download_urls_mock.return_value = ["https://download.url/1.zip"]
+        full_response = MagicMock()
+        full_response.headers = {
+            "content-length": 10,
+            "accept-ranges": "bytes",
+            "content-disposition": 'inline; filename="RJ30123.zip"',
+        }
+        partial_response = MagicMock()
+        partial_response.status_code = 206
+        partial_response.headers = {"Content-Length": 6}
+        partial_response.iter_content.return_value = [b"567890"]
+        get_mock.side_effect = [full_response, partial_response]
+
+        dl = downloader.Downloader(MagicMock())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Killed after writing 4 bytes, without truncating the file.
+            with open(pathlib.Path(tmpdir) / "RJ30123.downloading", "wb") as f:
+                downloader._Preallocate(f, 10)
+                f.write(b"1234")
+
+            paths = dl.DownloadTo("RJ30123", tmpdir)
+            self.assertEqual(paths[0].read_bytes(), b"1234567890")
+
+        get_mock.assert_called_with(
+            "https://download.url/1.zip", headers={"Range": "bytes=4-"}
+        )
+
+    @patch("downloader.Downloader._Get")
+    @patch("downloader.Downloader.GetDownloadUrls")
+    def testDownloadToRestartsWithoutRangeSupport(
+        self, get_download_urls_mock, get_mock
+    ):
+        get_download_urls_mock.return_value = ["https://download.url/1.zip"]
+        response_mock = MagicMock()
+        response_mock.headers = {
+            "content-length": 3,
+            "Content-Length": 3,
+            "content-disposition": 'inline; filename="RJ30123.zip"',
+        }
+        response_mock.iter_content.return_value = [b"abc"]
+        get_mock.return_value = response_mock
+
+        dl = downloader.Downloader(MagicMock())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            (pathlib.Path(tmpdir) / "RJ30123.downloading").write_bytes(b"xy")
+            paths = dl.DownloadTo("RJ30123", tmpdir)
+            self.assertEqual(paths[0].read_bytes(), b"abc")
+
+        get_mock.assert_called_once()
+
+    def testDownloadWithProgressConsumesLimiter(self):
+        response = MagicMock()
+        response.headers = {"Content-Length": 5}
+        response.iter_content.return_value = [b"ab", b"", b"cde"]
+        limiter = MagicMock()
+        limiter.ChunkSize.return_value = 1024
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = downloader._DownloadWithProgress(
+                response, pathlib.Path(tmpdir) / "RJ1.zip", limiter=limiter
+            )
+            self.assertEqual(path.read_bytes(), b"abcde")
+
+        response.iter_content.assert_called_once_with(chunk_size=1024)
+        self.assertEqual([c.args for c in limiter.Consume.call_args_list], [(2,), (3,)])
+
+    def testDownloadWithProgressReadsIntoBuffer(self):
+        response = MagicMock()
+        response.headers = {"Content-Length": 10}
+        response.raw = io.BytesIO(b"0123456789")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch("downloader._DOWNLOAD_CHUNK_SIZE", 3):
+                path = downloader._DownloadWithProgress(
+                    response, pathlib.Path(tmpdir) / "RJ1.zip"
+                )
+            self.assertEqual(path.read_bytes(), b"0123456789")
+        response.iter_content.assert_not_called()
+
+    def testDownloadWithProgressReleasesConnection(self):
+        class PooledRaw(io.BytesIO):
+            def __init__(self, content: bytes):
+                super().__init__(content)
+                self.release_conn = MagicMock()
+
+        response = MagicMock()
+        response.headers = {"Content-Length": 3}
+        response.raw = PooledRaw(b"abc")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            downloader._DownloadWithProgress(response, pathlib.Path(tmpdir) / "1.zip")
+        response.raw.release_conn.assert_called_once()
+        response.close.assert_not_called()
+
+        # A connection with unread data cannot be reused.
+        response = MagicMock()
+        response.headers = {"Content-Length": 4}
+        response.raw = PooledRaw(b"abc")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaises(downloader.DownloadError):
+                downloader._DownloadWithProgress(
+                    response, pathlib.Path(tmpdir) / "2.zip"
+                )
+        response.raw.release_conn.assert_not_called()
+        response.close.assert_called_once()
+
+    def testDownloadWithProgressKeepsOnlyWrittenBytesOnFailure(self):
+        class FailingRaw(io.RawIOBase):
+            def __init__(self):
+                self.reads = 0
+
+            def readinto(self, buffer):
+                self.reads += 1
+                if self.reads > 1:
+                    raise ConnectionError()
+                buffer[:4] = b"abcd"
+                return 4
+
+        response = MagicMock()
+        response.headers = {"Content-Length": 100}
+        response.raw = FailingRaw()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            download_path = pathlib.Path(tmpdir) / "RJ1.zip"
+            with self.assertRaises(ConnectionError):
+                downloader._DownloadWithProgress(response, download_path)
+            temp_path = downloader._TempDownloadPath(download_path)
+            self.assertEqual(temp_path.read_bytes(), b"abcd")
+
+    @patch("downloader.Downloader._Get")
+    @patch("downloader.Downloader.GetDownloadUrls")
+    def testDownloadToRecordsManifest(self, get_download_urls_mock, get_mock):
+        get_download_urls_mock.return_value = ["https://download.url/1.zip"]
+        response_mock = MagicMock()
+        response_mock.headers = {
+            "content-length": 3,
+            "Content-Length": 3,
+            "content-disposition": 'inline; filename="RJ30123.zip"',
+        }
+        response_mock.iter_content.return_value = [b"abc"]
+        get_mock.return_value = response_mock
+
+        dl = downloader.Downloader(MagicMock())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dl.DownloadTo("RJ30123", tmpdir)
+            item_manifest = manifest.Manifest.Load(
+                manifest.ArchiveManifestPath(pathlib.Path(tmpdir), "RJ30123")
+            )
+        self.assertEqual(
+            item_manifest.files,
+            [manifest.FileEntry("RJ30123.zip", 3, hashlib.sha256(b"abc").hexdigest())],
+        )
@@ -0,0 +1,715 @@
+"""A local stand-in for the DLsite servers.
+
+Serves the parts of the DLsite sites that this tool uses from a local HTTP
+server, so that the network code can be tested end to end and benchmarked
+without an account or a connection:
+
+- Login with an XSRF token (login.dlsite.com), mypage and play.dlsite.com.
+- Purchase count and paginated purchases.
+- Download redirects, split archive pages and file downloads with Range.
+- Work info used to name extracted directories.
+- Mylists.
+
+Latency, bandwidth, expired sessions and server errors can be injected.
+
+Clients keep using the real https URLs. While Install() is active, requests
+and urllib send requests for dlsite.com hosts to the local server instead,
+with the original host in the Host header.
+
+    with fake_dlsite.FakeDlsite() as fake:
+        fake.AddUser("user", "password")
+        fake.AddWork("RJ01000001", [10 * 1024**2], name="Some work")
+        session = login.Login("user", "password")
+"""
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from email.utils import formatdate
+import hashlib
+import html
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import re
+import secrets
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+import urllib.parse
+import urllib.request
+
+from requests.adapters import HTTPAdapter
+
+import find_id
+
+_DLSITE_DOMAIN = "dlsite.com"
+
+_SESSION_COOKIE = "PHPSESSID"
+_XSRF_TOKEN_COOKIE = "XSRF-TOKEN"
+
+# Laravel returns this when the XSRF token is stale.
+_HTTP_STATUS_PAGE_EXPIRED = 419
+
+# Generated file content repeats with this period.
+_PATTERN_SIZE = 64 * 1024
+
+_WRITE_CHUNK_SIZE = 64 * 1024
+
+# Seconds that Stop() may wait for the server loop to notice.
+_SHUTDOWN_POLL_INTERVAL = 0.05
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+# www.dlsite.com/<site>/product/info/ajax
+_PRODUCT_INFO_PATTERN = re.compile(r"/([a-z]+)/product/info/ajax")
+
+
+def _IsDlsiteHost(host: Optional[str]) -> bool:
+    return bool(host) and (
+        host == _DLSITE_DOMAIN or host.endswith("." + _DLSITE_DOMAIN)
+    )
+
+
+def _Pattern(seed: str) -> bytes:
+    digests = (
+        hashlib.sha256(f"{seed}/{i}".encode()).digest()
+        for i in range(_PATTERN_SIZE // hashlib.sha256().digest_size)
+    )
+    return b"".join(digests)
+
+
+@dataclass
+class WorkFile:
+    name: str
+    size: int
+    # If None, the content is generated from the name.
+    data: Optional[bytes] = None
+
+    def __post_init__(self):
+        if self.data is None:
+            self._pattern = memoryview(_Pattern(self.name) * 2)
+
+    def Chunks(self, start: int, end: int) -> Iterator[memoryview]:
+        """Yields the content in [start, end) without building all of it."""
+        if self.data is not None:
+            view = memoryview(self.data)
+            for offset in range(start, end, _WRITE_CHUNK_SIZE):
+                yield view[offset : min(end, offset + _WRITE_CHUNK_SIZE)]
+            return
+        offset = start
+        while offset < end:
+            begin = offset % _PATTERN_SIZE
+            length = min(end - offset, _PATTERN_SIZE)
+            yield self._pattern[begin : begin + length]
+            offset += length
+
+    def Content(self) -> bytes:
+        return b"".join(self.Chunks(0, self.size))
+
+
+@dataclass
+class Work:
+    item_id: str
+    name: str
+    files: List[WorkFile]
+    # Entry returned by the purchases API.
+    purchase: Dict
+
+
+@dataclass
+class _MyList:
+    id: int
+    name: str
+    insert_date: str
+    item_ids: List[str] = field(default_factory=list)
+
+
+@dataclass
+class RequestRecord:
+    method: str
+    host: str
+    path: str
+    headers: Dict[str, str]
+    status: int = 0
+
+
+@dataclass
+class _Failure:
+    status: int
+    count: int
+    path_prefix: str
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class FakeDlsite:
+    """The fake server and its state.
+
+    Attributes can be changed while the server is running:
+        latency: Seconds to wait before answering each request.
+        bandwidth: Bytes per second for each response body. None for
+            unlimited.
+        range_support: Whether file downloads honor Range requests.
+        page_limit: Purchases per page.
+        concurrency: Parallel requests the purchase count suggests.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        bandwidth: Optional[int] = None,
+        range_support: bool = True,
+        page_limit: int = 50,
+        concurrency: int = 3,
+    ) -> None:
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.range_support = range_support
+        self.page_limit = page_limit
+        self.concurrency = concurrency
+
+        self._lock = threading.Lock()
+        self._users: Dict[str, str] = {}
+        self._sessions: Dict[str, str] = {}
+        self._xsrf_tokens = set()
+        self._works: Dict[str, Work] = {}
+        self._mylists: List[_MyList] = []
+        self._next_mylist_id = 1
+        self._failures: List[_Failure] = []
+        self._requests: List[RequestRecord] = []
+        self._server: Optional[_Server] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "FakeDlsite":
+        self.Start()
+        self._install = self.Install()
+        self._install.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self._install.__exit__(*args)
+        self.Stop()
+
+    def Start(self):
+        self._server = _Server(("127.0.0.1", 0), self._MakeHandler())
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={"poll_interval": _SHUTDOWN_POLL_INTERVAL},
+            daemon=True,
+        )
+        self._thread.start()
+
+    def Stop(self):
+        if not self._server:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
+    @property
+    def address(self) -> str:
+        """host:port of the local server."""
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    @contextmanager
+    def Install(self):
+        """Sends requests for dlsite.com to this server while active.
+
+        Applies to every requests adapter and to urllib.request.urlopen(). Only
+        one fake can be installed at a time.
+        """
+        address = self.address
+        original_send = HTTPAdapter.send
+
+        def _Send(adapter, request, *args, **kwargs):
+            parts = urllib.parse.urlsplit(request.url)
+            if not _IsDlsiteHost(parts.hostname):
+                return original_send(adapter, request, *args, **kwargs)
+            local_request = request.copy()
+            local_request.url = urllib.parse.urlunsplit(
+                ("http", address, parts.path, parts.query, "")
+            )
+            local_request.headers["Host"] = parts.hostname
+            response = original_send(adapter, local_request, *args, **kwargs)
+            # Cookies and redirects are resolved against the real URL.
+            response.url = request.url
+            response.request = request
+            return response
+
+        HTTPAdapter.send = _Send
+        urllib.request.install_opener(
+            urllib.request.build_opener(_UrllibRedirectHandler(address))
+        )
+        try:
+            yield
+        finally:
+            HTTPAdapter.send = original_send
+            urllib.request.install_opener(None)
+
+    def AddUser(self, login_id: str, password: str):
+        with self._lock:
+            self._users[login_id] = password
+
+    def AddWork(
+        self,
+        item_id: str,
+        files: List[Union[int, bytes]],
+        name: str = "",
+        **purchase_fields,
+    ) -> Work:
+        """Adds a purchased work.
+
+        Args:
+            item_id: e.g. RJ01000001.
+            files: Size or content of each file. More than one file makes it a
+                split archive. Content is generated for sizes.
+            name: Name of the work.
+            purchase_fields: Added to the entry in the purchases API, e.g.
+                work_type="SOU".
+        """
+        if len(files) == 1:
+            names = [f"{item_id}.zip"]
+        else:
+            names = [f"{item_id}.part{i + 1}.rar" for i in range(len(files))]
+        work_files = [
+            WorkFile(n, f, None) if isinstance(f, int) else WorkFile(n, len(f), f)
+            for n, f in zip(names, files)
+        ]
+        name = name or f"Work {item_id}"
+        purchase = {
+            "workno": item_id,
+            "name": {"ja_JP": name},
+            "work_type": "SOU",
+            "age_category": "all",
+            "file_size": sum(f.size for f in work_files),
+            "sales_date": "2024-01-01T00:00:00.000000Z",
+            **purchase_fields,
+        }
+        work = Work(item_id, name, work_files, purchase)
+        with self._lock:
+            self._works[item_id] = work
+        return work
+
+    def ExpireSessions(self):
+        """Logs out everyone. Requests with old cookies get 401 from now on."""
+        with self._lock:
+            self._sessions.clear()
+
+    def FailNext(self, status: int, count: int = 1, path_prefix: str = "/"):
+        """Answers the next count requests under path_prefix with status."""
+        with self._lock:
+            self._failures.append(_Failure(status, count, path_prefix))
+
+    def Requests(self, path_prefix: str = "/") -> List[RequestRecord]:
+        """Returns the requests received so far, oldest first."""
+        with self._lock:
+            return [r for r in self._requests if r.path.startswith(path_prefix)]
+
+    def MyListItems(self) -> Dict[str, List[str]]:
+        """Returns the item IDs in each mylist, keyed by list name."""
+        with self._lock:
+            return {m.name: list(m.item_ids) for m in self._mylists}
+
+    def _TakeFailure(self, path: str) -> Optional[int]:
+        with self._lock:
+            for failure in self._failures:
+                if failure.count and path.startswith(failure.path_prefix):
+                    failure.count -= 1
+                    return failure.status
+        return None
+
+    def _MakeHandler(self):
+        return type("Handler", (_Handler,), {"fake": self})
+
+
+class _UrllibRedirectHandler(urllib.request.BaseHandler):
+    # Runs before the HTTPS handler prepares the request.
+    handler_order = 100
+
+    def __init__(self, address: str) -> None:
+        self._address = address
+
+    def https_request(self, request: urllib.request.Request):
+        host = request.host
+        if _IsDlsiteHost(host):
+            request.full_url = f"http://{self._address}{request.selector}"
+            request.add_unredirected_header("Host", host)
+        return request
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake: FakeDlsite
+
+    def log_message(self, format, *args):
+        logging.debug(f"fake_dlsite: {format % args}")
+
+    def do_GET(self):
+        self._Handle("GET")
+
+    def do_POST(self):
+        self._Handle("POST")
+
+    def _Handle(self, method: str):
+        fake = self.fake
+        host = self.headers.get("Host", "").split(":")[0]
+        parsed = urllib.parse.urlsplit(self.path)
+        self._query = urllib.parse.parse_qs(parsed.query)
+        self._form = {}
+        if method == "POST":
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self._form = urllib.parse.parse_qs(body.decode())
+        self._cookies = SimpleCookie(self.headers.get("Cookie", ""))
+        self._record = RequestRecord(method, host, parsed.path, dict(self.headers))
+        with fake._lock:
+            fake._requests.append(self._record)
+
+        if fake.latency:
+            time.sleep(fake.latency)
+        status = fake._TakeFailure(parsed.path)
+        if status:
+            self._Send(status, b"")
+            return
+
+        routes: Dict[Tuple[str, str, str], Callable[[], None]] = {
+            ("login.dlsite.com", "GET", "/login"): self._LoginPage,
+            ("login.dlsite.com", "POST", "/login"): self._Login,
+            ("ssl.dlsite.com", "GET", "/home/mypage"): self._Mypage,
+            ("play.dlsite.com", "GET", "/"): self._Play,
+            ("play.dlsite.com", "GET", "/api/product_count"): self._ProductCount,
+            ("play.dlsite.com", "GET", "/api/purchases"): self._Purchases,
+            ("play.dlsite.com", "GET", "/api/download"): self._Download,
+            ("play.dlsite.com", "GET", "/api/mylist/mylists"): self._MyLists,
+            (
+                "play.dlsite.com",
+                "POST",
+                "/api/mylist/update_mylist",
+            ): self._UpdateMyList,
+            (
+                "play.dlsite.com",
+                "POST",
+                "/api/mylist/update_mylist_work",
+            ): self._UpdateMyListWork,
+        }
+        handler = routes.get((host, method, parsed.path))
+        site_match = _PRODUCT_INFO_PATTERN.fullmatch(parsed.path)
+        if host == "www.dlsite.com" and method == "GET" and site_match:
+            self._ProductInfo(site_match[1])
+        elif handler:
+            handler()
+        elif host == "download.dlsite.com" and method == "GET":
+            self._File(parsed.path)
+        else:
+            self._Send(HTTPStatus.NOT_FOUND, b"")
+
+    def _Arg(self, args: Dict[str, List[str]], name: str) -> Optional[str]:
+        values = args.get(name)
+        return values[0] if values else None
+
+    def _Send(
+        self,
+        status: int,
+        body: bytes,
+        content_type: str = "text/html; charset=utf-8",
+        headers: Optional[Dict[str, str]] = None,
+        cookies: Optional[List[str]] = None,
+    ):
+        self._record.status = status
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        for cookie in cookies or []:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        self._Write([memoryview(body)])
+
+    def _SendJson(self, content, cookies: Optional[List[str]] = None):
+        body = json.dumps(content).encode()
+        self._Send(HTTPStatus.OK, body, "application/json", cookies=cookies)
+
+    def _Redirect(self, location: str, cookies: Optional[List[str]] = None):
+        self._Send(
+            HTTPStatus.FOUND, b"", headers={"Location": location}, cookies=cookies
+        )
+
+    def _Write(self, chunks):
+        """Writes the body, at most at the bandwidth of the fake."""
+        start = time.perf_counter()
+        sent = 0
+        try:
+            for chunk in chunks:
+                sent += len(chunk)
+                bandwidth = self.fake.bandwidth
+                if bandwidth:
+                    delay = start + sent / bandwidth - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client may close a download after reading the headers.
+            self.close_connection = True
+
+    def _LoggedIn(self) -> bool:
+        morsel = self._cookies.get(_SESSION_COOKIE)
+        with self.fake._lock:
+            return morsel is not None and morsel.value in self.fake._sessions
+
+    def _RequireLogin(self) -> bool:
+        if self._LoggedIn():
+            return True
+        self._Send(HTTPStatus.UNAUTHORIZED, b"")
+        return False
+
+    def _LoginPage(self):
+        token = secrets.token_urlsafe(16)
+        with self.fake._lock:
+            self.fake._xsrf_tokens.add(token)
+        # No Domain, so that it is only sent back to login.dlsite.com.
+        self._Send(
+            HTTPStatus.OK,
+            b"<html><form method='post'></form></html>",
+            cookies=[f"{_XSRF_TOKEN_COOKIE}={token}; Path=/; Secure"],
+        )
+
+    def _Login(self):
+        fake = self.fake
+        token = self._Arg(self._form, "_token")
+        login_id = self._Arg(self._form, "login_id")
+        password = self._Arg(self._form, "password")
+        with fake._lock:
+            valid_token = token in fake._xsrf_tokens
+            valid_user = login_id in fake._users and fake._users[login_id] == password
+            if valid_user:
+                session_id = secrets.token_urlsafe(16)
+                fake._sessions[session_id] = login_id
+        if not valid_token:
+            self._Send(_HTTP_STATUS_PAGE_EXPIRED, b"")
+            return
+        if not valid_user:
+            self._Send(HTTPStatus.UNAUTHORIZED, b"")
+            return
+        self._Redirect(
+            "https://ssl.dlsite.com/home/mypage",
+            cookies=[
+                f"{_SESSION_COOKIE}={session_id}; Domain=.{_DLSITE_DOMAIN}; Path=/"
+            ],
+        )
+
+    def _Mypage(self):
+        if self._RequireLogin():
+            self._Send(HTTPStatus.OK, b"<html>mypage</html>")
+
+    def _Play(self):
+        self._Send(
+            HTTPStatus.OK,
+            b"<html>play</html>",
+            cookies=["play_session=1; Domain=play.dlsite.com; Path=/"],
+        )
+
+    def _Purchases(self):
+        if not self._RequireLogin():
+            return
+        page = int(self._Arg(self._query, "page") or 1)
+        limit = self.fake.page_limit
+        with self.fake._lock:
+            purchases = [w.purchase for w in self.fake._works.values()]
+        offset = (page - 1) * limit
+        if page < 1 or (offset >= len(purchases) and page != 1):
+            self._Send(HTTPStatus.NOT_FOUND, b"")
+            return
+        self._SendJson(
+            {
+                "last": "1970-01-01T00:00:00.000000Z",
+                "limit": limit,
+                "offset": offset,
+                "total": len(purchases),
+                "works": purchases[offset : offset + limit],
+            }
+        )
+
+    def _ProductCount(self):
+        if not self._RequireLogin():
+            return
+        with self.fake._lock:
+            num_works = len(self.fake._works)
+        self._SendJson(
+            {
+                "user": num_works,
+                "production": 0,
+                "page_limit": self.fake.page_limit,
+                "concurrency": self.fake.concurrency,
+            }
+        )
+
+    def _FindWork(self, item_id: Optional[str]) -> Optional[Work]:
+        with self.fake._lock:
+            return self.fake._works.get(item_id or "")
+
+    def _Download(self):
+        if not self._RequireLogin():
+            return
+        item_id = self._Arg(self._query, "workno")
+        work = self._FindWork(item_id)
+        if not work:
+            self._Send(HTTPStatus.NOT_FOUND, b"")
+            return
+        urls = [
+            f"https://download.{_DLSITE_DOMAIN}/get/{item_id}/{i + 1}"
+            for i in range(len(work.files))
+        ]
+        if len(urls) == 1:
+            self._Redirect(urls[0])
+            return
+        parts = "".join(
+            f'<div class="work_download"><a href="{html.escape(url)}">'
+            f"{html.escape(f.name)}</a></div>"
+            for url, f in zip(urls, work.files)
+        )
+        body = f'<html><div id="download_division_file">{parts}</div></html>'
+        self._Send(HTTPStatus.OK, body.encode())
+
+    def _File(self, path: str):
+        if not self._RequireLogin():
+            return
+        match = re.fullmatch(r"/get/([^/]+)/(\d+)", path)
+        work = self._FindWork(match.group(1)) if match else None
+        index = int(match.group(2)) - 1 if match else -1
+        if not work or not 0 <= index < len(work.files):
+            self._Send(HTTPStatus.NOT_FOUND, b"")
+            return
+
+        work_file = work.files[index]
+        start, end = 0, work_file.size
+        status = HTTPStatus.OK
+        headers = {
+            "Content-Disposition": f'attachment; filename="{work_file.name}"',
+            "Last-Modified": formatdate(usegmt=True),
+        }
+        if self.fake.range_support:
+            headers["Accept-Ranges"] = "bytes"
+            range_match = _RANGE_PATTERN.match(self.headers.get("Range", ""))
+            if range_match:
+                start = int(range_match.group(1))
+                if range_match.group(2):
+                    end = min(end, int(range_match.group(2)) + 1)
+                if start >= end:
+                    self._Send(
+                        HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                        b"",
+                        headers={"Content-Range": f"bytes */{work_file.size}"},
+                    )
+                    return
+                status = HTTPStatus.PARTIAL_CONTENT
+                headers["Content-Range"] = f"bytes {start}-{end - 1}/{work_file.size}"
+
+        self._record.status = status
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self._Write(work_file.Chunks(start, end))
+
+    def _ProductInfo(self, site: str):
+        item_id = self._Arg(self._query, "product_id")
+        work = self._FindWork(item_id)
+        # Works are only on the site of their category.
+        if not work or find_id.SiteOf(item_id) != site:
+            self._Send(HTTPStatus.NOT_FOUND, b"")
+            return
+        self._SendJson({item_id: {"work_name": work.name}})
+
+    def _MyLists(self):
+        if not self._RequireLogin():
+            return
+        mylists = []
+        mylist_works = []
+        with self.fake._lock:
+            for mylist in self.fake._mylists:
+                indices = []
+                for item_id in mylist.item_ids:
+                    indices.append(str(len(mylist_works)))
+                    mylist_works.append(item_id)
+                mylists.append(
+                    {
+                        "id": mylist.id,
+                        "mylist_name": mylist.name,
+                        "insert_date": mylist.insert_date,
+                        "mylist_work_id": indices,
+                    }
+                )
+        self._SendJson({"mylists": mylists, "mylist_works": mylist_works})
+
+    def _FindMyList(self, list_id: Optional[str]) -> Optional[_MyList]:
+        for mylist in self.fake._mylists:
+            if str(mylist.id) == list_id:
+                return mylist
+        return None
+
+    def _UpdateMyList(self):
+        if not self._RequireLogin():
+            return
+        fake = self.fake
+        request_type = self._Arg(self._form, "type")
+        with fake._lock:
+            if request_type == "create":
+                mylist = _MyList(
+                    fake._next_mylist_id,
+                    self._Arg(self._form, "mylist_name") or "",
+                    formatdate(localtime=True),
+                )
+                fake._next_mylist_id += 1
+                fake._mylists.append(mylist)
+            else:
+                mylist = self._FindMyList(self._Arg(self._form, "mylist_id"))
+                if mylist and request_type == "rename":
+                    mylist.name = self._Arg(self._form, "mylist_name") or ""
+                elif mylist and request_type == "delete":
+                    fake._mylists.remove(mylist)
+        if not mylist or request_type not in ("create", "rename", "delete"):
+            self._SendJson({"result": False})
+            return
+        self._SendJson({"result": True, "mylist_id": mylist.id})
+
+    def _UpdateMyListWork(self):
+        if not self._RequireLogin():
+            return
+        request_type = self._Arg(self._form, "type")
+        response = {"result": False}
+        with self.fake._lock:
+            mylist = self._FindMyList(self._Arg(self._form, "mylist_id"))
+            if not mylist:
+                pass
+            elif request_type == "add":
+                item_id = self._Arg(self._form, "workno")
+                mylist.item_ids.append(item_id)
+                response = {
+                    "result": True,
+                    "mylist_id": mylist.id,
+                    "mylist_work_id": len(mylist.item_ids) - 1,
+                    "workno": item_id,
+                }
+            elif request_type == "delete":
+                index = self._Arg(self._form, "mylist_work_id")
+                if index is not None and 0 <= int(index) < len(mylist.item_ids):
+                    del mylist.item_ids[int(index)]
+                    response = {
+                        "result": True,
+                        "mylist_id": mylist.id,
+                        "mylist_work_id": index,
+                    }
+            elif request_type == "order":
+                order = [int(i) for i in self._Arg(self._form, "new_order").split(",")]
+                if sorted(order) == list(range(len(mylist.item_ids))):
+                    mylist.item_ids = [mylist.item_ids[i] for i in order]
+                    response = {"result": True, "mylist_id": mylist.id}
+        self._SendJson(response)
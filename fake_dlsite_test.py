@@ -0,0 +1,177 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import time
+import unittest
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import all_purchased
+import dlsite_extract
+import downloader
+import fake_dlsite
+import login
+import mylist_editor
+import session_pool
+
+_USER = "user@example.com"
+_PASSWORD = "password"
+
+
+class FakeDlsiteTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_dlsite.FakeDlsite()
+        self.fake.__enter__()
+        self.addCleanup(self.fake.__exit__, None, None, None)
+        self.fake.AddUser(_USER, _PASSWORD)
+
+    def testLoginAndGetAllPurchases(self):
+        self.fake.page_limit = 2
+        for i in range(5):
+            self.fake.AddWork(f"RJ0100000{i}", [10])
+
+        session = login.Login(_USER, _PASSWORD)
+        purchases = all_purchased.GetAllPurchases(
+            session_pool.SessionPool(
+                session, all_purchased.MAX_SIMULTANEOUS_CONNECTIONS
+            )
+        )
+
+        self.assertEqual(
+            sorted(p["workno"] for p in purchases),
+            [f"RJ0100000{i}" for i in range(5)],
+        )
+        self.assertEqual(len(self.fake.Requests("/api/purchases")), 3)
+
+    def testLoginWithWrongPassword(self):
+        with self.assertRaises(login.LoginFailureException):
+            login.Login(_USER, "wrong")
+
+    def testLoginRefetchesExpiredXsrfToken(self):
+        session = login.Login(_USER, _PASSWORD)
+        self.fake._xsrf_tokens.clear()
+
+        login.Login(_USER, _PASSWORD, saved_cookies=session.cookies)
+
+        self.assertEqual(
+            [r.status for r in self.fake.Requests("/login")],
+            [200, 302, 419, 200, 302],
+        )
+
+    def testDownloadSplitArchive(self):
+        work = self.fake.AddWork("RJ01000001", [300 * 1024, 100])
+        dl = downloader.Downloader(login.Login(_USER, _PASSWORD))
+
+        with TemporaryDirectory() as tmpdir:
+            paths = dl.DownloadTo("RJ01000001", tmpdir)
+
+            self.assertEqual(
+                [p.name for p in paths],
+                ["RJ01000001.part1.rar", "RJ01000001.part2.rar"],
+            )
+            for path, work_file in zip(paths, work.files):
+                self.assertEqual(path.read_bytes(), work_file.Content())
+
+    def testResolveFilesThenDownload(self):
+        work = self.fake.AddWork("RJ01000001", [300 * 1024, 100])
+        dl = downloader.Downloader(login.Login(_USER, _PASSWORD))
+
+        files = dl.ResolveFiles("RJ01000001")
+        self.assertEqual(
+            [(f.file_name, f.size) for f in files],
+            [("RJ01000001.part1.rar", 300 * 1024), ("RJ01000001.part2.rar", 100)],
+        )
+        with TemporaryDirectory() as tmpdir:
+            paths = dl.DownloadTo("RJ01000001", tmpdir, files=files)
+            for path, work_file in zip(paths, work.files):
+                self.assertEqual(path.read_bytes(), work_file.Content())
+
+        # Resolved once, to get the sizes.
+        self.assertEqual(len(self.fake.Requests("/api/download")), 1)
+
+    def testDownloadResumes(self):
+        work = self.fake.AddWork("RJ01000001", [200 * 1024])
+        content = work.files[0].Content()
+        dl = downloader.Downloader(login.Login(_USER, _PASSWORD))
+
+        with TemporaryDirectory() as tmpdir:
+            Path(tmpdir, "RJ01000001.downloading").write_bytes(content[:1000])
+            paths = dl.DownloadTo("RJ01000001", tmpdir)
+            self.assertEqual(paths[0].read_bytes(), content)
+
+        file_requests = self.fake.Requests("/get/")
+        self.assertEqual(file_requests[-1].headers.get("Range"), "bytes=1000-")
+        self.assertEqual(file_requests[-1].status, 206)
+
+    def testExpiredSession(self):
+        self.fake.AddWork("RJ01000001", [10])
+        dl = downloader.Downloader(login.Login(_USER, _PASSWORD))
+        self.fake.ExpireSessions()
+
+        with self.assertRaises(downloader.HttpUnauthorizeException):
+            dl.GetDownloadUrls("RJ01000001")
+
+    def testServerErrorIsRetried(self):
+        self.fake.AddWork("RJ01000001", [10])
+        pool = session_pool.SessionPool(login.Login(_USER, _PASSWORD))
+        self.fake.FailNext(503, path_prefix="/api/product_count")
+
+        self.assertEqual(len(all_purchased.GetAllPurchases(pool)), 1)
+        self.assertEqual(
+            [r.status for r in self.fake.Requests("/api/product_count")], [503, 200]
+        )
+
+    def testServerErrorWithoutRetries(self):
+        self.fake.FailNext(500)
+        response = requests.get("https://play.dlsite.com/api/product_count")
+        self.assertEqual(response.status_code, 500)
+
+    def testMyLists(self):
+        editor = mylist_editor.MyListEditor(login.Login(_USER, _PASSWORD))
+        self.assertTrue(editor.CreateNewList("favorites"))
+        (mylist,) = editor.GetListsFromListName("favorites")
+        self.assertTrue(editor.AddItemToList("RJ01000001", mylist.id))
+        self.assertTrue(editor.AddItemToList("RJ01000002", mylist.id))
+
+        mylist = editor.GetListFromListId(mylist.id)
+        self.assertEqual(mylist.item_ids, ["RJ01000001", "RJ01000002"])
+        self.assertTrue(editor.DeleteItemFromList("RJ01000001", mylist))
+        self.assertEqual(self.fake.MyListItems(), {"favorites": ["RJ01000002"]})
+
+    def testWorkName(self):
+        self.fake.AddWork("RJ01000001", [10], name="作品名")
+        self.assertEqual(dlsite_extract.GetWorkNameFromWorkId("RJ01000001"), "作品名")
+        self.assertEqual(dlsite_extract.GetWorkNameFromWorkId("RJ01000002"), "")
+
+    def testWorkNameOfOtherCategories(self):
+        self.fake.AddWork("VJ01000001", [10], name="ゲーム")
+        self.fake.AddWork("BJ01000001", [10], name="書籍")
+        self.assertEqual(dlsite_extract.GetWorkNameFromWorkId("VJ01000001"), "ゲーム")
+        self.assertEqual(dlsite_extract.GetWorkNameFromWorkId("BJ01000001"), "書籍")
+        self.assertEqual(
+            [r.path.split("?")[0] for r in self.fake.Requests("/")[-2:]],
+            ["/pro/product/info/ajax", "/books/product/info/ajax"],
+        )
+
+    def testLatencyAndBandwidth(self):
+        self.fake.AddWork("RJ01000001", [100 * 1024])
+        dl = downloader.Downloader(login.Login(_USER, _PASSWORD))
+        self.fake.latency = 0.1
+        self.fake.bandwidth = 500 * 1024
+
+        start = time.perf_counter()
+        with TemporaryDirectory() as tmpdir:
+            dl.DownloadTo("RJ01000001", tmpdir)
+        # Three requests (the download API, the file it redirects to, and the
+        # file again to download it) and 0.2 seconds for the body.
+        self.assertGreaterEqual(time.perf_counter() - start, 0.45)
+
+    def testInstallIsUndone(self):
+        send = HTTPAdapter.send
+        with fake_dlsite.FakeDlsite():
+            self.assertIsNot(HTTPAdapter.send, send)
+        self.assertIs(HTTPAdapter.send, send)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,11 +2,21 @@ import argparse
 from dataclasses import dataclass
 import os
 import pathlib
-from typing import List, Set, Tuple
+import re
+from typing import List, Optional, Set
+
+import instrument
+import progress
 
 # TODO: This should be configurable.
 _WATCHED_DIR_NAME = "視聴済み"
 
+# Item ID categories and the store site where the items are sold, e.g.
+# voice works (RJ) are in www.dlsite.com/maniax/.
+_CATEGORY_SITES = {"RJ": "maniax", "VJ": "pro", "BJ": "books"}
+
+_ITEM_ID_PATTERN = re.compile(rf"(?:{'|'.join(_CATEGORY_SITES)})\d+")
+
 
 @dataclass
 class Item:
@@ -48,38 +58,20 @@ def _SplitPrefix(name):
     return "", name
 
 
-# Split the name by a valid prefix followed by the rest. If there isn't a
-# valid prefix, the first item returned is an empty string.
-def _SplitByCategoryPrefix(name):
-    POSSIBLE_ITEM_PREFIXES = ["RJ", "VJ", "BJ"]
-    for item_prefix in POSSIBLE_ITEM_PREFIXES:
-        if name.startswith(item_prefix):
-            return item_prefix, name[len(item_prefix) :]
-    return "", name
-
-
-# Split the the number prefix in |name|. If the prefix is not a number,
-# returns an empty string.
-def _SplitByNumber(name: str) -> Tuple[str, str]:
-    """Split the the number prefix in |name|. If the prefix is not a number,
-    returns an empty string.
-
-    Args:
-        name (str): The name to be split.
+def MatchItemId(name: str) -> Optional[str]:
+    """Returns the item ID that name starts with, or None.
 
-    Returns:
-        Tuple[str, str]: A tuple containing the number prefix and the rest of the
-        name, respectively. If the prefix is not a number, the first element is an
-        empty string.
+    Item IDs are a category, RJ, VJ or BJ, followed by digits, e.g.
+    RJ01234567. Anything can follow the ID, e.g. "RJ1234 title" and
+    "RJ1234.part1.exe" both start with RJ1234.
     """
-    if name.isnumeric():
-        return name, ""
-    for i in range(len(name)):
-        ch = name[i]
-        if not ch.isdigit():
-            return name[:i], name[i:]
+    match = _ITEM_ID_PATTERN.match(name)
+    return match[0] if match else None
 
-    return "", name
+
+def SiteOf(item_id: str) -> str:
+    """Returns the store site of the item, as in www.dlsite.com/<site>/."""
+    return _CATEGORY_SITES[item_id[:2]]
 
 
 class Items:
@@ -89,15 +81,9 @@ class Items:
     def Add(self, directory: pathlib.Path):
         name = directory.name
         prefix, name = _SplitPrefix(name)
-        category, name = _SplitByCategoryPrefix(name)
-
-        if not category:
-            return
-
-        item_num, _ = _SplitByNumber(name)
-        if not item_num.isnumeric():
+        id = MatchItemId(name)
+        if not id:
             return
-        id = category + item_num
         self.items[id] = Item(directory, id, prefix)
 
     def Find(self, id: str) -> Item | None:
@@ -146,10 +132,12 @@ def GetItemsInDir(directory: str | pathlib.Path) -> Items:
     """
 
     items = Items()
-    watched = pathlib.Path(directory) / _WATCHED_DIR_NAME
-    if watched.is_dir():
-        _AddItemsInDir(watched, items)
-    _AddItemsInDir(pathlib.Path(directory), items)
+    with instrument.Span("library.scan"):
+        watched = pathlib.Path(directory) / _WATCHED_DIR_NAME
+        if watched.is_dir():
+            _AddItemsInDir(watched, items)
+        _AddItemsInDir(pathlib.Path(directory), items)
+    instrument.Count("library.items", len(items.items))
     return items
 
 
@@ -166,7 +154,9 @@ def CheckAleadyDownloaded(items_to_download: Set[str], management_dir: str) -> S
     items = FindItems(management_dir, items_to_download)
 
     for item in items:
-        print(f"Skipping {item.item_id}. Already at {item.directory}.")
+        progress.Message(
+            f"Skipping {item.item_id}. Already at {item.directory}.", item.item_id
+        )
 
     return items_to_download - set(item.item_id for item in items)
 
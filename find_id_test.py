@@ -44,6 +44,19 @@ class FindIdTest(unittest.TestCase):
             self.assertIn("VJ2333623", all_item_ids)
             self.assertTrue("RJ111", all_item_ids)
 
+    def testMatchItemId(self):
+        self.assertEqual(find_id.MatchItemId("RJ01234567"), "RJ01234567")
+        self.assertEqual(find_id.MatchItemId("VJ123 title"), "VJ123")
+        self.assertEqual(find_id.MatchItemId("BJ01234567.part1.exe"), "BJ01234567")
+        self.assertIsNone(find_id.MatchItemId("RJ"))
+        self.assertIsNone(find_id.MatchItemId("XJ1234"))
+        self.assertIsNone(find_id.MatchItemId("#RJ1234"))
+
+    def testSiteOf(self):
+        self.assertEqual(find_id.SiteOf("RJ01234567"), "maniax")
+        self.assertEqual(find_id.SiteOf("VJ01234567"), "pro")
+        self.assertEqual(find_id.SiteOf("BJ01234567"), "books")
+
     def testGetAllItemPaths(self):
         with TemporaryDirectory() as tmpdir:
             (Path(tmpdir) / "RJ23123").mkdir()
@@ -0,0 +1,189 @@
+"""Timing spans and counters for the network and disk stages.
+
+Disabled by default. While disabled, Span() returns a shared context that
+does nothing and Count() returns right away, so instrumented code costs a
+function call and a flag check.
+
+    instrument.Enable()
+    with instrument.Span("extract.unarchive"):
+        ...
+    instrument.Count("download.bytes", size)
+    print(instrument.Summary())
+
+Span names are "<stage>.<step>". Spans with the same name are aggregated.
+Counters can have labels, e.g. the HTTP status, and are then recorded per
+label value. Gauges hold the current value of something, e.g. the number of
+downloads in flight.
+"""
+
+from dataclasses import dataclass
+import json
+from pathlib import Path
+import threading
+import time
+from typing import Dict, Optional
+
+_lock = threading.Lock()
+_enabled = False
+_start_time = 0.0
+_spans: Dict[str, "_SpanStats"] = {}
+_counters: Dict[str, int] = {}
+_gauges: Dict[str, float] = {}
+
+
+@dataclass
+class _SpanStats:
+    count: int = 0
+    total_seconds: float = 0.0
+    min_seconds: float = float("inf")
+    max_seconds: float = 0.0
+
+    def Add(self, seconds: float):
+        self.count += 1
+        self.total_seconds += seconds
+        self.min_seconds = min(self.min_seconds, seconds)
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+class _Span:
+    __slots__ = ("_name", "_start")
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self._start
+        with _lock:
+            stats = _spans.get(self._name)
+            if stats is None:
+                stats = _spans[self._name] = _SpanStats()
+            stats.Add(elapsed)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Active:
+    __slots__ = ("_name",)
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+
+    def __enter__(self):
+        AddGauge(self._name, 1)
+        return self
+
+    def __exit__(self, *exc_info):
+        AddGauge(self._name, -1)
+
+
+def _Key(name: str, labels: Optional[Dict[str, str]]) -> str:
+    if not labels:
+        return name
+    label_values = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{label_values}}}"
+
+
+def Enable():
+    """Starts recording. Anything recorded before is discarded."""
+    global _enabled, _start_time
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _gauges.clear()
+        _start_time = time.perf_counter()
+        _enabled = True
+
+
+def Disable():
+    global _enabled
+    _enabled = False
+
+
+def IsEnabled() -> bool:
+    return _enabled
+
+
+def Span(name: str):
+    """Context manager that times the block under name."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def Count(name: str, value: int = 1, labels: Optional[Dict[str, str]] = None):
+    """Adds value to the counter name.
+
+    With labels, the counter is recorded as e.g. 'http.responses{code="200"}'.
+    """
+    if not _enabled:
+        return
+    key = _Key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def SetGauge(name: str, value: float):
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+def AddGauge(name: str, delta: float):
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[name] = _gauges.get(name, 0) + delta
+
+
+def Active(name: str):
+    """Context manager that counts the blocks running in the gauge name."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Active(name)
+
+
+def Summary() -> Dict:
+    """Returns what was recorded since Enable()."""
+    with _lock:
+        spans = {
+            name: {
+                "count": s.count,
+                "total_seconds": s.total_seconds,
+                "mean_seconds": s.total_seconds / s.count,
+                "min_seconds": s.min_seconds,
+                "max_seconds": s.max_seconds,
+            }
+            for name, s in sorted(_spans.items())
+        }
+        return {
+            "wall_seconds": time.perf_counter() - _start_time if _enabled else 0.0,
+            "spans": spans,
+            "counters": dict(sorted(_counters.items())),
+            "gauges": dict(sorted(_gauges.items())),
+        }
+
+
+def WriteSummary(path: Optional[Path]):
+    """Writes Summary() as JSON to path, or prints it if path is None."""
+    content = json.dumps(Summary(), indent=2)
+    if path is None:
+        print(content)
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content + "\n")
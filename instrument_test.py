@@ -0,0 +1,89 @@
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+import instrument
+
+
+class InstrumentTest(unittest.TestCase):
+    def tearDown(self):
+        instrument.Disable()
+
+    def testDisabledRecordsNothing(self):
+        instrument.Enable()
+        instrument.Disable()
+        with instrument.Span("stage.step"):
+            pass
+        instrument.Count("stage.count")
+        summary = instrument.Summary()
+        self.assertEqual(summary["spans"], {})
+        self.assertEqual(summary["counters"], {})
+
+    def testSpansWithTheSameNameAreAggregated(self):
+        instrument.Enable()
+        for _ in range(3):
+            with instrument.Span("stage.step"):
+                pass
+        with self.assertRaises(ValueError):
+            with instrument.Span("stage.failed"):
+                raise ValueError()
+
+        spans = instrument.Summary()["spans"]
+        self.assertEqual(spans["stage.step"]["count"], 3)
+        self.assertLessEqual(
+            spans["stage.step"]["min_seconds"], spans["stage.step"]["max_seconds"]
+        )
+        self.assertEqual(spans["stage.failed"]["count"], 1)
+
+    def testCounters(self):
+        instrument.Enable()
+        instrument.Count("stage.items")
+        instrument.Count("stage.items")
+        instrument.Count("stage.bytes", 100)
+        instrument.Count("stage.bytes", 23)
+        self.assertEqual(
+            instrument.Summary()["counters"], {"stage.bytes": 123, "stage.items": 2}
+        )
+
+    def testCountersWithLabels(self):
+        instrument.Enable()
+        instrument.Count("http.responses", labels={"code": "200"})
+        instrument.Count("http.responses", labels={"code": "200"})
+        instrument.Count("http.responses", labels={"code": "503"})
+        self.assertEqual(
+            instrument.Summary()["counters"],
+            {'http.responses{code="200"}': 2, 'http.responses{code="503"}': 1},
+        )
+
+    def testGauges(self):
+        instrument.Enable()
+        instrument.SetGauge("stage.queue_depth", 5)
+        with instrument.Active("stage.active"):
+            with instrument.Active("stage.active"):
+                self.assertEqual(instrument.Summary()["gauges"]["stage.active"], 2)
+        self.assertEqual(
+            instrument.Summary()["gauges"],
+            {"stage.active": 0, "stage.queue_depth": 5},
+        )
+
+    def testEnableDiscardsEarlierRecords(self):
+        instrument.Enable()
+        instrument.Count("stage.items")
+        instrument.Enable()
+        self.assertEqual(instrument.Summary()["counters"], {})
+
+    def testWriteSummary(self):
+        instrument.Enable()
+        instrument.Count("stage.items", 2)
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "stats.json"
+            instrument.WriteSummary(path)
+            with open(path, "r", encoding="utf-8") as f:
+                summary = json.load(f)
+        self.assertEqual(summary["counters"], {"stage.items": 2})
+        self.assertGreaterEqual(summary["wall_seconds"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+"""Per-item lock files so that several manager runs can share a download dir.
+
+A lock is a file named after the item, created exclusively. It records which
+host and process owns it. The owner touches the file periodically. Locks whose
+owner process is gone (on the same host) or that have not been touched for a
+while (any host) are considered stale and can be taken over.
+
+This only relies on exclusive file creation and rename, which also work on
+network shares where fcntl style locks are often unreliable.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Set
+
+_LOCK_SUFFIX = ".lock"
+
+# A lock that has not been touched for this many seconds is stale.
+DEFAULT_STALE_AFTER = 10 * 60
+
+# How often held locks are touched. Must be well below DEFAULT_STALE_AFTER.
+DEFAULT_HEARTBEAT_INTERVAL = 60
+
+
+def _IsProcessAlive(pid: int) -> bool:
+    # os.kill(pid, 0) terminates the process on Windows, so only check on posix.
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists but owned by someone else.
+        return True
+    return True
+
+
+class ItemLock:
+    def __init__(
+        self, lock_dir: Path, item_id: str, stale_after: float = DEFAULT_STALE_AFTER
+    ) -> None:
+        self.item_id = item_id
+        self.path = lock_dir / f"{item_id}{_LOCK_SUFFIX}"
+        self._stale_after = stale_after
+        self._owner = {
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "token": uuid.uuid4().hex,
+        }
+
+    def _ReadOwner(self, path: Path) -> Optional[Dict]:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _IsStale(self, owner: Optional[Dict], mtime: float) -> bool:
+        if time.time() - mtime > self._stale_after:
+            return True
+        if owner is None:
+            # Being written right now, or garbage. Rely on the mtime.
+            return False
+        if owner.get("host") == self._owner["host"]:
+            return not _IsProcessAlive(owner.get("pid", -1))
+        return False
+
+    def _Create(self) -> bool:
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._owner, f)
+        return True
+
+    def _ReclaimIfStale(self) -> bool:
+        """Removes the lock file if it is stale. Returns True if removed."""
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        owner = self._ReadOwner(self.path)
+        if not self._IsStale(owner, mtime):
+            return False
+
+        # Move it out of the way first so that only one process reclaims it.
+        # If the file changed in the meantime, another process already
+        # reclaimed it and this moved a fresh lock. Put that one back.
+        moved = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(self.path, moved)
+        except FileNotFoundError:
+            return True
+        if self._ReadOwner(moved) != owner:
+            try:
+                os.link(moved, self.path)
+            except FileExistsError:
+                pass
+            os.unlink(moved)
+            return False
+
+        logging.info(f"Reclaimed stale lock for {self.item_id} held by {owner}.")
+        os.unlink(moved)
+        return True
+
+    def TryAcquire(self) -> bool:
+        """Takes the lock without waiting. Returns True on success."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self._Create():
+            return True
+        if self._ReclaimIfStale():
+            return self._Create()
+        return False
+
+    def Touch(self):
+        """Marks the lock as still in use."""
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            logging.warning(f"Lock for {self.item_id} disappeared.")
+
+    def Release(self):
+        if self._ReadOwner(self.path) != self._owner:
+            logging.warning(f"Lock for {self.item_id} is not owned anymore.")
+            return
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ItemLocks:
+    """Set of item locks held by this process, kept alive in the background.
+
+    Use as a context manager. All locks are released on exit.
+    """
+
+    def __init__(
+        self,
+        lock_dir: Path,
+        stale_after: float = DEFAULT_STALE_AFTER,
+        heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+    ) -> None:
+        self._lock_dir = lock_dir
+        self._stale_after = stale_after
+        self._heartbeat_interval = heartbeat_interval
+        self._held: Dict[str, ItemLock] = {}
+        self._mutex = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "ItemLocks":
+        self._stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._Heartbeat, daemon=True)
+        self._heartbeat_thread.start()
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self._stop.set()
+        if self._heartbeat_thread:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        self.ReleaseAll()
+
+    def _Heartbeat(self):
+        while not self._stop.wait(self._heartbeat_interval):
+            with self._mutex:
+                locks = list(self._held.values())
+            for lock in locks:
+                lock.Touch()
+
+    def Holds(self, item_id: str) -> bool:
+        with self._mutex:
+            return item_id in self._held
+
+    def HeldItems(self) -> Set[str]:
+        with self._mutex:
+            return set(self._held)
+
+    def TryAcquire(self, item_id: str) -> bool:
+        """Takes the lock for item_id. True if held by this process after."""
+        with self._mutex:
+            if item_id in self._held:
+                return True
+        lock = ItemLock(self._lock_dir, item_id, self._stale_after)
+        if not lock.TryAcquire():
+            return False
+        with self._mutex:
+            self._held[item_id] = lock
+        return True
+
+    def Release(self, item_id: str):
+        with self._mutex:
+            lock = self._held.pop(item_id, None)
+        if lock:
+            lock.Release()
+
+    def ReleaseAll(self):
+        for item_id in self.HeldItems():
+            self.Release(item_id)
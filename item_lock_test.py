@@ -0,0 +1,104 @@
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+import unittest
+
+import item_lock
+
+
+class ItemLockTest(unittest.TestCase):
+    def testAcquireAndRelease(self):
+        with TemporaryDirectory() as lock_dir:
+            lock = item_lock.ItemLock(Path(lock_dir), "RJ123")
+            self.assertTrue(lock.TryAcquire())
+            self.assertTrue(lock.path.exists())
+
+            lock.Release()
+            self.assertFalse(lock.path.exists())
+
+    def testSecondOwnerFails(self):
+        with TemporaryDirectory() as lock_dir:
+            first = item_lock.ItemLock(Path(lock_dir), "RJ123")
+            second = item_lock.ItemLock(Path(lock_dir), "RJ123")
+            self.assertTrue(first.TryAcquire())
+            self.assertFalse(second.TryAcquire())
+
+            # Releasing with a non owner must not remove the lock.
+            second.Release()
+            self.assertTrue(first.path.exists())
+
+    def testDifferentItems(self):
+        with TemporaryDirectory() as lock_dir:
+            self.assertTrue(item_lock.ItemLock(Path(lock_dir), "RJ123").TryAcquire())
+            self.assertTrue(item_lock.ItemLock(Path(lock_dir), "RJ1234").TryAcquire())
+
+    @unittest.skipUnless(os.name == "posix", "Process check is posix only.")
+    def testReclaimLockOfDeadProcess(self):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        with TemporaryDirectory() as lock_dir:
+            lock = item_lock.ItemLock(Path(lock_dir), "RJ123")
+            with open(lock.path, "w") as f:
+                json.dump(
+                    {"host": lock._owner["host"], "pid": process.pid, "token": "x"}, f
+                )
+
+            self.assertTrue(lock.TryAcquire())
+            self.assertEqual(os.listdir(lock_dir), ["RJ123.lock"])
+
+    def testReclaimLockNotTouched(self):
+        with TemporaryDirectory() as lock_dir:
+            other = item_lock.ItemLock(Path(lock_dir), "RJ123")
+            self.assertTrue(other.TryAcquire())
+            old = time.time() - item_lock.DEFAULT_STALE_AFTER - 10
+            os.utime(other.path, (old, old))
+
+            lock = item_lock.ItemLock(Path(lock_dir), "RJ123")
+            self.assertTrue(lock.TryAcquire())
+
+    def testTouchedLockIsNotReclaimed(self):
+        with TemporaryDirectory() as lock_dir:
+            other = item_lock.ItemLock(Path(lock_dir), "RJ123")
+            self.assertTrue(other.TryAcquire())
+            old = time.time() - item_lock.DEFAULT_STALE_AFTER - 10
+            os.utime(other.path, (old, old))
+            other.Touch()
+
+            lock = item_lock.ItemLock(Path(lock_dir), "RJ123")
+            self.assertFalse(lock.TryAcquire())
+
+
+class ItemLocksTest(unittest.TestCase):
+    def testReleasedOnExit(self):
+        with TemporaryDirectory() as lock_dir:
+            with item_lock.ItemLocks(Path(lock_dir)) as locks:
+                self.assertTrue(locks.TryAcquire("RJ1"))
+                self.assertTrue(locks.TryAcquire("RJ1"))
+                self.assertTrue(locks.TryAcquire("RJ2"))
+                self.assertEqual(locks.HeldItems(), {"RJ1", "RJ2"})
+            self.assertEqual(os.listdir(lock_dir), [])
+
+    def testPartitionsItems(self):
+        with TemporaryDirectory() as lock_dir:
+            with item_lock.ItemLocks(Path(lock_dir)) as first:
+                with item_lock.ItemLocks(Path(lock_dir)) as second:
+                    self.assertTrue(first.TryAcquire("RJ1"))
+                    self.assertFalse(second.TryAcquire("RJ1"))
+                    self.assertTrue(second.TryAcquire("RJ2"))
+                    self.assertFalse(first.TryAcquire("RJ2"))
+
+    def testHeartbeatTouchesLocks(self):
+        with TemporaryDirectory() as lock_dir:
+            with item_lock.ItemLocks(Path(lock_dir), heartbeat_interval=0.01) as locks:
+                locks.TryAcquire("RJ1")
+                lock_file = Path(lock_dir) / "RJ1.lock"
+                old = time.time() - 1000
+                os.utime(lock_file, (old, old))
+                deadline = time.time() + 5
+                while lock_file.stat().st_mtime == old and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertNotEqual(lock_file.stat().st_mtime, old)
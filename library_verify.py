@@ -0,0 +1,172 @@
+"""Verifies the items in the library against their manifests.
+
+Files are checked in a thread pool, so the number of workers bounds how many
+files are read at the same time. Finished items are recorded in a journal, so
+an interrupted run continues where it stopped. The journal is removed once
+every item has been checked, and the next run starts over.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from enum import Enum
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import find_id
+import manifest
+import progress
+
+
+class Mode(str, Enum):
+    # Only compares sizes and modification times.
+    FAST = "fast"
+    # Hashes every file.
+    DEEP = "deep"
+
+
+@dataclass
+class ItemResult:
+    item: find_id.Item
+    # None if the item has no manifest.
+    problems: Optional[List[str]] = field(default_factory=list)
+    # Verified by a previous, interrupted run.
+    skipped: bool = False
+
+
+class _Journal:
+    def __init__(self, path: Path) -> None:
+        self._path = path
+
+    def Load(self) -> Dict[str, Dict]:
+        """Returns the recorded results, keyed by item directory."""
+        entries = {}
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return entries
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                entries[entry["path"]] = entry
+            except (ValueError, KeyError):
+                # A crash can leave a truncated last line.
+                logging.warning(f"Ignoring broken verify journal entry: {line!r}")
+        return entries
+
+    def Append(self, directory: Path, mode: Mode, ok: bool):
+        line = json.dumps(
+            {"path": str(directory), "mode": mode.value, "ok": ok},
+            ensure_ascii=False,
+        )
+        with open(self._path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def Remove(self):
+        self._path.unlink(missing_ok=True)
+
+
+def _AlreadyVerified(entry: Optional[Dict], mode: Mode) -> bool:
+    if not entry or not entry.get("ok"):
+        return False
+    return mode == Mode.FAST or entry.get("mode") == Mode.DEEP.value
+
+
+def VerifyItems(
+    items: List[find_id.Item],
+    mode: Mode,
+    jobs: int,
+    journal_path: Optional[Path] = None,
+) -> List[ItemResult]:
+    """Verifies the items.
+
+    Args:
+        items: Items to verify.
+        mode: How thoroughly the files are checked.
+        jobs: Number of files checked at the same time.
+        journal_path: Where progress is recorded. Items that a previous run
+            verified in the same or a deeper mode are skipped.
+
+    Returns:
+        Results for all the items.
+    """
+    journal = _Journal(journal_path) if journal_path else None
+    verified = journal.Load() if journal else {}
+
+    results: List[ItemResult] = []
+    to_check = []
+    for item in items:
+        if _AlreadyVerified(verified.get(str(item.directory)), mode):
+            results.append(ItemResult(item, skipped=True))
+            continue
+        item_manifest = manifest.Manifest.Load(item.directory / manifest.MANIFEST_FILE)
+        if item_manifest is None:
+            results.append(ItemResult(item, problems=None))
+            continue
+        to_check.append((item, item_manifest.files))
+
+    deep = mode == Mode.DEEP
+    num_files = sum(len(files) for _, files in to_check)
+    progress.Message(f"Verifying {num_files} files of {len(to_check)} items.")
+
+    pending: Dict[Path, int] = {}
+    sizes: Dict[Path, int] = {}
+    # Started when the first file of the item is checked, so that only the
+    # items being checked are shown.
+    item_progress: Dict[Path, progress.FileProgress] = {}
+    problems: Dict[Path, List[str]] = {}
+    futures: Dict[Future, Tuple[find_id.Item, manifest.FileEntry]] = {}
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for item, files in to_check:
+            if not files:
+                results.append(ItemResult(item))
+                if journal:
+                    journal.Append(item.directory, mode, True)
+                continue
+            pending[item.directory] = len(files)
+            sizes[item.directory] = sum(f.size for f in files)
+            problems[item.directory] = []
+            for entry in files:
+                future = executor.submit(
+                    manifest.CheckEntry,
+                    item.directory,
+                    entry,
+                    check_mtime=not deep,
+                    check_hash=deep,
+                )
+                futures[future] = (item, entry)
+
+        for future in as_completed(futures):
+            item, entry = futures[future]
+            problem = future.result()
+            if problem:
+                problems[item.directory].append(problem)
+            if item.directory not in item_progress:
+                item_progress[item.directory] = progress.StartFile(
+                    item.item_id,
+                    item.directory.name,
+                    sizes[item.directory],
+                )
+            item_progress[item.directory].Update(entry.size)
+
+            pending[item.directory] -= 1
+            if pending[item.directory]:
+                continue
+            item_progress.pop(item.directory).Finish()
+            item_problems = sorted(problems.pop(item.directory))
+            results.append(ItemResult(item, item_problems))
+            if journal:
+                journal.Append(item.directory, mode, not item_problems)
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for stopped in item_progress.values():
+            stopped.Finish(succeeded=False)
+        raise
+    executor.shutdown()
+
+    if journal:
+        journal.Remove()
+    return results
@@ -0,0 +1,117 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+import find_id
+import library_verify
+from library_verify import Mode
+import manifest
+import progress
+from progress_test import RecordingSink
+
+
+def _CreateItem(management_dir: Path, name: str, content: bytes) -> find_id.Item:
+    item_dir = management_dir / name
+    item_dir.mkdir()
+    (item_dir / "file").write_bytes(content)
+    manifest.Create(item_dir, name).Save(item_dir / manifest.MANIFEST_FILE)
+    return find_id.Item(item_dir, name, "")
+
+
+class VerifyItemsTest(unittest.TestCase):
+    def testFastModeChecksSizeAndModificationTime(self):
+        with TemporaryDirectory() as tmpdir:
+            resized = _CreateItem(Path(tmpdir), "RJ1", b"abc")
+            touched = _CreateItem(Path(tmpdir), "RJ2", b"abc")
+            ok = _CreateItem(Path(tmpdir), "RJ3", b"abc")
+            (resized.directory / "file").write_bytes(b"abcd")
+            os.utime(touched.directory / "file", (0, 0))
+
+            results = library_verify.VerifyItems(
+                [resized, touched, ok], Mode.FAST, jobs=2
+            )
+            problems = {r.item.item_id: r.problems for r in results}
+            self.assertEqual(problems["RJ1"], ["file is 4 bytes, expected 3."])
+            self.assertEqual(problems["RJ2"], ["file was modified."])
+            self.assertEqual(problems["RJ3"], [])
+
+    def testDeepModeHashes(self):
+        with TemporaryDirectory() as tmpdir:
+            item = _CreateItem(Path(tmpdir), "RJ1", b"abc")
+            (item.directory / "file").write_bytes(b"xyz")
+
+            fast = library_verify.VerifyItems([item], Mode.FAST, jobs=1)
+            self.assertEqual(fast[0].problems, [])
+            deep = library_verify.VerifyItems([item], Mode.DEEP, jobs=1)
+            self.assertEqual(deep[0].problems, ["file does not match its hash."])
+
+    def testProgressIsReportedToTheSink(self):
+        sink = RecordingSink()
+        previous = progress.SetSink(sink)
+        self.addCleanup(progress.SetSink, previous)
+        with TemporaryDirectory() as tmpdir:
+            item = _CreateItem(Path(tmpdir), "RJ1", b"abc")
+            library_verify.VerifyItems([item], Mode.DEEP, jobs=1)
+
+        file_events = [e for e in sink.events if e.kind != progress.MESSAGE]
+        self.assertEqual(
+            [(e.kind, e.item_id, e.done, e.total) for e in file_events],
+            [
+                (progress.FILE_STARTED, "RJ1", 0, 3),
+                (progress.FILE_DONE, "RJ1", 3, 3),
+            ],
+        )
+
+    def testItemWithoutManifest(self):
+        with TemporaryDirectory() as tmpdir:
+            (Path(tmpdir) / "RJ1").mkdir()
+            item = find_id.Item(Path(tmpdir) / "RJ1", "RJ1", "")
+            results = library_verify.VerifyItems([item], Mode.FAST, jobs=1)
+            self.assertIsNone(results[0].problems)
+
+    def testInterruptedRunIsContinued(self):
+        with TemporaryDirectory() as tmpdir:
+            journal_path = Path(tmpdir) / "journal.jsonl"
+            management_dir = Path(tmpdir) / "manage"
+            management_dir.mkdir()
+            first = _CreateItem(management_dir, "RJ1", b"abc")
+            second = _CreateItem(management_dir, "RJ2", b"abc")
+
+            check_entry = manifest.CheckEntry
+
+            def _InterruptOnSecond(directory, *args, **kwargs):
+                if directory == second.directory:
+                    raise KeyboardInterrupt()
+                return check_entry(directory, *args, **kwargs)
+
+            with patch("manifest.CheckEntry", side_effect=_InterruptOnSecond):
+                with self.assertRaises(KeyboardInterrupt):
+                    library_verify.VerifyItems(
+                        [first, second], Mode.DEEP, jobs=1, journal_path=journal_path
+                    )
+            self.assertTrue(journal_path.exists())
+
+            results = library_verify.VerifyItems(
+                [first, second], Mode.FAST, jobs=1, journal_path=journal_path
+            )
+            self.assertEqual([r.skipped for r in results], [True, False])
+            # A completed run starts over next time.
+            self.assertFalse(journal_path.exists())
+
+    def testFastResultIsNotEnoughForDeep(self):
+        with TemporaryDirectory() as tmpdir:
+            journal_path = Path(tmpdir) / "journal.jsonl"
+            journal = library_verify._Journal(journal_path)
+            journal.Append(Path(tmpdir) / "RJ1", Mode.FAST, True)
+            self.assertTrue(
+                library_verify._AlreadyVerified(
+                    journal.Load()[str(Path(tmpdir) / "RJ1")], Mode.FAST
+                )
+            )
+            self.assertFalse(
+                library_verify._AlreadyVerified(
+                    journal.Load()[str(Path(tmpdir) / "RJ1")], Mode.DEEP
+                )
+            )
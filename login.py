@@ -1,52 +1,155 @@
+import time
+from contextlib import contextmanager
+from http.cookiejar import CookieJar
+from typing import Dict, Optional
+
 import requests
 import logging
 
-from requests.adapters import HTTPAdapter, Retry
+import instrument
+import session_pool
 
 LOGIN_URL = "https://login.dlsite.com/login"
 MYPAGE_URL = "https://ssl.dlsite.com/home/mypage"
+PLAY_URL = "https://play.dlsite.com/"
+
+_XSRF_TOKEN_COOKIE = "XSRF-TOKEN"
+_LOGIN_DOMAIN = "login.dlsite.com"
+
+# Laravel returns this when the XSRF token is stale.
+_HTTP_STATUS_PAGE_EXPIRED = 419
 
 
 class LoginFailureException(Exception):
     pass
 
 
-def Login(username: str, password: str) -> requests.Session:
+def _CreateSession() -> requests.Session:
+    """Creates a session that retries on server errors from the first request.
+
+    The same adapter keeps the connection to each host alive for the whole
+    login sequence.
+    """
+    session = requests.Session()
+    adapter = session_pool.CreateAdapter(1)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@contextmanager
+def _TimeStep(name: str, timings: Optional[Dict[str, float]]):
+    start = time.perf_counter()
+    try:
+        with instrument.Span(f"login.{name}"):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        logging.info(f"Login step {name} took {elapsed}.")
+        if timings is not None:
+            timings[name] = elapsed
+
+
+def _GetValidXsrfToken(session: requests.Session) -> Optional[str]:
+    """Returns the XSRF token for the login page if it has not expired."""
+    now = time.time()
+    for cookie in session.cookies:
+        if cookie.name != _XSRF_TOKEN_COOKIE:
+            continue
+        if not cookie.domain.lstrip(".").endswith(_LOGIN_DOMAIN):
+            continue
+        if cookie.is_expired(now):
+            continue
+        return cookie.value
+    return None
+
+
+def _FetchXsrfToken(session: requests.Session) -> str:
+    session.get(LOGIN_URL)
+    token = _GetValidXsrfToken(session)
+    if not token:
+        logging.error("Login page did not set an XSRF token.")
+        raise LoginFailureException()
+    return token
+
+
+def _VisitedMypage(response: requests.Response) -> bool:
+    """Whether the login redirects already went through mypage successfully."""
+    for r in response.history + [response]:
+        if r.url.startswith(MYPAGE_URL) and r.status_code == requests.codes.ok:
+            return True
+    return False
+
+
+def Login(
+    username: str,
+    password: str,
+    saved_cookies: Optional[CookieJar] = None,
+    timings: Optional[Dict[str, float]] = None,
+) -> requests.Session:
     """Logs into DLsite using the username and password.
 
+    Args:
+        username: Login ID or email address.
+        password: Plain text password.
+        saved_cookies: Cookies from a previous session. If it still has a valid
+            XSRF token for the login page, fetching the login page is skipped.
+        timings: If specified, the time each step took in seconds is stored
+            with the step name as the key.
+
     Returns:
         requests session. This can be further used as a "logged in" session.
     """
 
     logging.info("Logging in.")
-    session = requests.Session()
-    session.get("https://login.dlsite.com/login")
-    token = session.cookies.get_dict()["XSRF-TOKEN"]
-
-    payload = {
-        "_token": token,
-        "login_id": username,
-        "password": password,
-    }
-
-    login_response = session.post(LOGIN_URL, data=payload)
+    session = _CreateSession()
+    if saved_cookies is not None:
+        session.cookies.update(saved_cookies)
+
+    token = _GetValidXsrfToken(session)
+    if token:
+        logging.info("Reusing XSRF token from saved cookies.")
+    else:
+        with _TimeStep("login_page", timings):
+            token = _FetchXsrfToken(session)
+
+    def _PostLogin(token: str) -> requests.Response:
+        payload = {
+            "_token": token,
+            "login_id": username,
+            "password": password,
+        }
+        return session.post(LOGIN_URL, data=payload)
+
+    with _TimeStep("login", timings):
+        login_response = _PostLogin(token)
+
+        if login_response.status_code == _HTTP_STATUS_PAGE_EXPIRED:
+            logging.info("Saved XSRF token was rejected. Fetching a new one.")
+            login_response = _PostLogin(_FetchXsrfToken(session))
 
     if login_response.status_code != requests.codes.ok:
         logging.error(f"Got status code {login_response.status_code} trying to login.")
         raise LoginFailureException()
 
-    # Requires cookies from mypage.
-    mypage_response = session.get(MYPAGE_URL)
+    # Requires cookies from mypage. The login may already redirect there, in
+    # which case the cookies are already set.
+    if _VisitedMypage(login_response):
+        logging.info("Login redirected to mypage. Skipping mypage.")
+    else:
+        with _TimeStep("mypage", timings):
+            mypage_response = session.get(MYPAGE_URL)
 
-    if mypage_response.status_code != requests.codes.ok:
-        logging.error("Failed to get logged in mypage.")
-        raise LoginFailureException()
+        if mypage_response.status_code != requests.codes.ok:
+            logging.error("Failed to get logged in mypage.")
+            raise LoginFailureException()
 
     # Not sure if this is absolutely necessary but does not seem to hurt.
     session.cookies.set("adultchecked", "1", domain=".dlsite.com", path="/")
 
     # Get cookies for play.dlsite.com.
-    session.get("https://play.dlsite.com/")
+    with _TimeStep("play", timings):
+        session.get(PLAY_URL)
 
     # Note that when visiting https://play.dlsite.com/ in a browser, it also
     # accesses https://play.dlsite.com/login. This gets redirected and seems to
@@ -56,11 +159,4 @@ def Login(username: str, password: str) -> requests.Session:
     # Also https://play.dlsite.com/api/authorize is accessed but does not seem
     # to add any cookie entries.
 
-    # Setup automatic retries for this session. Any http and https requests
-    # using this session will have this retry configured.
-    # It often gets status 500 and fails to get the content length. This should
-    # recover after a few retries.
-    retries = Retry(backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
-    session.mount("https://", HTTPAdapter(max_retries=retries))
-    session.mount("http://", HTTPAdapter(max_retries=retries))
     return session
@@ -0,0 +1,133 @@
+import time
+import unittest
+from unittest.mock import MagicMock, call, patch
+
+import requests
+
+import login
+
+
+def _Response(url: str, status_code: int = 200, history=None) -> MagicMock:
+    response = MagicMock()
+    response.url = url
+    response.status_code = status_code
+    response.history = history or []
+    return response
+
+
+def _FakeSession() -> MagicMock:
+    """Session whose login page sets an XSRF token like the real one."""
+    session = MagicMock()
+    session.cookies = requests.cookies.RequestsCookieJar()
+
+    def _Get(url, **kwargs):
+        if url == login.LOGIN_URL:
+            session.cookies.set(
+                "XSRF-TOKEN", "fresh token", domain="login.dlsite.com", path="/"
+            )
+        return _Response(url)
+
+    session.get.side_effect = _Get
+    session.post.return_value = _Response(login.LOGIN_URL)
+    return session
+
+
+class LoginTest(unittest.TestCase):
+    @patch("login._CreateSession")
+    def testLogin(self, create_session_mock: MagicMock):
+        session = _FakeSession()
+        create_session_mock.return_value = session
+        timings = {}
+
+        self.assertIs(login.Login("user", "pass", timings=timings), session)
+
+        session.post.assert_called_once_with(
+            login.LOGIN_URL,
+            data={"_token": "fresh token", "login_id": "user", "password": "pass"},
+        )
+        session.get.assert_has_calls(
+            [call(login.LOGIN_URL), call(login.MYPAGE_URL), call(login.PLAY_URL)]
+        )
+        self.assertEqual(set(timings), {"login_page", "login", "mypage", "play"})
+
+    @patch("login._CreateSession")
+    def testLoginReusesSavedToken(self, create_session_mock: MagicMock):
+        session = _FakeSession()
+        create_session_mock.return_value = session
+        saved = requests.cookies.RequestsCookieJar()
+        saved.set(
+            "XSRF-TOKEN",
+            "saved token",
+            domain="login.dlsite.com",
+            path="/",
+            expires=int(time.time()) + 3600,
+        )
+        timings = {}
+
+        login.Login("user", "pass", saved_cookies=saved, timings=timings)
+
+        self.assertNotIn(call(login.LOGIN_URL), session.get.call_args_list)
+        self.assertEqual(session.post.call_args.kwargs["data"]["_token"], "saved token")
+        self.assertNotIn("login_page", timings)
+
+    @patch("login._CreateSession")
+    def testLoginIgnoresExpiredSavedToken(self, create_session_mock: MagicMock):
+        session = _FakeSession()
+        create_session_mock.return_value = session
+        saved = requests.cookies.RequestsCookieJar()
+        saved.set(
+            "XSRF-TOKEN",
+            "expired token",
+            domain="login.dlsite.com",
+            path="/",
+            expires=int(time.time()) - 10,
+        )
+
+        login.Login("user", "pass", saved_cookies=saved)
+
+        self.assertIn(call(login.LOGIN_URL), session.get.call_args_list)
+        self.assertEqual(session.post.call_args.kwargs["data"]["_token"], "fresh token")
+
+    @patch("login._CreateSession")
+    def testLoginRefetchesRejectedToken(self, create_session_mock: MagicMock):
+        session = _FakeSession()
+        create_session_mock.return_value = session
+        session.post.side_effect = [
+            _Response(login.LOGIN_URL, status_code=419),
+            _Response(login.LOGIN_URL),
+        ]
+        saved = requests.cookies.RequestsCookieJar()
+        saved.set("XSRF-TOKEN", "stale token", domain="login.dlsite.com", path="/")
+
+        login.Login("user", "pass", saved_cookies=saved)
+
+        self.assertEqual(session.post.call_count, 2)
+        self.assertEqual(session.post.call_args.kwargs["data"]["_token"], "fresh token")
+
+    @patch("login._CreateSession")
+    def testLoginSkipsMypageAfterRedirect(self, create_session_mock: MagicMock):
+        session = _FakeSession()
+        create_session_mock.return_value = session
+        session.post.return_value = _Response(
+            login.MYPAGE_URL, history=[_Response(login.LOGIN_URL, status_code=302)]
+        )
+        timings = {}
+
+        login.Login("user", "pass", timings=timings)
+
+        self.assertNotIn(call(login.MYPAGE_URL), session.get.call_args_list)
+        self.assertNotIn("mypage", timings)
+
+    @patch("login._CreateSession")
+    def testLoginFailure(self, create_session_mock: MagicMock):
+        session = _FakeSession()
+        create_session_mock.return_value = session
+        session.post.return_value = _Response(login.LOGIN_URL, status_code=403)
+
+        with self.assertRaises(login.LoginFailureException):
+            login.Login("user", "pass")
+
+    def testCreateSessionRetries(self):
+        session = login._CreateSession()
+        adapter = session.get_adapter(login.LOGIN_URL)
+        self.assertIn(500, adapter.max_retries.status_forcelist)
@@ -1,27 +1,40 @@
 import argparse
+import concurrent.futures
 from dataclasses import dataclass
 from enum import Enum
 import functools
 from http import HTTPStatus
 import logging
 
-import os
-import shutil
 
 import dateparser
+import dedup
+import dir_move
+import disk_plan
+import config_store
 import login
 import pickle
-import pathlib
 import requests
 import sys
 import downloader
 import click_point
+import cleaner
 import all_purchased
 import json
 import dlsite_extract
+import download_queue
 import find_id
-
-from typing import Callable, List, Optional, Set
+import instrument
+import item_lock
+import library_verify
+import manifest
+import metrics
+import profiling
+import progress
+import rate_limit
+import session_pool
+
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 from pathlib import Path
 
@@ -36,17 +49,76 @@ _DEFAULT_CONFIG_DIR = Path.home() / _DEFAULT_CONFIG_DIR_FROM_HOME
 
 _IN_DOWNLOAD_DIR = "downloading"
 
-_RAW_LOGIN_CREDENTAIL_FILE = "login_credential"
+# Under the download dir. Holds a lock file for each item being processed.
+_LOCK_DIR = ".locks"
+
+_RAW_LOGIN_CREDENTAIL_FILE = "login_credential.json"
+
+_MAIN_SESSION_FILE = "session.json"
+
+_DOWNLOAD_QUEUE_FILE = "download_queue.jsonl"
+
+# Items checked by a `verify` run that has not finished yet.
+_VERIFY_JOURNAL_FILE = "verify_progress.jsonl"
+
+# Watched items that `clean` emptied, so that they are not looked into again.
+_CLEANED_ITEMS_FILE = "cleaned_items.json"
+
+# Default number of files that `verify` reads at the same time.
+_DEFAULT_VERIFY_JOBS = 4
+
+# Items whose download sizes are looked up at the same time before planning.
+_SIZE_LOOKUP_JOBS = 4
+
+# Bandwidth schedule used by downloads. Running downloads pick up changes.
+_BANDWIDTH_SCHEDULE_FILE = "bandwidth_schedule"
+
+# Reports of runs with --profile.
+_PROFILE_DIR = "profiles"
+
+# Holds the path of the staging dir for moving items across file systems.
+_STAGING_DIR_CONFIG_FILE = "staging_dir"
+
+# Older versions pickled the credential and cookies. These are read once and
+# converted to the JSON files above.
+_LEGACY_RAW_LOGIN_CREDENTIAL_FILE = "login_credential"
+_LEGACY_MAIN_SESSION_FILE = "main.session"
 
 
 def _SetManagementDir(config_dir: Path, management_dir: Path):
     path = config_dir / _MANAGEMENT_DIR_CONFIG_FILE
-    with open(path, "w") as f:
-        f.write(str(management_dir))
+    with config_store.FileLock(path):
+        config_store.WriteAtomic(path, str(management_dir).encode())
 
     print(f"Changed management directory to {management_dir}")
 
 
+def _SetBandwidthSchedule(config_dir: Path, spec: str):
+    """Saves the bandwidth schedule. Raises ValueError if it is malformed."""
+    rate_limit.Schedule.Parse(spec)
+    path = config_dir / _BANDWIDTH_SCHEDULE_FILE
+    with config_store.FileLock(path):
+        config_store.WriteAtomic(path, spec.encode())
+
+    print(f"Changed bandwidth schedule to {spec}")
+
+
+def _SetStagingDir(config_dir: Path, staging_dir: Path):
+    path = config_dir / _STAGING_DIR_CONFIG_FILE
+    with config_store.FileLock(path):
+        config_store.WriteAtomic(path, str(staging_dir).encode())
+
+    print(f"Changed staging directory to {staging_dir}")
+
+
+def _GetStagingDir(config_dir: Path) -> Optional[Path]:
+    path = config_dir / _STAGING_DIR_CONFIG_FILE
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return Path(f.read())
+
+
 def _GetManagementDir(config_dir: Path) -> Optional[str]:
     path = config_dir / _MANAGEMENT_DIR_CONFIG_FILE
     if not path.exists():
@@ -61,38 +133,115 @@ class RawCredential:
     password: str
 
 
+def _SaveRawCredential(config_dir: Path, credential: RawCredential):
+    config_store.WriteJson(
+        config_dir / _RAW_LOGIN_CREDENTAIL_FILE,
+        {"username": credential.username, "password": credential.password},
+        mode=config_store.PRIVATE_FILE_MODE,
+    )
+
+
+def _MigrateLegacyFile(
+    legacy_file: Path, new_file: Path, convert: Callable[[Path], None]
+):
+    """Converts legacy_file with convert(), unless new_file exists, and deletes it.
+
+    Processes that start at the same time take turns under the lock of
+    legacy_file, so only one of them converts it. A legacy file that is gone by
+    then has been migrated by another process.
+    """
+    if not legacy_file.exists():
+        return
+    with config_store.FileLock(legacy_file):
+        if not legacy_file.exists():
+            return
+        if not new_file.exists():
+            logging.info(f"Converting {legacy_file} to {new_file.name}.")
+            convert(legacy_file)
+        # Even if new_file already existed. The legacy credential file has the
+        # password in it.
+        legacy_file.unlink()
+
+
+def _MigrateLegacyRawCredential(config_dir: Path):
+    def _Convert(legacy_file: Path):
+        with open(legacy_file, "rb") as f:
+            credential: RawCredential = pickle.load(f)
+        _SaveRawCredential(config_dir, credential)
+
+    _MigrateLegacyFile(
+        config_dir / _LEGACY_RAW_LOGIN_CREDENTIAL_FILE,
+        config_dir / _RAW_LOGIN_CREDENTAIL_FILE,
+        _Convert,
+    )
+
+
+def _LoadRawCredential(config_dir: Path) -> Optional[RawCredential]:
+    _MigrateLegacyRawCredential(config_dir)
+    content = config_store.ReadJson(config_dir / _RAW_LOGIN_CREDENTAIL_FILE)
+    if not content:
+        return None
+    return RawCredential(username=content["username"], password=content["password"])
+
+
+def _HasRawCredential(config_dir: Path) -> bool:
+    return (config_dir / _RAW_LOGIN_CREDENTAIL_FILE).exists() or (
+        config_dir / _LEGACY_RAW_LOGIN_CREDENTIAL_FILE
+    ).exists()
+
+
 def _ReloginWithCredential(config_dir: Path) -> Optional[requests.Session]:
-    cred_file = config_dir / _RAW_LOGIN_CREDENTAIL_FILE
-    if not cred_file.exists():
+    credential = _LoadRawCredential(config_dir)
+    if not credential:
         return None
 
-    with open(cred_file, "rb") as f:
-        credential: RawCredential = pickle.load(f)
-    return login.Login(credential.username, credential.password)
+    # The saved cookies let login skip steps that are still valid.
+    try:
+        saved_session = LoadMainSessionFromConfigDir(config_dir)
+    except NoCredentialsException:
+        return login.Login(credential.username, credential.password)
+    return login.Login(
+        credential.username, credential.password, saved_cookies=saved_session.cookies
+    )
+
+
+def _ReloginAndSave(config_dir: Path) -> Optional[requests.Session]:
+    """Relogin with the raw credentials and save the new session on success."""
+    new_session = _ReloginWithCredential(config_dir)
+    if new_session:
+        SaveMainSessionToConfigDir(config_dir, new_session)
+    return new_session
 
 
-def _ReloginOnFailure(config_dir: Path, func: Callable) -> requests.Session | None:
+def _ReloginOnFailure(
+    config_dir: Path, pool: session_pool.SessionPool, func: Callable
+) -> bool:
     """Relogin using raw credentials if there is an authorization failure.
 
     Attempts a relogin using raw credentials saved under the config dir.
-    The credential will be save to the main session file.
+    The credential will be save to the main session file. When several workers
+    fail with the same session, only one of them relogins and the rest wait for
+    it and reuse the new session.
 
     Args:
         config_dir (Path): Config dir with raw credentials.
+        pool (SessionPool): Pool that func uses. Gets the new session.
         func (Callable): Any operation.
 
     Returns:
-        New session when there was a relogin. None otherwise.
+        True when func failed and there is a new session to retry with.
+        False if func succeeded.
     """
+    generation = pool.Generation()
 
-    def _ReloginAndSaveNewSession(config_dir: Path):
+    def _Relogin():
         logging.error("Unauthorized. Trying to relogin.")
-        new_session = _ReloginWithCredential(config_dir)
-        if not new_session:
+        return _ReloginAndSave(config_dir)
+
+    def _ReloginOrRaise():
+        if not pool.Relogin(_Relogin, generation):
             logging.error("Failed to find credential for login.")
             raise
-        SaveMainSessionToConfigDir(config_dir, new_session)
-        return new_session
 
     try:
         func()
@@ -100,11 +249,27 @@ def _ReloginOnFailure(config_dir: Path, func: Callable) -> requests.Session | No
         if e.response.status_code != HTTPStatus.UNAUTHORIZED:
             logging.error("Something wrong happened in HTTP request.")
             raise
-        return _ReloginAndSaveNewSession(config_dir)
+        _ReloginOrRaise()
     except downloader.HttpUnauthorizeException:
-        return _ReloginAndSaveNewSession(config_dir)
+        _ReloginOrRaise()
     else:
-        return None
+        return False
+    return True
+
+
+def _EnsureFreshSession(config_dir: Path, pool: session_pool.SessionPool):
+    """Relogins before a batch if the session is about to expire or rejected.
+
+    This costs one small request, which is cheaper than failing the first
+    item of a long batch.
+    """
+    if not _HasRawCredential(config_dir):
+        return
+    if not pool.NeedsRefresh() and pool.IsValid():
+        return
+    logging.info("Session is expired or about to expire. Relogging in.")
+    if not pool.Relogin(lambda: _ReloginAndSave(config_dir), pool.Generation()):
+        logging.warning("Failed to relogin. Continuing with the saved session.")
 
 
 # TODO: Add a relogin message in the exception or handle where its called.
@@ -132,87 +297,538 @@ def UsingMainSession(config_dir: Path):
 
 
 def LoadSessionFromFile(session_file: Path) -> requests.Session:
-    if not session_file.is_file():
+    serialized_cookies = config_store.ReadJson(session_file)
+    if serialized_cookies is None:
         raise NoCredentialsException()
-    with open(session_file, "rb") as f:
-        session = requests.Session()
-        session.cookies.update(pickle.load(f))
-        return session
+    session = requests.Session()
+    session.cookies.update(config_store.CookiesFromJson(serialized_cookies))
+    return session
+
+
+def _MigrateLegacyMainSession(config_dir: Path):
+    def _Convert(legacy_file: Path):
+        with open(legacy_file, "rb") as f:
+            session = requests.Session()
+            session.cookies.update(pickle.load(f))
+        SaveMainSessionToConfigDir(config_dir, session)
+
+    _MigrateLegacyFile(
+        config_dir / _LEGACY_MAIN_SESSION_FILE,
+        config_dir / _MAIN_SESSION_FILE,
+        _Convert,
+    )
 
 
 def LoadMainSessionFromConfigDir(config_dir: Path):
-    session_file = config_dir / "main.session"
+    _MigrateLegacyMainSession(config_dir)
+    session_file = config_dir / _MAIN_SESSION_FILE
     return LoadSessionFromFile(session_file)
 
 
 def SaveMainSessionToConfigDir(config_dir: Path, session: requests.Session):
-    session_file = config_dir / "main.session"
-    logging.debug("Saving session to file.")
-    with open(session_file, "wb") as f:
-        pickle.dump(session.cookies, f)
+    """Saves the cookies of the session, only if they changed."""
+    session_file = config_dir / _MAIN_SESSION_FILE
+    if config_store.WriteJson(
+        session_file,
+        config_store.CookiesToJson(session.cookies),
+        mode=config_store.PRIVATE_FILE_MODE,
+    ):
+        logging.debug("Saved session to file.")
+
+
+# Queue states where only extraction is left for the item.
+_DOWNLOAD_FINISHED_STATES = {
+    download_queue.ItemState.DOWNLOADED,
+    download_queue.ItemState.EXTRACTING,
+}
+
+
+def _ItemIdFromDirName(dir_name: str) -> str:
+    # Directories are named "<item ID> <work name>" or just "<item ID>".
+    return dir_name.split(" ", 1)[0]
+
+
+def _LeftoverArchiveDirs(
+    in_download_dir: Path,
+    item_filter: Optional[Callable[[str], bool]],
+    queue: Optional[download_queue.DownloadQueue] = None,
+) -> Set[Path]:
+    """Directories whose extraction was interrupted, e.g. by a crash.
+
+    Only directories of items that were downloaded here count: the item has
+    an archive manifest or a queue entry, or its files were already recorded
+    in an item manifest. Other directories, e.g. of the user, are left alone.
+    """
+    leftovers = set()
+    for entry in in_download_dir.iterdir():
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        item_id = _ItemIdFromDirName(entry.name)
+        if find_id.MatchItemId(item_id) != item_id:
+            continue
+        if not (
+            manifest.ArchiveManifestPath(in_download_dir, item_id).exists()
+            or (entry / manifest.MANIFEST_FILE).exists()
+            or (queue and queue.Get(item_id))
+        ):
+            continue
+        if item_filter and not item_filter(item_id):
+            continue
+        leftovers.add(entry)
+    return leftovers
+
+
+def _HasDownloadedArchives(in_download_dir: Path, item_id: str) -> bool:
+    """Whether the archives recorded while downloading the item are still there.
+
+    They are either in the download dir or, once extraction started, in the
+    directory of the item in it.
+    """
+    archive_manifest = manifest.Manifest.Load(
+        manifest.ArchiveManifestPath(in_download_dir, item_id)
+    )
+    if not archive_manifest or not archive_manifest.files:
+        return False
+    dirs = [
+        in_download_dir,
+        *_LeftoverArchiveDirs(in_download_dir, lambda i: i == item_id),
+    ]
+    return all(
+        any((d / f.path).is_file() for d in dirs) for f in archive_manifest.files
+    )
+
+
+def _ArchivesRemovedAfterExtraction(
+    in_download_dir: Path, archive_dir: Path, item_id: str
+) -> bool:
+    """Whether the archives were extracted and removed, e.g. before a crash.
+
+    Only the extracted files are left in archive_dir then.
+    """
+    archive_manifest = manifest.Manifest.Load(
+        manifest.ArchiveManifestPath(in_download_dir, item_id)
+    )
+    if not archive_manifest or not archive_manifest.files:
+        return False
+    return not any((archive_dir / f.path).exists() for f in archive_manifest.files)
+
+
+def _CheckArchives(in_download_dir: Path, archive_dir: Path, item_id: str) -> List[str]:
+    """Checks the archives against the manifest recorded while downloading.
+
+    Returns:
+        A description of each problem. Empty if the archives look fine.
+    """
+    archive_manifest = manifest.Manifest.Load(
+        manifest.ArchiveManifestPath(in_download_dir, item_id)
+    )
+    if not archive_manifest:
+        logging.info(f"No archive manifest for {item_id}. Not checking.")
+        return []
+
+    problems = manifest.CheckSizes(archive_dir, archive_manifest.files)
+    for f in archive_manifest.files:
+        path = archive_dir / f.path
+        if path.exists() and not dlsite_extract.IsReadableArchive(path):
+            problems.append(f"{f.path} is not a valid archive.")
+    return problems
+
+
+def _WriteItemManifest(in_download_dir: Path, item_dir: Path, item_id: str):
+    """Records the extracted files so that they can be verified later."""
+    archive_manifest_path = manifest.ArchiveManifestPath(in_download_dir, item_id)
+    item_manifest = manifest.Create(item_dir, item_id)
+    archive_manifest = manifest.Manifest.Load(archive_manifest_path)
+    if archive_manifest:
+        item_manifest.archives = archive_manifest.files
+    item_manifest.Save(item_dir / manifest.MANIFEST_FILE)
+    archive_manifest_path.unlink(missing_ok=True)
+
+
+def _UnarchiveItem(
+    in_download_dir: Path,
+    new_dir: Path,
+    item_id: str,
+    keep_archive: bool,
+    queue: Optional[download_queue.DownloadQueue],
+) -> bool:
+    """Checks and extracts the archives in new_dir. Reports failures."""
+    problems = _CheckArchives(in_download_dir, new_dir, item_id)
+    if problems:
+        progress.Emit(
+            progress.ERROR,
+            item_id=item_id,
+            message=f"Archives of {item_id} are broken: {' '.join(problems)}",
+        )
+        if queue:
+            queue.Update(
+                item_id,
+                download_queue.ItemState.FAILED,
+                error="archive check failed",
+            )
+        return False
+
+    progress.Emit(
+        progress.EXTRACT_STARTED,
+        item_id=item_id,
+        message=f"Extracting files in: {new_dir}",
+    )
+    if not dlsite_extract.Unarchive(new_dir, keep_archive):
+        progress.Emit(
+            progress.ERROR,
+            item_id=item_id,
+            message=f"Failed to extract {new_dir}. Leaving it for a retry.",
+        )
+        if queue:
+            queue.Update(
+                item_id, download_queue.ItemState.FAILED, error="extract failed"
+            )
+        return False
+    return True
 
 
-def Extract(in_download_dir: Path, management_dir: Path, keep_archive: bool):
-    new_directories = dlsite_extract.CreateArchivesDirs(in_download_dir)
+def Extract(
+    in_download_dir: Path,
+    management_dir: Path,
+    keep_archive: bool,
+    locks: Optional[item_lock.ItemLocks] = None,
+    queue: Optional[download_queue.DownloadQueue] = None,
+    staging_dir: Optional[Path] = None,
+):
+    """Extracts the archives in the download dir and moves them to management dir.
+
+    Directories left in the download dir by an interrupted extraction are
+    extracted again too.
+
+    Args:
+        locks: If specified, only the items whose locks are held or can be
+            taken are extracted. Items that another process is working on are
+            left alone.
+        queue: If specified, the state of each item is recorded in it.
+        staging_dir: Where the items are copied first if the download dir is
+            on another file system than the management dir. See
+            dir_move.MoveDir().
+    """
+    item_filter = None
+    if locks:
+        item_filter = locks.TryAcquire
+    new_directories = dlsite_extract.CreateArchivesDirs(in_download_dir, item_filter)
+    new_directories = set(new_directories) | _LeftoverArchiveDirs(
+        in_download_dir, item_filter, queue
+    )
     for new_dir in new_directories:
-        print(f"Extracting files in: {new_dir}")
-        dlsite_extract.Unarchive(new_dir, keep_archive)
+        item_id = _ItemIdFromDirName(new_dir.name)
+        if queue:
+            queue.Update(item_id, download_queue.ItemState.EXTRACTING)
+
+        if _ArchivesRemovedAfterExtraction(in_download_dir, new_dir, item_id):
+            # Only the extracted files are left. Extracting again would take
+            # one of them for an archive.
+            progress.Message(f"{new_dir} is already extracted.", item_id)
+        elif not _UnarchiveItem(in_download_dir, new_dir, item_id, keep_archive, queue):
+            continue
+        _WriteItemManifest(in_download_dir, new_dir, item_id)
 
-        print(f"Moving {new_dir} to {management_dir}")
+        progress.Message(f"Moving {new_dir} to {management_dir}", item_id)
 
-        # Before moving the directory, check whether the same name directory
-        # exists. If so delete it then move. This only really happens when
+        # The same name directory is replaced. This only really happens when
         # using the 'force' flag so, it is safe to do so (for now).
         move_destination_dir = management_dir / new_dir.name
-
         if move_destination_dir.exists():
-            print(f"{management_dir} exists. Removing before move.")
-            shutil.rmtree(move_destination_dir)
+            progress.Message(f"{move_destination_dir} exists. Replacing it.", item_id)
+
+        with instrument.Span("extract.move"):
+            try:
+                dir_move.MoveDir(new_dir, management_dir, staging_dir)
+            except dir_move.MoveError as e:
+                progress.Emit(progress.ERROR, item_id=item_id, message=str(e))
+                if queue:
+                    queue.Update(
+                        item_id, download_queue.ItemState.FAILED, error="move failed"
+                    )
+                continue
+        instrument.Count("extract.items")
+        progress.Emit(progress.EXTRACT_FINISHED, item_id=item_id)
+        if queue:
+            queue.Update(item_id, download_queue.ItemState.DONE)
+
+
+def _PlanBatches(
+    dl: downloader.Downloader,
+    config_dir: Path,
+    pool: session_pool.SessionPool,
+    items_to_download: Set[str],
+    management_dir: Path,
+    in_download_dir: Path,
+    extract: bool,
+    keep_archive: bool,
+) -> Tuple[List[Set[str]], Dict[str, List[downloader.RemoteFile]]]:
+    """Splits the items into batches that fit in the free disk space.
+
+    The files of the items are resolved in parallel to get their sizes. Items
+    that do not fit at all, and items whose size is not known, are left out.
+
+    Returns:
+        The batches, and the resolved files of each item to pass to
+        Downloader.DownloadTo().
+    """
+
+    def _Resolve(item_id: str) -> Optional[List[downloader.RemoteFile]]:
+        files = None
+
+        def _GetFiles():
+            nonlocal files
+            files = dl.ResolveFiles(item_id)
 
-        # Want to move to management_dir here because new_dir is the directory
-        # name.
-        shutil.move(new_dir, management_dir)
+        try:
+            if _ReloginOnFailure(config_dir, pool, _GetFiles):
+                _GetFiles()
+        except downloader.HttpUnauthorizeException:
+            raise
+        except Exception as e:
+            progress.Emit(
+                progress.ERROR,
+                item_id=item_id,
+                message=f"Skipping {item_id}. Could not get its download size: {e}",
+            )
+        return files
+
+    item_ids = sorted(items_to_download)
+    with concurrent.futures.ThreadPoolExecutor(_SIZE_LOOKUP_JOBS) as executor:
+        resolved = {
+            item_id: files
+            for item_id, files in zip(item_ids, executor.map(_Resolve, item_ids))
+            if files is not None
+        }
+    sizes = [
+        disk_plan.ItemSize(item_id, sum(f.size for f in files))
+        for item_id, files in resolved.items()
+    ]
+
+    free_download = disk_plan.FreeBytes(in_download_dir)
+    free_management = disk_plan.FreeBytes(management_dir)
+    plan = disk_plan.MakePlan(
+        sizes,
+        free_download,
+        free_management,
+        disk_plan.SameFileSystem(in_download_dir, management_dir),
+        extract,
+        keep_archive,
+    )
+    total = sum(s.download_bytes for s in sizes)
+    progress.Message(
+        f"Downloading {total:,} bytes. {free_download:,} bytes are free in "
+        f"{in_download_dir}, {free_management:,} bytes in {management_dir}."
+    )
+    for item in plan.too_large:
+        progress.Emit(
+            progress.ERROR,
+            item_id=item.item_id,
+            message=f"Skipping {item.item_id}. {item.download_bytes:,} bytes do "
+            "not fit in the free space.",
+        )
+    return plan.batches, resolved
 
 
 def Download(
-    session: requests.Session,
+    session: requests.Session | session_pool.SessionPool,
     config_dir: Path,
     management_dir: str,
     items_to_download: Set[str],
     extract: bool,
     keep_archive: bool,
+    skip_downloaded: bool = False,
+    queue: Optional[download_queue.DownloadQueue] = None,
+    continue_on_error: bool = False,
+    bandwidth: Optional[rate_limit.Schedule] = None,
+    plan_disk_space: bool = False,
 ):
-    dl = downloader.Downloader(session)
+    """Downloads the items and optionally extracts them.
+
+    Each item is locked while it is downloaded and extracted, so concurrent
+    runs sharing the management dir split the items between them instead of
+    downloading the same item twice.
+
+    Args:
+        skip_downloaded: Check again right before downloading whether the item
+            is already in the management dir. Another run may have finished
+            it in the meantime.
+        queue: If specified, the progress of each item is recorded in it so
+            that an interrupted run can be resumed. Items that it says are
+            already downloaded are not downloaded again.
+        continue_on_error: Skip items that fail to download instead of
+            stopping the whole batch. Authorization failures still stop it.
+        bandwidth: Bandwidth schedule for this run. If not specified, the
+            schedule saved in the config dir is used and re-read when it
+            changes.
+        plan_disk_space: Check the download sizes against the free space
+            first. The items are then downloaded in batches that fit, and each
+            batch is extracted before the next one. Items that do not fit at
+            all are skipped.
+    """
+    pool = session
+    if not isinstance(pool, session_pool.SessionPool):
+        pool = session_pool.SessionPool(session)
+    if bandwidth:
+        limiter = rate_limit.ScheduledLimiter(schedule=bandwidth)
+    else:
+        limiter = rate_limit.ScheduledLimiter(
+            schedule_file=config_dir / _BANDWIDTH_SCHEDULE_FILE
+        )
+    dl = downloader.Downloader(pool, limiter)
     in_download_dir = Path(management_dir) / _IN_DOWNLOAD_DIR
     in_download_dir.mkdir(exist_ok=True)
 
     _RELOGIN_THRESHOLD = 5
     num_relogins = 0
 
-    while len(items_to_download) > 0:
-        downloaded_items = set()
-        for item_id in items_to_download:
-
-            def _DownloadAndMark():
-                dl.DownloadTo(item_id, in_download_dir)
-                downloaded_items.add(item_id)
-
-            if new_session := _ReloginOnFailure(config_dir, _DownloadAndMark):
-                num_relogins += 1
-                dl.session = new_session
-
-            if num_relogins >= _RELOGIN_THRESHOLD:
-                print(
-                    f"Tried relogin {num_relogins} times but still failing. Terminating."
+    if _HasRawCredential(config_dir):
+        pool.StartBackgroundRefresh(lambda: _ReloginAndSave(config_dir))
+
+    with item_lock.ItemLocks(in_download_dir / _LOCK_DIR) as locks:
+        try:
+            batches = [items_to_download]
+            resolved: Dict[str, List[downloader.RemoteFile]] = {}
+            if plan_disk_space:
+                batches, resolved = _PlanBatches(
+                    dl,
+                    config_dir,
+                    pool,
+                    items_to_download,
+                    Path(management_dir),
+                    in_download_dir,
+                    extract,
+                    keep_archive,
                 )
-                return
-
-        items_to_download -= downloaded_items
-
-    SaveMainSessionToConfigDir(config_dir, dl.session)
-
-    if extract:
-        Extract(in_download_dir, Path(management_dir), keep_archive)
+            for index, batch in enumerate(batches):
+                if index > 0 and extract:
+                    # Frees the space of the previous batch.
+                    Extract(
+                        in_download_dir,
+                        Path(management_dir),
+                        keep_archive,
+                        locks,
+                        queue,
+                        _GetStagingDir(config_dir),
+                    )
+                if len(batches) > 1:
+                    progress.Message(
+                        f"Batch {index + 1}/{len(batches)}: {len(batch)} items."
+                    )
+                items_to_download = set(batch)
+                while len(items_to_download) > 0:
+                    done_items = set()
+                    for item_id in items_to_download:
+                        instrument.SetGauge(
+                            "download.queue_depth",
+                            len(items_to_download) - len(done_items),
+                        )
+                        if not locks.Holds(item_id):
+                            if not locks.TryAcquire(item_id):
+                                progress.Message(
+                                    f"Skipping {item_id}. Another process has it.",
+                                    item_id,
+                                )
+                                done_items.add(item_id)
+                                continue
+                            if skip_downloaded and find_id.FindItems(
+                                management_dir, {item_id}
+                            ):
+                                progress.Message(
+                                    f"Skipping {item_id}. Already downloaded.",
+                                    item_id,
+                                )
+                                locks.Release(item_id)
+                                done_items.add(item_id)
+                                if queue:
+                                    queue.Update(item_id, download_queue.ItemState.DONE)
+                                continue
+
+                        if queue and (entry := queue.Get(item_id)):
+                            if entry.state in _DOWNLOAD_FINISHED_STATES:
+                                if _HasDownloadedArchives(in_download_dir, item_id):
+                                    done_items.add(item_id)
+                                    continue
+                                logging.info(
+                                    f"Archives of {item_id} are gone. "
+                                    "Downloading it again."
+                                )
+                                queue.Update(item_id, download_queue.ItemState.QUEUED)
+
+                        def _OnPart(part: int, num_parts: int):
+                            if queue:
+                                queue.Update(
+                                    item_id,
+                                    download_queue.ItemState.DOWNLOADING,
+                                    part=part,
+                                    num_parts=num_parts,
+                                )
+
+                        def _DownloadAndMark():
+                            if queue:
+                                queue.Update(
+                                    item_id, download_queue.ItemState.RESOLVING
+                                )
+                            with instrument.Span("download.item"):
+                                # A retry, e.g. after a relogin, resolves again.
+                                dl.DownloadTo(
+                                    item_id,
+                                    in_download_dir,
+                                    on_part=_OnPart,
+                                    files=resolved.pop(item_id, None),
+                                )
+                            instrument.Count("download.items")
+                            done_items.add(item_id)
+                            if queue:
+                                queue.Update(
+                                    item_id, download_queue.ItemState.DOWNLOADED
+                                )
+
+                        try:
+                            if _ReloginOnFailure(config_dir, pool, _DownloadAndMark):
+                                num_relogins += 1
+                        except Exception as e:
+                            if queue:
+                                queue.Update(
+                                    item_id,
+                                    download_queue.ItemState.FAILED,
+                                    error=str(e),
+                                )
+                            if not continue_on_error or isinstance(
+                                e, downloader.HttpUnauthorizeException
+                            ):
+                                raise
+                            progress.Emit(
+                                progress.ERROR,
+                                item_id=item_id,
+                                message=f"Failed to download {item_id}: {e}",
+                            )
+                            locks.Release(item_id)
+                            done_items.add(item_id)
+
+                        if num_relogins >= _RELOGIN_THRESHOLD:
+                            progress.Emit(
+                                progress.ERROR,
+                                message=f"Tried relogin {num_relogins} times but "
+                                "still failing. Terminating.",
+                            )
+                            return
+
+                    items_to_download -= done_items
+        finally:
+            pool.StopBackgroundRefresh()
+
+        SaveMainSessionToConfigDir(config_dir, pool.MainSession())
+
+        if extract:
+            Extract(
+                in_download_dir,
+                Path(management_dir),
+                keep_archive,
+                locks,
+                queue,
+                _GetStagingDir(config_dir),
+            )
 
 
 def MakeItemIdsSet(items_to_download: List[str]) -> Set[str]:
@@ -242,6 +858,9 @@ def _DownloadSubcommand(
     force: bool,
     extract: bool,
     keep_extracted_archive: bool,
+    resume_queue: bool = False,
+    bandwidth: Optional[rate_limit.Schedule] = None,
+    plan_disk_space: bool = True,
 ):
     management_dir = _GetManagementDir(config_dir)
     if not management_dir:
@@ -251,24 +870,50 @@ def _DownloadSubcommand(
         )
         sys.exit(1)
 
-    item_ids = MakeItemIdsSet(items)
+    queue = download_queue.DownloadQueue(config_dir / _DOWNLOAD_QUEUE_FILE)
+    requested_item_ids = MakeItemIdsSet(items)
+    item_ids = set(requested_item_ids)
+    if resume_queue:
+        pending = [entry.item_id for entry in queue.Pending()]
+        progress.Message(f"Resuming {len(pending)} items from the queue.")
+        item_ids |= set(pending)
+
+    if not item_ids:
+        progress.Message("Nothing to download.")
+        return
+
     if force:
         items_to_download = set(item_ids)
     else:
         items_to_download = find_id.CheckAleadyDownloaded(item_ids, management_dir)
-
-    session = LoadMainSessionFromConfigDir(config_dir)
+        for item_id in item_ids - items_to_download:
+            if queue.Get(item_id):
+                queue.Update(item_id, download_queue.ItemState.DONE)
+    # Items asked for again start over. Only resumed items keep their state.
+    reset_item_ids = items_to_download if force else requested_item_ids
+    queue.Add(items_to_download - reset_item_ids)
+    queue.Add(items_to_download & reset_item_ids, reset=True)
+
+    pool = session_pool.SessionPool(LoadMainSessionFromConfigDir(config_dir))
+    _EnsureFreshSession(config_dir, pool)
     try:
         Download(
-            session,
+            pool,
             config_dir,
             management_dir,
             items_to_download,
             extract,
             keep_extracted_archive,
+            skip_downloaded=not force,
+            queue=queue,
+            bandwidth=bandwidth,
+            plan_disk_space=plan_disk_space,
         )
     except downloader.HttpUnauthorizeException:
-        print("Unauthorized download. Try relogin and see if it gets fixed.")
+        progress.Emit(
+            progress.ERROR,
+            message="Unauthorized download. Try relogin and see if it gets fixed.",
+        )
         return
 
 
@@ -279,6 +924,9 @@ def _DownloadHandler(args):
         args.force,
         args.extract,
         args.keep_extracted_archive,
+        args.resume_queue,
+        args.bandwidth,
+        not args.no_space_check,
     )
 
 
@@ -288,12 +936,26 @@ def _ConfigSubcommand(
     username: Optional[str],
     password: Optional[str],
     save_raw_credentials: bool,
+    bandwidth: Optional[str] = None,
+    staging_dir: Optional[Path] = None,
 ) -> bool:
     config_dir.mkdir(parents=True, exist_ok=True)
     if management_dir:
         _SetManagementDir(config_dir, management_dir)
         return True
 
+    if staging_dir:
+        _SetStagingDir(config_dir, staging_dir)
+        return True
+
+    if bandwidth is not None:
+        try:
+            _SetBandwidthSchedule(config_dir, bandwidth)
+        except ValueError as e:
+            print(f"Invalid bandwidth schedule {bandwidth}: {e}")
+            return False
+        return True
+
     if not (username and password):
         print("Username and password are required for login.")
         return False
@@ -305,10 +967,7 @@ def _ConfigSubcommand(
     if not save_raw_credentials:
         return True
 
-    raw_credential_file = config_dir / _RAW_LOGIN_CREDENTAIL_FILE
-    with open(raw_credential_file, "wb") as f:
-        creds = RawCredential(username=username, password=password)
-        pickle.dump(creds, f)
+    _SaveRawCredential(config_dir, RawCredential(username=username, password=password))
 
     return True
 
@@ -320,35 +979,11 @@ def _ConfigHandler(args):
         args.username,
         args.password,
         not args.no_save_raw_credential,
+        args.bandwidth,
+        args.staging_dir,
     )
 
 
-# There is a race condition in python until 3.13. See https://stackoverflow.com/a/70549000.
-# Until then, thsi shoulw be passed to shutil.rmtree.
-def ignore_extended_attributes(func, filename, exc_info):
-    is_meta_file = os.path.basename(filename).startswith("._")
-    if not (func is os.unlink and is_meta_file):
-        raise
-
-
-def _RemoveFilesInDir(directory: pathlib.Path):
-    with os.scandir(directory) as entries:
-        for entry in entries:
-            if entry.is_dir() and not entry.is_symlink():
-                shutil.rmtree(entry.path, onerror=ignore_extended_attributes)
-            else:
-                try:
-                    os.remove(entry.path)
-                except FileNotFoundError as e:
-                    is_meta_file = os.path.basename(entry.name).startswith("._")
-                    if is_meta_file:
-                        # Same as shutil.rmtree, if it starts with "._" but a race condition fails
-                        # to remove it, then ignore.
-                        continue
-                    else:
-                        raise e
-
-
 def _CleanSubcommand(args):
     management_dir = _GetManagementDir(args.config_dir)
     if not management_dir:
@@ -359,16 +994,35 @@ def _CleanSubcommand(args):
         sys.exit(1)
 
     watched_items = find_id.GetAllWatchedItems(management_dir)
+    record = cleaner.CleanedRecord(args.config_dir / _CLEANED_ITEMS_FILE)
     paths_to_be_removed: List[Path] = []
+    reclaimable = cleaner.RemoveStats()
+    num_clean = 0
     for item in watched_items:
-        # TODO: Check whether there are files in the directory. Otherwise
-        # the same list of tiles are reprintted every time clean command is run.
         if item.prefix:
             print(f"SKIP: {item.directory} which is prefixed with {item.prefix}.")
             continue
 
-        print(f"DELETE: {item.directory}.")
+        if record.IsClean(item.directory):
+            num_clean += 1
+            continue
+        if cleaner.IsEmpty(item.directory):
+            record.MarkClean(item.directory)
+            num_clean += 1
+            continue
+
+        contents = cleaner.MeasureContents(item.directory)
+        reclaimable.Add(contents)
+        print(f"DELETE: {item.directory}. {contents.bytes:,} bytes.")
         paths_to_be_removed.append(item.directory)
+    record.Save()
+
+    print(
+        f"{len(paths_to_be_removed)} items hold {reclaimable.bytes:,} bytes in "
+        f"{reclaimable.files:,} files. {num_clean} items are already clean."
+    )
+    if not paths_to_be_removed:
+        return
 
     if args.dryrun:
         print("Dryrun complete. No files are deleted.")
@@ -385,8 +1039,18 @@ def _CleanSubcommand(args):
             print("Aborting.")
             return
 
+    stats = cleaner.RemoveContentsOfAll(paths_to_be_removed, args.jobs)
+    print(
+        f"Freed {stats.bytes:,} bytes in {stats.files:,} files "
+        f"from {stats.items} items."
+    )
+    if stats.failed_items:
+        print(f"Failed to clean {stats.failed_items} items.")
+
     for p in paths_to_be_removed:
-        _RemoveFilesInDir(p)
+        if cleaner.IsEmpty(p):
+            record.MarkClean(p)
+    record.Save()
 
 
 def _FindSubcommand(args):
@@ -400,23 +1064,30 @@ def _FindSubcommand(args):
         print(f"{item.item_id}: {item.directory} prefix:{item.prefix}")
 
 
-def _PurchasedHandler(args):
-    session = LoadMainSessionFromConfigDir(args.config_dir)
+def _GetAllPurchases(config_dir: Path, pool: session_pool.SessionPool) -> List[Dict]:
+    """Gets all purchases, relogging in once if the session is rejected."""
+    _EnsureFreshSession(config_dir, pool)
     purchases = []
 
     def _GetAll():
         nonlocal purchases
-        purchases = all_purchased.GetAllPurchases(session)
+        purchases = all_purchased.GetAllPurchases(pool)
 
     _MAX_RETRIES = 1
-    for _ in range(_MAX_RETRIES):
-        if new_session := _ReloginOnFailure(args.config_dir, _GetAll):
-            session = new_session
-        else:
+    for _ in range(_MAX_RETRIES + 1):
+        if not _ReloginOnFailure(config_dir, pool, _GetAll):
             break
 
-    SaveMainSessionToConfigDir(args.config_dir, session)
+    SaveMainSessionToConfigDir(config_dir, pool.MainSession())
+    return purchases
 
+
+def _PurchasedHandler(args):
+    pool = session_pool.SessionPool(
+        LoadMainSessionFromConfigDir(args.config_dir),
+        all_purchased.MAX_SIMULTANEOUS_CONNECTIONS,
+    )
+    purchases = _GetAllPurchases(args.config_dir, pool)
     if not purchases:
         return
 
@@ -446,11 +1117,166 @@ def _PurchasedHandler(args):
             json.dump(purchases, f)
 
 
+def _MissingItemIds(purchases: Iterable[Dict], library: find_id.Items) -> Iterator[str]:
+    """Yields the IDs of purchases that are not in the library."""
+    for purchase in purchases:
+        item_id = purchase["workno"]
+        if not library.Find(item_id):
+            yield item_id
+
+
+def _SyncSubcommand(args):
+    management_dir = _GetManagementDir(args.config_dir)
+    if not management_dir:
+        print(
+            "Management dir is not specified. Specify the management dir "
+            "with `config` first."
+        )
+        sys.exit(1)
+
+    pool = session_pool.SessionPool(
+        LoadMainSessionFromConfigDir(args.config_dir),
+        all_purchased.MAX_SIMULTANEOUS_CONNECTIONS,
+    )
+    purchases = all_purchased.FilterPurchases(
+        _GetAllPurchases(args.config_dir, pool),
+        age_categories=args.age,
+        work_types=args.work_type,
+        max_size=args.max_size,
+    )
+    library = find_id.GetItemsInDir(management_dir)
+    items_to_download = set(_MissingItemIds(purchases, library))
+
+    progress.Message(f"{len(items_to_download)} purchased items are not downloaded.")
+    if args.dryrun:
+        print(" ".join(sorted(items_to_download)))
+        return
+    if not items_to_download:
+        return
+
+    queue = download_queue.DownloadQueue(args.config_dir / _DOWNLOAD_QUEUE_FILE)
+    queue.Add(items_to_download)
+    try:
+        Download(
+            pool,
+            args.config_dir,
+            management_dir,
+            items_to_download,
+            args.extract,
+            args.keep_extracted_archive,
+            skip_downloaded=True,
+            queue=queue,
+            continue_on_error=True,
+            bandwidth=args.bandwidth,
+            plan_disk_space=not args.no_space_check,
+        )
+    except downloader.HttpUnauthorizeException:
+        progress.Emit(
+            progress.ERROR,
+            message="Unauthorized download. Try relogin and see if it gets fixed.",
+        )
+
+
+def _VerifySubcommand(args):
+    management_dir = _GetManagementDir(args.config_dir)
+    if not management_dir:
+        print(
+            "Management dir is not specified. Specify the management dir "
+            "with `config` first."
+        )
+        sys.exit(1)
+
+    journal_path = args.config_dir / _VERIFY_JOURNAL_FILE
+    if args.restart:
+        journal_path.unlink(missing_ok=True)
+
+    items = find_id.GetItemsInDir(management_dir).GetItemsAsList()
+    mode = library_verify.Mode.DEEP if args.deep else library_verify.Mode.FAST
+    results = library_verify.VerifyItems(items, mode, args.jobs, journal_path)
+
+    broken = [r for r in results if r.problems]
+    for result in broken:
+        problems = "".join(f"\n  {problem}" for problem in result.problems)
+        progress.Emit(
+            progress.ERROR,
+            item_id=result.item.item_id,
+            message=f"{result.item.directory}:{problems}",
+        )
+
+    num_skipped = sum(1 for r in results if r.skipped)
+    num_without_manifest = sum(1 for r in results if r.problems is None)
+    num_ok = len(results) - len(broken) - num_skipped - num_without_manifest
+    progress.Message(
+        f"{num_ok} items OK, {len(broken)} broken, "
+        f"{num_without_manifest} without a manifest, "
+        f"{num_skipped} already verified by the previous run."
+    )
+    if broken:
+        sys.exit(1)
+
+
+def _DedupSubcommand(args):
+    management_dir = _GetManagementDir(args.config_dir)
+    if not management_dir:
+        print(
+            "Management dir is not specified. Specify the management dir "
+            "with `config` first."
+        )
+        sys.exit(1)
+
+    roots = find_id.GetAllItemPaths(management_dir)
+    groups = dedup.FindDuplicates(roots, args.jobs)
+    for group in groups:
+        print(f"{group.size:,} bytes x {len(group.paths)}:")
+        for path in group.paths:
+            print(f"  {path}")
+
+    reclaimable = sum(g.ReclaimableBytes() for g in groups)
+    print(f"{len(groups)} sets of duplicates. {reclaimable:,} bytes can be reclaimed.")
+    if args.dryrun or not groups:
+        return
+
+    if not args.yes:
+        yes_no = input(
+            f"\n\nContinuing will replace the duplicates above with {args.method.value} "
+            "links to the first file of each set. "
+            "Continue? "
+            "[Y/n]:"
+        )
+        if not yes_no in ["yes", "Y"]:
+            print("Aborting.")
+            return
+
+    reclaimed, num_failures = dedup.Deduplicate(groups, args.method, roots)
+    print(f"Reclaimed {reclaimed:,} bytes.")
+    if num_failures:
+        print(f"Failed to replace {num_failures} files.")
+
+
 def _PointsHandler(args):
     with UsingMainSession(args.config_dir) as session:
         click_point.ClickForPoints(session)
 
 
+def _AddBandwidthArgument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--bandwidth",
+        type=rate_limit.Schedule.Parse,
+        help="Bandwidth schedule for this run, e.g. 5M or "
+        '"09:00-18:00=5M,18:00-22:00=20M". Overrides the one set with config.',
+    )
+
+
+def _AddSpaceCheckArgument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--no-space-check",
+        action="store_true",
+        default=False,
+        help="Do not check the download sizes against the free disk space. "
+        "By default, items are downloaded and extracted in batches that fit.",
+    )
+
+
 # All the flags for this script is not final. It might change to use commands
 # e.g. config, download, etc., instead of specifying with '--' prefixed flags.
 def _ParseArgs(arg_array):
@@ -467,10 +1293,10 @@ def _ParseArgs(arg_array):
     """
     parser = argparse.ArgumentParser()
 
-    subparsers = parser.add_subparsers()
+    subparsers = parser.add_subparsers(dest="command")
 
     parser_dl = subparsers.add_parser("download", help="see `download -h`")
-    parser_dl.add_argument("items", nargs="+")
+    parser_dl.add_argument("items", nargs="*")
     parser_dl.add_argument(
         "-f",
         "--force",
@@ -492,6 +1318,15 @@ def _ParseArgs(arg_array):
         "Set to false to keep the archives after extraction. "
         "This flag is only meaningful with the extract flag.",
     )
+    parser_dl.add_argument(
+        "--resume-queue",
+        action="store_true",
+        default=False,
+        help="Also download the items left unfinished by previous runs. "
+        "Partially downloaded files are resumed.",
+    )
+    _AddBandwidthArgument(parser_dl)
+    _AddSpaceCheckArgument(parser_dl)
     parser_dl.set_defaults(handler=_DownloadHandler)
 
     parser_config = subparsers.add_parser("config", help="see config -h")
@@ -512,6 +1347,21 @@ def _ParseArgs(arg_array):
             "a file. The session (cookie) would still be saved."
         ),
     )
+    parser_config.add_argument(
+        "--bandwidth",
+        help="Saves the bandwidth schedule for downloads, e.g. "
+        '"09:00-18:00=5M" limits to 5MB/s during the day and does not limit '
+        'otherwise. "unlimited" removes the limit. '
+        "Downloads that are running pick up the change.",
+    )
+    parser_config.add_argument(
+        "--staging-dir",
+        type=Path,
+        help="Where extracted items are copied first when the download dir "
+        "is on another file system than the management dir. It should be on "
+        "the management dir's file system. Defaults to "
+        f"{dir_move.DEFAULT_STAGING_DIR_NAME} in the management dir.",
+    )
     parser_config.set_defaults(handler=_ConfigHandler)
 
     parser_clean = subparsers.add_parser("clean")
@@ -529,6 +1379,13 @@ def _ParseArgs(arg_array):
         default=False,
         help="Answer yes to all.",
     )
+    parser_clean.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=cleaner.DEFAULT_JOBS,
+        help="Number of items to clean at the same time.",
+    )
     parser_clean.set_defaults(handler=_CleanSubcommand)
 
     parser_find = subparsers.add_parser("find")
@@ -550,6 +1407,111 @@ def _ParseArgs(arg_array):
     )
     parser_purchased.set_defaults(handler=_PurchasedHandler)
 
+    parser_sync = subparsers.add_parser(
+        "sync", help="Download all purchased items that are not downloaded yet."
+    )
+    parser_sync.add_argument(
+        "-n",
+        "--dryrun",
+        action="store_true",
+        default=False,
+        help="Only list the items that would be downloaded.",
+    )
+    parser_sync.add_argument(
+        "--age",
+        action="append",
+        help="Only items with this age category, e.g. adult, general, r15. "
+        "Can be specified multiple times.",
+    )
+    parser_sync.add_argument(
+        "--work-type",
+        action="append",
+        help="Only items with this work type, e.g. SOU, MOV, ICG. "
+        "Can be specified multiple times.",
+    )
+    parser_sync.add_argument(
+        "--max-size",
+        type=rate_limit.ParseByteSize,
+        help="Skip items larger than this, e.g. 500M or 2G. "
+        "Items without size information are not skipped.",
+    )
+    parser_sync.add_argument(
+        "--no-extract",
+        action="store_false",
+        dest="extract",
+        default=True,
+        help="Do not extract downloaded archives.",
+    )
+    parser_sync.add_argument(
+        "--keep-extracted-archive",
+        action="store_true",
+        default=False,
+        help="Keeps the extracted archive file.",
+    )
+    _AddBandwidthArgument(parser_sync)
+    _AddSpaceCheckArgument(parser_sync)
+    parser_sync.set_defaults(handler=_SyncSubcommand)
+
+    parser_verify = subparsers.add_parser(
+        "verify", help="Check the downloaded items against their manifests."
+    )
+    parser_verify.add_argument(
+        "--deep",
+        action="store_true",
+        default=False,
+        help="Hash every file. Without this only sizes and modification "
+        "times are compared.",
+    )
+    parser_verify.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=_DEFAULT_VERIFY_JOBS,
+        help="Number of files to read at the same time.",
+    )
+    parser_verify.add_argument(
+        "--restart",
+        action="store_true",
+        default=False,
+        help="Verify all items again even if the previous run was interrupted.",
+    )
+    parser_verify.set_defaults(handler=_VerifySubcommand)
+
+    parser_dedup = subparsers.add_parser(
+        "dedup", help="Replace identical files in the library with links."
+    )
+    parser_dedup.add_argument(
+        "-n",
+        "--dryrun",
+        action="store_true",
+        default=False,
+        help="Only list the duplicates.",
+    )
+    parser_dedup.add_argument(
+        "-y",
+        "--yes",
+        action="store_true",
+        default=False,
+        help="Answer yes to all.",
+    )
+    parser_dedup.add_argument(
+        "--method",
+        type=dedup.Method,
+        choices=[m.value for m in dedup.Method],
+        default=dedup.Method.HARDLINK,
+        help="hardlink works on any local file system but the files share "
+        "their permissions and times. reflink makes independent copies that "
+        "share storage, and needs a file system that supports it, e.g. btrfs.",
+    )
+    parser_dedup.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=_DEFAULT_VERIFY_JOBS,
+        help="Number of files to read at the same time.",
+    )
+    parser_dedup.set_defaults(handler=_DedupSubcommand)
+
     parser_points = subparsers.add_parser("lottery")
     parser_points.set_defaults(handler=_PointsHandler)
 
@@ -579,16 +1541,82 @@ def _ParseArgs(arg_array):
         "use a different directory than the default config "
         "directory. Useful for testing.",
     )
+    parser.add_argument(
+        "--stats",
+        help="Write timings and counters of the network and disk stages as "
+        "JSON to this file when the command finishes. - prints them.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve metrics in the Prometheus format on this local port at "
+        "/metrics while the command runs.",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        help="Keep the metrics in the Prometheus format up to date in this "
+        "file, e.g. for the node_exporter textfile collector.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the command and write the reports, including stacks "
+        f"for flame graphs, to {_PROFILE_DIR} in the config dir.",
+    )
+    parser.add_argument(
+        "--progress",
+        choices=progress.SINKS.keys(),
+        default="bar",
+        help="How to show the progress of downloads and extractions. ndjson "
+        "prints an event as JSON per line, e.g. for a supervisor.",
+    )
 
     return parser.parse_args(arg_array)
 
 
+def _RunHandler(args):
+    sink = progress.SINKS[args.progress]()
+    previous_sink = progress.SetSink(sink)
+    try:
+        if not args.profile:
+            args.handler(args)
+            return
+        with profiling.Profile(args.config_dir / _PROFILE_DIR, args.command):
+            args.handler(args)
+    finally:
+        sink.Close()
+        progress.SetSink(previous_sink)
+
+
 def main(arg_array):
     args = _ParseArgs(arg_array)
     logging.basicConfig(level=args.loglevel)
 
-    if hasattr(args, "handler"):
-        args.handler(args)
+    if not hasattr(args, "handler"):
+        return
+    exporting = args.metrics_port is not None or args.metrics_file
+    if not args.stats and not exporting:
+        _RunHandler(args)
+        return
+
+    instrument.Enable()
+    exporter = metrics.Exporter(args.metrics_port, args.metrics_file)
+    exporter.Start()
+    if args.metrics_port is not None:
+        host, port = exporter.address
+        # Not on stdout, which may have the progress events.
+        print(f"Serving metrics at http://{host}:{port}/metrics", file=sys.stderr)
+    succeeded = False
+    try:
+        _RunHandler(args)
+        succeeded = True
+    finally:
+        instrument.SetGauge("run.succeeded", int(succeeded))
+        exporter.Stop()
+        if args.stats:
+            instrument.WriteSummary(None if args.stats == "-" else Path(args.stats))
+        instrument.Disable()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,23 @@
+import contextlib
+import io
+import json
 import os
 from pathlib import Path
 import pickle
+import threading
 from tempfile import TemporaryDirectory, NamedTemporaryFile
 import unittest
 from unittest import mock
 from unittest.mock import MagicMock, call, patch
+import requests
+import cleaner
+import config_store
+import download_queue
 import downloader
+import instrument
+import item_lock
 import manager
+import manifest
 
 
 class ManagerTest(unittest.TestCase):
@@ -31,15 +42,44 @@ class ManagerTest(unittest.TestCase):
             (tmpdir / "run from this directory").mkdir()
             os.chdir(tmpdir / "run from this directory")
 
-            manager._RemoveFilesInDir(dir_with_items)
+            cleaner.RemoveContents(dir_with_items)
 
             self.assertTrue(dir_with_items.exists())
 
             self.assertEquals(len(os.listdir(dir_with_items)), 0)
 
+    def testCleanSkipsCleanedItems(self):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            config_dir = Path(tmpdir) / "config"
+            watched_dir = Path(tmpdir) / "manage" / "視聴済み"
+            (watched_dir / "RJ1 full").mkdir(parents=True)
+            (watched_dir / "RJ1 full" / "track.mp3").write_bytes(b"music")
+            (watched_dir / "RJ2 empty").mkdir()
+            (watched_dir / "#RJ3 keep").mkdir()
+            (watched_dir / "#RJ3 keep" / "track.mp3").write_bytes(b"music")
+            manager.main(
+                [
+                    "--config-dir",
+                    str(config_dir),
+                    "config",
+                    "-m",
+                    str(watched_dir.parent),
+                ]
+            )
+
+            manager.main(["--config-dir", str(config_dir), "clean", "-y"])
+
+            self.assertEqual(os.listdir(watched_dir / "RJ1 full"), [])
+            self.assertEqual(len(os.listdir(watched_dir / "#RJ3 keep")), 1)
+            with patch("cleaner.MeasureContents") as measure_mock:
+                with patch("cleaner.RemoveContentsOfAll") as remove_mock:
+                    manager.main(["--config-dir", str(config_dir), "clean", "-y"])
+            measure_mock.assert_not_called()
+            remove_mock.assert_not_called()
+
     # Verify that extract works. Assuming that the managed directory does not
     # already have the same name directory.
-    @patch("shutil.move")
+    @patch("dir_move.MoveDir")
     @patch("dlsite_extract.CreateArchivesDirs")
     @patch("dlsite_extract.Unarchive")
     def testExtract(self, mock_unarchive, mock_create_archive_dirs, mock_move):
@@ -61,23 +101,21 @@ class ManagerTest(unittest.TestCase):
 
             mock_create_archive_dirs.assert_called()
             mock_unarchive.assert_called()
-            mock_move.assert_any_call(Path(download_dir / "RJ123"), extracted_files_dir)
+            mock_move.assert_any_call(
+                Path(download_dir / "RJ123"), extracted_files_dir, None
+            )
 
             mock_move.assert_any_call(
-                Path(download_dir / "RJ2786"), extracted_files_dir
+                Path(download_dir / "RJ2786"), extracted_files_dir, None
             )
 
             self.assertEquals(mock_move.call_count, 2)
 
     # If the managed directory already has the same name directory as the
-    # extracted archive's, then remove it then move.
-    @patch("shutil.rmtree")
-    @patch("shutil.move")
+    # extracted archive's, then it is replaced.
     @patch("dlsite_extract.CreateArchivesDirs")
     @patch("dlsite_extract.Unarchive")
-    def testExtractAlreadyExtracted(
-        self, mock_unarchive, mock_create_archive_dirs, mock_move, mock_rmtree
-    ):
+    def testExtractAlreadyExtracted(self, mock_unarchive, mock_create_archive_dirs):
         with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
             download_dir = Path(tmpdir) / "downloads"
             download_dir.mkdir()
@@ -86,7 +124,9 @@ class ManagerTest(unittest.TestCase):
 
             # The destination dir already has the same name directory.
             Path(extracted_files_dir / "RJ123").mkdir()
+            (extracted_files_dir / "RJ123" / "old").write_bytes(b"old")
             Path(download_dir / "RJ123").mkdir()
+            (download_dir / "RJ123" / "new").write_bytes(b"new")
 
             mock_create_archive_dirs.return_value = [
                 Path(download_dir / "RJ123"),
@@ -96,40 +136,123 @@ class ManagerTest(unittest.TestCase):
 
             mock_create_archive_dirs.assert_called()
             mock_unarchive.assert_called()
-            mock_rmtree.assert_called_once_with(extracted_files_dir / "RJ123")
-            mock_move.assert_called_once_with(
-                Path(download_dir / "RJ123"), extracted_files_dir
+            self.assertEqual(
+                sorted(p.name for p in (extracted_files_dir / "RJ123").iterdir()),
+                [manifest.MANIFEST_FILE, "new"],
             )
+            self.assertEqual([p.name for p in extracted_files_dir.iterdir()], ["RJ123"])
+            self.assertFalse((download_dir / "RJ123").exists())
 
-    @patch("pickle.load")
-    @patch("requests.Session")
-    def testLoadSession(self, mock_session_create, mock_load):
-        mock_session = MagicMock()
-        # On non-Windows platforms, `NamedTemporaryFile()` can be used here,
-        # but it won't work on Windows.
-        # This is because the file gets opened on call to NamedTemporaryFile(),
-        # but manager.LoadSessionFromFile also opens it. Behavior for double
-        # open is undefined. So a temporary directory is created instead.
+    def testLoadSession(self):
         with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
-            session_file = Path(tmpdir) / "session.pkl"
-            session_file.touch()  # Ensure the file exists before LoadSessionFromFile is called.
-            mock_session_create.return_value = mock_session
+            session_file = Path(tmpdir) / "session.json"
+            with open(session_file, "w") as f:
+                json.dump(
+                    [
+                        {
+                            "name": "PHPSESSID",
+                            "value": "abc",
+                            "domain": ".dlsite.com",
+                            "path": "/",
+                        }
+                    ],
+                    f,
+                )
             result = manager.LoadSessionFromFile(session_file)
-            self.assertEquals(result, mock_session)
 
-        mock_session_create.assert_called()
-        mock_session.cookies.update.assert_called()
+        self.assertEqual(result.cookies.get("PHPSESSID"), "abc")
+
+    def testLoadSessionNoFile(self):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            with self.assertRaises(manager.NoCredentialsException):
+                manager.LoadSessionFromFile(Path(tmpdir) / "session.json")
 
     def testSaveSession(self):
-        session_mock = MagicMock()
-        session_mock.cookies = "any value"
+        session = requests.Session()
+        session.cookies.set(
+            "PHPSESSID", "abc", domain=".dlsite.com", path="/", expires=2000000000
+        )
+        with TemporaryDirectory() as config_dir:
+            manager.SaveMainSessionToConfigDir(Path(config_dir), session)
+            loaded = manager.LoadMainSessionFromConfigDir(Path(config_dir))
+
+        cookie = next(iter(loaded.cookies))
+        self.assertEqual(cookie.name, "PHPSESSID")
+        self.assertEqual(cookie.value, "abc")
+        self.assertEqual(cookie.domain, ".dlsite.com")
+        self.assertEqual(cookie.expires, 2000000000)
+
+    @patch("config_store.WriteAtomic")
+    def testSaveSessionUnchanged(self, write_mock: MagicMock):
+        session = requests.Session()
+        session.cookies.set("PHPSESSID", "abc", domain=".dlsite.com", path="/")
         with TemporaryDirectory() as config_dir:
-            manager.SaveMainSessionToConfigDir(Path(config_dir), session_mock)
+            session_file = Path(config_dir) / "session.json"
+            with open(session_file, "w") as f:
+                json.dump(
+                    config_store.CookiesToJson(session.cookies),
+                    f,
+                    indent=2,
+                    sort_keys=True,
+                )
+            manager.SaveMainSessionToConfigDir(Path(config_dir), session)
+
+        write_mock.assert_not_called()
+
+    def testLoadLegacyPickledSession(self):
+        session = requests.Session()
+        session.cookies.set("PHPSESSID", "abc", domain=".dlsite.com", path="/")
+        with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
+            config_dir = Path(config_dir)
+            with open(config_dir / "main.session", "wb") as f:
+                pickle.dump(session.cookies, f)
+
+            loaded = manager.LoadMainSessionFromConfigDir(config_dir)
+
+            self.assertEqual(loaded.cookies.get("PHPSESSID"), "abc")
+            self.assertFalse((config_dir / "main.session").exists())
+            self.assertTrue((config_dir / "session.json").exists())
+
+    def testLegacyCredentialIsDeletedWhenJsonExists(self):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
+            config_dir = Path(config_dir)
+            manager._SaveRawCredential(
+                config_dir, manager.RawCredential(username="new", password="new")
+            )
+            with open(config_dir / "login_credential", "wb") as f:
+                pickle.dump(manager.RawCredential(username="old", password="old"), f)
+
+            credential = manager._LoadRawCredential(config_dir)
+
+            self.assertEqual(credential.username, "new")
+            self.assertFalse((config_dir / "login_credential").exists())
+
+    def testLegacySessionIsMigratedOnceByConcurrentRuns(self):
+        session = requests.Session()
+        session.cookies.set("PHPSESSID", "abc", domain=".dlsite.com", path="/")
+        with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
+            config_dir = Path(config_dir)
+            with open(config_dir / "main.session", "wb") as f:
+                pickle.dump(session.cookies, f)
+            barrier = threading.Barrier(4)
+            loaded = []
+
+            def _Load():
+                barrier.wait()
+                loaded.append(manager.LoadMainSessionFromConfigDir(config_dir))
+
+            threads = [threading.Thread(target=_Load) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual([s.cookies.get("PHPSESSID") for s in loaded], ["abc"] * 4)
+            self.assertFalse((config_dir / "main.session").exists())
 
     @patch("login.Login")
     def testCreateLoginSession(self, mock_login):
-        mock_login.return_value = MagicMock()
-        mock_login.return_value.cookies = "any value"
+        mock_login.return_value = requests.Session()
         with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
             os.chdir(config_dir)
             manager._ConfigSubcommand(
@@ -139,13 +262,13 @@ class ManagerTest(unittest.TestCase):
                 "fakepass",
                 True,
             )
-            self.assertTrue((Path(config_dir) / "main.session").exists())
-            cred_file = Path(config_dir) / "login_credential"
+            self.assertTrue((Path(config_dir) / "session.json").exists())
+            cred_file = Path(config_dir) / "login_credential.json"
             self.assertTrue(cred_file.exists())
-            with open(cred_file, "rb") as f:
-                raw_cred: manager.RawCredential = pickle.load(f)
-                self.assertEqual(raw_cred.username, "fakeusername")
-                self.assertEqual(raw_cred.password, "fakepass")
+            with open(cred_file, "r") as f:
+                raw_cred = json.load(f)
+                self.assertEqual(raw_cred["username"], "fakeusername")
+                self.assertEqual(raw_cred["password"], "fakepass")
 
         mock_login.assert_called_once_with("fakeusername", "fakepass")
 
@@ -173,6 +296,44 @@ class ManagerTest(unittest.TestCase):
                 )
             )
 
+    def testConfigBandwidth(self):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            config_dir = Path(tmpdir)
+            self.assertTrue(
+                manager._ConfigSubcommand(
+                    config_dir, None, None, None, True, "09:00-18:00=5M"
+                )
+            )
+            self.assertEqual(
+                (config_dir / "bandwidth_schedule").read_text(), "09:00-18:00=5M"
+            )
+
+            self.assertFalse(
+                manager._ConfigSubcommand(config_dir, None, None, None, True, "fast")
+            )
+            self.assertEqual(
+                (config_dir / "bandwidth_schedule").read_text(), "09:00-18:00=5M"
+            )
+
+    def testConfigStagingDir(self):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            config_dir = Path(tmpdir) / "config"
+            self.assertIsNone(manager._GetStagingDir(config_dir))
+
+            manager.main(
+                [
+                    "--config-dir",
+                    str(config_dir),
+                    "config",
+                    "--staging-dir",
+                    str(Path(tmpdir) / "staging"),
+                ]
+            )
+
+            self.assertEqual(
+                manager._GetStagingDir(config_dir), Path(tmpdir) / "staging"
+            )
+
     @patch("downloader.Downloader.DownloadTo")
     def testDownloadUnauthorized(self, download_to_mock: MagicMock):
         download_to_mock.side_effect = downloader.HttpUnauthorizeException(MagicMock())
@@ -206,7 +367,7 @@ class ManagerTest(unittest.TestCase):
         """
         num_called = 0
 
-        def download_mock_sideeffect(any, arg):
+        def download_mock_sideeffect(any, arg, on_part=None, files=None):
             """Raise exception on first call then behave normally."""
             nonlocal num_called
             num_called += 1
@@ -231,19 +392,116 @@ class ManagerTest(unittest.TestCase):
 
         self.assertEqual(download_to_mock.call_count, 2)
         download_to_mock.assert_has_calls(
-            [call("item1", mock.ANY), call("item1", mock.ANY)]
+            [
+                call("item1", mock.ANY, on_part=mock.ANY, files=None),
+                call("item1", mock.ANY, on_part=mock.ANY, files=None),
+            ]
+        )
+
+    @patch("disk_plan.RESERVED_BYTES", 0)
+    @patch("disk_plan.SameFileSystem", return_value=False)
+    @patch("disk_plan.FreeBytes", return_value=100)
+    @patch("manager.SaveMainSessionToConfigDir")
+    @patch("manager.Extract")
+    @patch("downloader.Downloader.ResolveFiles")
+    @patch("downloader.Downloader.DownloadTo")
+    def testDownloadInBatchesThatFit(
+        self,
+        download_to_mock: MagicMock,
+        resolve_files_mock: MagicMock,
+        extract_mock: MagicMock,
+        save_session_mock: MagicMock,
+        free_bytes_mock: MagicMock,
+        same_fs_mock: MagicMock,
+    ):
+        files = {
+            item_id: [downloader.RemoteFile(f"https://{item_id}", size, item_id)]
+            for item_id, size in {"RJ1": 40, "RJ2": 40, "RJ3": 200}.items()
+        }
+        resolve_files_mock.side_effect = lambda item_id: files[item_id]
+        downloaded = []
+        download_to_mock.side_effect = lambda item_id, *args, **kwargs: (
+            downloaded.append(item_id)
+        )
+        extract_mock.side_effect = lambda *args: downloaded.append("extract")
+
+        with TemporaryDirectory() as management_dir:
+            with TemporaryDirectory() as config_dir:
+                manager.Download(
+                    MagicMock(),
+                    Path(config_dir),
+                    str(management_dir),
+                    {"RJ1", "RJ2", "RJ3"},
+                    True,
+                    False,
+                    plan_disk_space=True,
+                )
+
+        # RJ1 and RJ2 do not fit together with their extracted files, and RJ3
+        # does not fit at all.
+        self.assertEqual(downloaded, ["RJ1", "extract", "RJ2", "extract"])
+        # The items are not resolved again to download them.
+        self.assertEqual(
+            download_to_mock.call_args_list[0],
+            call("RJ1", mock.ANY, on_part=mock.ANY, files=files["RJ1"]),
+        )
+
+    @patch("disk_plan.FreeBytes", return_value=1 << 40)
+    @patch("manager.SaveMainSessionToConfigDir")
+    @patch("downloader.Downloader.ResolveFiles")
+    @patch("downloader.Downloader.DownloadTo")
+    def testDownloadSkipsItemsOfUnknownSize(
+        self,
+        download_to_mock: MagicMock,
+        resolve_files_mock: MagicMock,
+        save_session_mock: MagicMock,
+        free_bytes_mock: MagicMock,
+    ):
+        def _Resolve(item_id):
+            if item_id == "RJ2":
+                raise downloader.DownloadError("Unknown size")
+            return [downloader.RemoteFile("https://RJ1", 10, "RJ1.zip")]
+
+        resolve_files_mock.side_effect = _Resolve
+
+        with TemporaryDirectory() as management_dir:
+            with TemporaryDirectory() as config_dir:
+                manager.Download(
+                    MagicMock(),
+                    Path(config_dir),
+                    str(management_dir),
+                    {"RJ1", "RJ2"},
+                    False,
+                    False,
+                    plan_disk_space=True,
+                )
+
+        download_to_mock.assert_called_once_with(
+            "RJ1", mock.ANY, on_part=mock.ANY, files=mock.ANY
         )
 
     @patch("login.Login")
     def testRelogin(self, login_mock: MagicMock):
         with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
-            with open(
-                Path(config_dir) / manager._RAW_LOGIN_CREDENTAIL_FILE, "wb"
-            ) as test_cred_file:
+            cred = manager.RawCredential(username="any", password="string")
+            manager._SaveRawCredential(Path(config_dir), cred)
+
+            manager._ReloginWithCredential(Path(config_dir))
+
+        login_mock.assert_called_once_with("any", "string")
+
+    @patch("login.Login")
+    def testReloginLegacyPickledCredential(self, login_mock: MagicMock):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
+            config_dir = Path(config_dir)
+            with open(config_dir / "login_credential", "wb") as test_cred_file:
                 cred = manager.RawCredential(username="any", password="string")
                 pickle.dump(cred, test_cred_file)
 
-            manager._ReloginWithCredential(Path(config_dir))
+            manager._ReloginWithCredential(config_dir)
+
+            self.assertFalse((config_dir / "login_credential").exists())
+            self.assertTrue((config_dir / "login_credential.json").exists())
 
         login_mock.assert_called_once_with("any", "string")
 
@@ -264,3 +522,514 @@ class ManagerTest(unittest.TestCase):
                 pass
         load_mock.assert_called_once()
         save_session_mock.assert_called_once()
+
+    @patch("downloader.Downloader.DownloadTo")
+    def testDownloadSkipsItemLockedByAnotherRun(self, download_to_mock: MagicMock):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as management_dir:
+            with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
+                lock_dir = Path(management_dir) / "downloading" / ".locks"
+                other_run = item_lock.ItemLock(lock_dir, "locked_item")
+                self.assertTrue(other_run.TryAcquire())
+
+                manager.Download(
+                    MagicMock(),
+                    Path(config_dir),
+                    str(management_dir),
+                    set(["locked_item", "free_item"]),
+                    False,
+                    False,
+                )
+
+                self.assertEqual(os.listdir(lock_dir), ["locked_item.lock"])
+
+        download_to_mock.assert_called_once_with(
+            "free_item", mock.ANY, on_part=mock.ANY, files=None
+        )
+
+    @patch("downloader.Downloader.DownloadTo")
+    def testDownloadRecordsQueueState(self, download_to_mock: MagicMock):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as management_dir:
+            with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
+                queue = download_queue.DownloadQueue(Path(config_dir) / "queue.jsonl")
+                queue.Add(["new_item", "downloaded_item"])
+                queue.Update("downloaded_item", download_queue.ItemState.DOWNLOADED)
+                download_dir = Path(management_dir) / "downloading"
+                download_dir.mkdir()
+                (download_dir / "downloaded_item.zip").write_bytes(b"zip")
+                manifest.Manifest(
+                    "downloaded_item",
+                    [manifest.FileEntry("downloaded_item.zip", 3, "")],
+                ).Save(manifest.ArchiveManifestPath(download_dir, "downloaded_item"))
+
+                manager.Download(
+                    MagicMock(),
+                    Path(config_dir),
+                    str(management_dir),
+                    set(["new_item", "downloaded_item"]),
+                    False,
+                    False,
+                    queue=queue,
+                )
+
+                self.assertEqual(
+                    queue.Get("new_item").state, download_queue.ItemState.DOWNLOADED
+                )
+
+        download_to_mock.assert_called_once_with(
+            "new_item", mock.ANY, on_part=mock.ANY, files=None
+        )
+
+    @patch("downloader.Downloader.DownloadTo")
+    def testDownloadAgainWhenArchivesAreGone(self, download_to_mock: MagicMock):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as management_dir:
+            with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
+                queue = download_queue.DownloadQueue(Path(config_dir) / "queue.jsonl")
+                queue.Add(["item"])
+                queue.Update("item", download_queue.ItemState.DOWNLOADED)
+                download_dir = Path(management_dir) / "downloading"
+                download_dir.mkdir()
+                # The archive was deleted after the download.
+                manifest.Manifest("item", [manifest.FileEntry("item.zip", 3, "")]).Save(
+                    manifest.ArchiveManifestPath(download_dir, "item")
+                )
+
+                manager.Download(
+                    MagicMock(),
+                    Path(config_dir),
+                    str(management_dir),
+                    set(["item"]),
+                    False,
+                    False,
+                    queue=queue,
+                )
+
+                self.assertEqual(
+                    queue.Get("item").state, download_queue.ItemState.DOWNLOADED
+                )
+
+        download_to_mock.assert_called_once_with(
+            "item", mock.ANY, on_part=mock.ANY, files=None
+        )
+
+    @patch("manager.Download")
+    @patch("manager._EnsureFreshSession")
+    @patch("manager.LoadMainSessionFromConfigDir")
+    def testDownloadWithNdjsonProgressOnlyWritesJson(
+        self, load_mock: MagicMock, ensure_mock: MagicMock, download_mock: MagicMock
+    ):
+        download_mock.side_effect = downloader.HttpUnauthorizeException(MagicMock())
+        with TemporaryDirectory(ignore_cleanup_errors=True) as management_dir:
+            with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
+                manager._ConfigSubcommand(
+                    Path(config_dir), Path(management_dir), None, None, False
+                )
+                (Path(management_dir) / "RJ2").mkdir()
+                stdout = io.StringIO()
+                with contextlib.redirect_stdout(stdout):
+                    manager.main(
+                        [
+                            "--config-dir",
+                            config_dir,
+                            "--progress",
+                            "ndjson",
+                            "download",
+                            "RJ1",
+                            "RJ2",
+                            "--resume-queue",
+                        ]
+                    )
+
+        events = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([e["kind"] for e in events], ["message", "message", "error"])
+
+    @patch("manager.Download")
+    @patch("manager._EnsureFreshSession")
+    @patch("manager.LoadMainSessionFromConfigDir")
+    def testDownloadSubcommandRequeuesRequestedItems(
+        self, load_mock: MagicMock, ensure_mock: MagicMock, download_mock: MagicMock
+    ):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as management_dir:
+            with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
+                config_dir = Path(config_dir)
+                manager._ConfigSubcommand(
+                    config_dir, Path(management_dir), None, None, False
+                )
+                queue = download_queue.DownloadQueue(
+                    config_dir / manager._DOWNLOAD_QUEUE_FILE
+                )
+                queue.Add(["RJ1", "RJ2"])
+                queue.Update("RJ1", download_queue.ItemState.DOWNLOADED)
+                queue.Update("RJ2", download_queue.ItemState.EXTRACTING)
+
+                manager._DownloadSubcommand(
+                    config_dir, ["RJ1"], False, False, False, resume_queue=True
+                )
+                queue = download_queue.DownloadQueue(
+                    config_dir / manager._DOWNLOAD_QUEUE_FILE
+                )
+                self.assertEqual(
+                    queue.Get("RJ1").state, download_queue.ItemState.QUEUED
+                )
+                self.assertEqual(
+                    queue.Get("RJ2").state, download_queue.ItemState.EXTRACTING
+                )
+
+                manager._DownloadSubcommand(
+                    config_dir, [], True, False, False, resume_queue=True
+                )
+                queue = download_queue.DownloadQueue(
+                    config_dir / manager._DOWNLOAD_QUEUE_FILE
+                )
+                self.assertEqual(
+                    queue.Get("RJ2").state, download_queue.ItemState.QUEUED
+                )
+
+        self.assertEqual(download_mock.call_count, 2)
+
+    @patch("downloader.Downloader.DownloadTo")
+    def testDownloadRecordsFailure(self, download_to_mock: MagicMock):
+        download_to_mock.side_effect = downloader.DownloadError("broken")
+        with TemporaryDirectory(ignore_cleanup_errors=True) as management_dir:
+            with TemporaryDirectory(ignore_cleanup_errors=True) as config_dir:
+                queue = download_queue.DownloadQueue(Path(config_dir) / "queue.jsonl")
+                queue.Add(["item"])
+                with self.assertRaises(downloader.DownloadError):
+                    manager.Download(
+                        MagicMock(),
+                        Path(config_dir),
+                        str(management_dir),
+                        set(["item"]),
+                        False,
+                        False,
+                        queue=queue,
+                    )
+
+                entry = queue.Get("item")
+                self.assertEqual(entry.state, download_queue.ItemState.FAILED)
+                self.assertEqual(entry.error, "broken")
+
+    @patch("dir_move.MoveDir")
+    @patch("dlsite_extract.CreateArchivesDirs")
+    @patch("dlsite_extract.Unarchive")
+    def testExtractFailureIsNotMoved(
+        self, mock_unarchive, mock_create_archive_dirs, mock_move
+    ):
+        mock_unarchive.return_value = False
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            download_dir = Path(tmpdir) / "downloads"
+            download_dir.mkdir()
+            (download_dir / "RJ123 title").mkdir()
+            mock_create_archive_dirs.return_value = [download_dir / "RJ123 title"]
+            queue = download_queue.DownloadQueue(Path(tmpdir) / "queue.jsonl")
+
+            manager.Extract(download_dir, Path(tmpdir), False, queue=queue)
+
+            self.assertEqual(queue.Get("RJ123").state, download_queue.ItemState.FAILED)
+        mock_move.assert_not_called()
+
+    @patch("dlsite_extract.GetWorkNameFromWorkId")
+    @patch("dlsite_extract.Unarchive")
+    def testExtractMixedCategories(self, mock_unarchive, mock_get_work_name):
+        mock_unarchive.return_value = True
+        mock_get_work_name.return_value = ""
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            management_dir = Path(tmpdir)
+            download_dir = management_dir / "downloading"
+            download_dir.mkdir()
+            for name in [
+                "RJ01000001.zip",
+                "VJ01000002.part1.exe",
+                "VJ01000002.part2.rar",
+                "BJ123.zip",
+            ]:
+                (download_dir / name).touch()
+
+            manager.Extract(download_dir, management_dir, False)
+
+            self.assertEqual(list(download_dir.iterdir()), [])
+            self.assertEqual(
+                sorted(p.name for p in management_dir.iterdir()),
+                ["BJ123", "RJ01000001", "VJ01000002", "downloading"],
+            )
+            self.assertTrue(
+                (management_dir / "VJ01000002" / "VJ01000002.part2.rar").exists()
+            )
+
+    @patch("dir_move.MoveDir")
+    @patch("dlsite_extract.CreateArchivesDirs")
+    @patch("dlsite_extract.Unarchive")
+    def testExtractResumesLeftoverDirectory(
+        self, mock_unarchive, mock_create_archive_dirs, mock_move
+    ):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            download_dir = Path(tmpdir) / "downloads"
+            download_dir.mkdir()
+            (download_dir / "RJ123 title").mkdir()
+            (download_dir / "RJ123 title" / "RJ123.part1.exe").write_bytes(b"exe")
+            manifest.Manifest(
+                "RJ123", [manifest.FileEntry("RJ123.part1.exe", 3, "")]
+            ).Save(manifest.ArchiveManifestPath(download_dir, "RJ123"))
+            (download_dir / ".locks").mkdir()
+            # Not directories of downloaded items.
+            (download_dir / "my notes").mkdir()
+            (download_dir / "RJ456 unknown").mkdir()
+            mock_create_archive_dirs.return_value = set()
+
+            manager.Extract(download_dir, Path(tmpdir), False)
+
+        mock_unarchive.assert_called_once_with(download_dir / "RJ123 title", False)
+        mock_move.assert_called_once_with(
+            download_dir / "RJ123 title", Path(tmpdir), None
+        )
+
+    @patch("dlsite_extract._ExtractZip", return_value=True)
+    @patch("dlsite_extract.CreateArchivesDirs", return_value=set())
+    def testExtractAfterCrashBetweenExtractingAndMoving(
+        self, mock_create_archive_dirs, mock_extract_zip
+    ):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            download_dir = Path(tmpdir) / "downloading"
+            management_dir = Path(tmpdir) / "manage"
+            management_dir.mkdir()
+            # The archive was extracted and deleted, but not moved yet.
+            item_dir = download_dir / "RJ01000001"
+            item_dir.mkdir(parents=True)
+            (item_dir / "bonus.zip").write_bytes(b"bonus")
+            (item_dir / "track01.wav").write_bytes(b"track")
+            manifest.Manifest(
+                "RJ01000001", [manifest.FileEntry("RJ01000001.zip", 10, "")]
+            ).Save(manifest.ArchiveManifestPath(download_dir, "RJ01000001"))
+
+            manager.Extract(download_dir, management_dir, False)
+
+            self.assertEqual(
+                sorted(os.listdir(management_dir / "RJ01000001")),
+                [manifest.MANIFEST_FILE, "bonus.zip", "track01.wav"],
+            )
+        mock_extract_zip.assert_not_called()
+
+    @patch("dir_move.MoveDir")
+    @patch("dlsite_extract.CreateArchivesDirs")
+    @patch("dlsite_extract.Unarchive")
+    def testExtractRefusesArchivesNotMatchingManifest(
+        self, mock_unarchive, mock_create_archive_dirs, mock_move
+    ):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            download_dir = Path(tmpdir) / "downloads"
+            archive_dir = download_dir / "RJ123 title"
+            archive_dir.mkdir(parents=True)
+            (archive_dir / "RJ123.part1.exe").write_bytes(b"short")
+            manifest.Manifest(
+                "RJ123", [manifest.FileEntry("RJ123.part1.exe", 100, "")]
+            ).Save(manifest.ArchiveManifestPath(download_dir, "RJ123"))
+            mock_create_archive_dirs.return_value = [archive_dir]
+            queue = download_queue.DownloadQueue(Path(tmpdir) / "queue.jsonl")
+
+            manager.Extract(download_dir, Path(tmpdir), False, queue=queue)
+
+            self.assertEqual(queue.Get("RJ123").state, download_queue.ItemState.FAILED)
+            self.assertTrue((archive_dir / "RJ123.part1.exe").exists())
+        mock_unarchive.assert_not_called()
+        mock_move.assert_not_called()
+
+    @patch("dir_move.MoveDir")
+    @patch("dlsite_extract.CreateArchivesDirs")
+    @patch("dlsite_extract.Unarchive")
+    def testExtractWritesItemManifest(
+        self, mock_unarchive, mock_create_archive_dirs, mock_move
+    ):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            download_dir = Path(tmpdir) / "downloads"
+            archive_dir = download_dir / "RJ123 title"
+            archive_dir.mkdir(parents=True)
+            (archive_dir / "RJ123.part1.exe").write_bytes(b"archive")
+            archive_manifest_path = manifest.ArchiveManifestPath(download_dir, "RJ123")
+            manifest.Manifest(
+                "RJ123", [manifest.FileEntry("RJ123.part1.exe", 7, "")]
+            ).Save(archive_manifest_path)
+            mock_create_archive_dirs.return_value = [archive_dir]
+
+            def _Unarchive(directory, keep_archive):
+                (directory / "RJ123.part1.exe").unlink()
+                (directory / "track.mp3").write_bytes(b"music")
+                return True
+
+            mock_unarchive.side_effect = _Unarchive
+
+            manager.Extract(download_dir, Path(tmpdir), False)
+
+            item_manifest = manifest.Manifest.Load(archive_dir / manifest.MANIFEST_FILE)
+            self.assertEqual([f.path for f in item_manifest.files], ["track.mp3"])
+            self.assertEqual(
+                [f.path for f in item_manifest.archives], ["RJ123.part1.exe"]
+            )
+            self.assertFalse(archive_manifest_path.exists())
+
+    def testVerify(self):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            config_dir = Path(tmpdir) / "config"
+            management_dir = Path(tmpdir) / "manage"
+            good = management_dir / "RJ1 good"
+            bad = management_dir / "RJ2 bad"
+            for item_dir in [good, bad]:
+                item_dir.mkdir(parents=True)
+                (item_dir / "file").write_bytes(b"content")
+                manifest.Create(item_dir, item_dir.name[:3]).Save(
+                    item_dir / manifest.MANIFEST_FILE
+                )
+            (management_dir / "RJ3 no manifest").mkdir()
+            manager.main(
+                ["--config-dir", str(config_dir), "config", "-m", str(management_dir)]
+            )
+
+            manager.main(["--config-dir", str(config_dir), "verify"])
+
+            (bad / "file").write_bytes(b"rotten!")
+            # Same size and written right away, so only hashing notices.
+            manager.main(["--config-dir", str(config_dir), "verify"])
+            with self.assertRaises(SystemExit):
+                manager.main(["--config-dir", str(config_dir), "verify", "--deep"])
+
+    def testVerifyWithNdjsonProgressOnlyWritesJson(self):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            config_dir = Path(tmpdir) / "config"
+            management_dir = Path(tmpdir) / "manage"
+            bad = management_dir / "RJ1 bad"
+            bad.mkdir(parents=True)
+            (bad / "file").write_bytes(b"content")
+            manifest.Create(bad, "RJ1").Save(bad / manifest.MANIFEST_FILE)
+            (bad / "file").write_bytes(b"rotten")
+            manager.main(
+                ["--config-dir", str(config_dir), "config", "-m", str(management_dir)]
+            )
+
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                with self.assertRaises(SystemExit):
+                    manager.main(
+                        [
+                            "--config-dir",
+                            str(config_dir),
+                            "--progress",
+                            "ndjson",
+                            "verify",
+                        ]
+                    )
+
+        events = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(
+            [e["kind"] for e in events],
+            ["message", "file_started", "file_done", "error", "message"],
+        )
+        self.assertEqual(events[3]["item_id"], "RJ1")
+        self.assertIn("file is 6 bytes, expected 7.", events[3]["message"])
+
+    def testStats(self):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            config_dir = Path(tmpdir) / "config"
+            management_dir = Path(tmpdir) / "manage"
+            (management_dir / "RJ1 one").mkdir(parents=True)
+            (management_dir / "RJ2 two").mkdir()
+            stats_file = Path(tmpdir) / "stats.json"
+            manager.main(
+                ["--config-dir", str(config_dir), "config", "-m", str(management_dir)]
+            )
+
+            manager.main(
+                ["--config-dir", str(config_dir), "--stats", str(stats_file), "verify"]
+            )
+
+            with open(stats_file, "r", encoding="utf-8") as f:
+                stats = json.load(f)
+            self.assertEqual(stats["spans"]["library.scan"]["count"], 1)
+            self.assertEqual(stats["counters"]["library.items"], 2)
+            self.assertFalse(instrument.IsEnabled())
+
+    def testProfile(self):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            config_dir = Path(tmpdir) / "config"
+            management_dir = Path(tmpdir) / "manage"
+            management_dir.mkdir()
+            manager.main(
+                ["--config-dir", str(config_dir), "config", "-m", str(management_dir)]
+            )
+
+            manager.main(["--config-dir", str(config_dir), "--profile", "verify"])
+
+            reports = sorted(p.suffix for p in (config_dir / "profiles").iterdir())
+            self.assertEqual(reports, [".collapsed", ".prof", ".txt"])
+
+    def testMetricsFile(self):
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            config_dir = Path(tmpdir) / "config"
+            management_dir = Path(tmpdir) / "manage"
+            (management_dir / "RJ1 one").mkdir(parents=True)
+            metrics_file = Path(tmpdir) / "dlsite.prom"
+            manager.main(
+                ["--config-dir", str(config_dir), "config", "-m", str(management_dir)]
+            )
+
+            manager.main(
+                [
+                    "--config-dir",
+                    str(config_dir),
+                    "--metrics-file",
+                    str(metrics_file),
+                    "verify",
+                ]
+            )
+
+            content = metrics_file.read_text()
+            self.assertIn("dlsite_library_items_total 1\n", content)
+            self.assertIn("dlsite_run_succeeded 1\n", content)
+
+    @patch("manager.Download")
+    @patch("manager._GetAllPurchases")
+    @patch("manager.LoadMainSessionFromConfigDir")
+    def testSync(
+        self,
+        load_session_mock: MagicMock,
+        get_purchases_mock: MagicMock,
+        download_mock: MagicMock,
+    ):
+        get_purchases_mock.return_value = [
+            {"workno": "RJ1", "age_category": "adult"},
+            {"workno": "RJ2", "age_category": "adult"},
+            {"workno": "RJ3", "age_category": "general"},
+            {"workno": "RJ4", "age_category": "adult"},
+        ]
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            config_dir = Path(tmpdir) / "config"
+            management_dir = Path(tmpdir) / "manage"
+            (management_dir / "RJ1 downloaded").mkdir(parents=True)
+            (management_dir / "視聴済み" / "RJ4 watched").mkdir(parents=True)
+            manager.main(
+                ["--config-dir", str(config_dir), "config", "-m", str(management_dir)]
+            )
+
+            manager.main(["--config-dir", str(config_dir), "sync", "--age", "adult"])
+
+        download_mock.assert_called_once()
+        self.assertEqual(download_mock.call_args.args[3], {"RJ2"})
+
+    @patch("manager.Download")
+    @patch("manager._GetAllPurchases")
+    @patch("manager.LoadMainSessionFromConfigDir")
+    def testSyncDryrun(
+        self,
+        load_session_mock: MagicMock,
+        get_purchases_mock: MagicMock,
+        download_mock: MagicMock,
+    ):
+        get_purchases_mock.return_value = [{"workno": "RJ1"}]
+        with TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
+            config_dir = Path(tmpdir) / "config"
+            management_dir = Path(tmpdir) / "manage"
+            management_dir.mkdir()
+            manager.main(
+                ["--config-dir", str(config_dir), "config", "-m", str(management_dir)]
+            )
+
+            manager.main(["--config-dir", str(config_dir), "sync", "-n"])
+
+        download_mock.assert_not_called()
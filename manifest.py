@@ -0,0 +1,174 @@
+"""Checksum manifests for downloaded archives and extracted items.
+
+Two kinds of manifests use the same format:
+
+- While an item is downloaded, a manifest of its archive files is kept next
+  to them in the download dir (".<item ID>.manifest.json"). The hashes are
+  computed while downloading so the archives are not read again.
+- An extracted item has a manifest of its files in its directory
+  (MANIFEST_FILE), which is used to verify the library later.
+"""
+
+from dataclasses import asdict, dataclass, field
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import config_store
+
+MANIFEST_FILE = ".dlsite_manifest.json"
+
+HASH_ALGORITHM = "sha256"
+
+_HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Some file systems, e.g. FAT, only keep modification times in 2 second steps.
+_MTIME_TOLERANCE_NS = 2 * 10**9
+
+
+@dataclass
+class FileEntry:
+    # Relative to the directory of the item, with "/" as the separator.
+    path: str
+    size: int
+    sha256: str
+    mtime_ns: int = 0
+
+
+@dataclass
+class Manifest:
+    item_id: str
+    files: List[FileEntry] = field(default_factory=list)
+    # Archives that the files were extracted from.
+    archives: List[FileEntry] = field(default_factory=list)
+
+    def ToJson(self) -> Dict:
+        content = asdict(self)
+        content["algorithm"] = HASH_ALGORITHM
+        return content
+
+    @classmethod
+    def FromJson(cls, content: Dict) -> "Manifest":
+        if content.get("algorithm", HASH_ALGORITHM) != HASH_ALGORITHM:
+            raise ValueError(f"Unsupported hash algorithm {content['algorithm']}")
+        return cls(
+            item_id=content["item_id"],
+            files=[FileEntry(**f) for f in content.get("files", [])],
+            archives=[FileEntry(**f) for f in content.get("archives", [])],
+        )
+
+    @classmethod
+    def Load(cls, path: Path) -> Optional["Manifest"]:
+        """Returns the manifest at path or None if there is none."""
+        content = config_store.ReadJson(path)
+        if content is None:
+            return None
+        return cls.FromJson(content)
+
+    def Save(self, path: Path):
+        data = json.dumps(self.ToJson(), indent=2, ensure_ascii=False).encode()
+        config_store.WriteAtomic(path, data)
+
+    def Set(self, entry: FileEntry):
+        """Adds entry to files, replacing the one with the same path."""
+        self.files = [f for f in self.files if f.path != entry.path]
+        self.files.append(entry)
+
+    def Get(self, path: str) -> Optional[FileEntry]:
+        for f in self.files:
+            if f.path == path:
+                return f
+        return None
+
+
+def NewHasher():
+    return hashlib.new(HASH_ALGORITHM)
+
+
+def HashFile(path: Path, hasher=None) -> str:
+    """Returns the hex digest of the file content.
+
+    If hasher is specified, the content is added to it. That is useful to
+    continue hashing a file that is still being written.
+    """
+    hasher = hasher or NewHasher()
+    buffer = memoryview(bytearray(_HASH_CHUNK_SIZE))
+    with open(path, "rb", buffering=0) as f:
+        while num_read := f.readinto(buffer):
+            hasher.update(buffer[:num_read])
+    return hasher.hexdigest()
+
+
+def ArchiveManifestPath(download_dir: Path, item_id: str) -> Path:
+    # Hidden so that it is not taken as one of the archives.
+    return download_dir / f".{item_id}.manifest.json"
+
+
+def _RelativePath(path: Path, directory: Path) -> str:
+    return path.relative_to(directory).as_posix()
+
+
+def Create(directory: Path, item_id: str) -> Manifest:
+    """Creates a manifest of all the files under directory."""
+    files = []
+    for root, _, file_names in os.walk(directory):
+        for name in file_names:
+            path = Path(root) / name
+            if path.parent == directory and name == MANIFEST_FILE:
+                continue
+            stat = path.stat()
+            files.append(
+                FileEntry(
+                    path=_RelativePath(path, directory),
+                    size=stat.st_size,
+                    sha256=HashFile(path),
+                    mtime_ns=stat.st_mtime_ns,
+                )
+            )
+    files.sort(key=lambda f: f.path)
+    return Manifest(item_id=item_id, files=files)
+
+
+def CheckEntry(
+    directory: Path,
+    entry: FileEntry,
+    check_mtime: bool = False,
+    check_hash: bool = False,
+) -> Optional[str]:
+    """Checks one file against its entry.
+
+    The size is always checked. Checking the modification time is cheap and
+    catches files that were changed or replaced. Only hashing catches
+    corruption that kept the size and the modification time.
+
+    Returns:
+        A description of the mismatch, or None if the file matches.
+    """
+    path = directory / entry.path
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return f"{entry.path} is missing."
+    if stat.st_size != entry.size:
+        return f"{entry.path} is {stat.st_size:,} bytes, expected {entry.size:,}."
+    if (
+        check_mtime
+        and entry.mtime_ns
+        and abs(stat.st_mtime_ns - entry.mtime_ns) > _MTIME_TOLERANCE_NS
+    ):
+        return f"{entry.path} was modified."
+    if check_hash and HashFile(path) != entry.sha256:
+        return f"{entry.path} does not match its hash."
+    return None
+
+
+def CheckSizes(directory: Path, entries: List[FileEntry]) -> List[str]:
+    """Checks that the files exist and have the recorded sizes.
+
+    Returns:
+        A description of each mismatch. Empty if everything matches.
+    """
+    problems = [CheckEntry(directory, entry) for entry in entries]
+    return [p for p in problems if p]
@@ -0,0 +1,67 @@
+import hashlib
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+import manifest
+
+
+class ManifestTest(unittest.TestCase):
+    def testHashFile(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "file"
+            path.write_bytes(b"hello")
+            self.assertEqual(
+                manifest.HashFile(path), hashlib.sha256(b"hello").hexdigest()
+            )
+
+    def testHashFileContinuesHasher(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "file"
+            path.write_bytes(b"hel")
+            hasher = manifest.NewHasher()
+            manifest.HashFile(path, hasher)
+            hasher.update(b"lo")
+            self.assertEqual(hasher.hexdigest(), hashlib.sha256(b"hello").hexdigest())
+
+    def testCreateSaveAndLoad(self):
+        with TemporaryDirectory() as tmpdir:
+            item_dir = Path(tmpdir)
+            (item_dir / "sub").mkdir()
+            (item_dir / "a.txt").write_bytes(b"a")
+            (item_dir / "sub" / "b.txt").write_bytes(b"bb")
+
+            created = manifest.Create(item_dir, "RJ1")
+            self.assertEqual([f.path for f in created.files], ["a.txt", "sub/b.txt"])
+            self.assertEqual([f.size for f in created.files], [1, 2])
+
+            created.Save(item_dir / manifest.MANIFEST_FILE)
+            loaded = manifest.Manifest.Load(item_dir / manifest.MANIFEST_FILE)
+            self.assertEqual(loaded, created)
+
+            # The manifest itself is not part of the manifest.
+            self.assertEqual(manifest.Create(item_dir, "RJ1"), created)
+
+    def testLoadMissing(self):
+        with TemporaryDirectory() as tmpdir:
+            self.assertIsNone(manifest.Manifest.Load(Path(tmpdir) / "none.json"))
+
+    def testCheck(self):
+        with TemporaryDirectory() as tmpdir:
+            item_dir = Path(tmpdir)
+            (item_dir / "a.txt").write_bytes(b"a")
+            (item_dir / "b.txt").write_bytes(b"b")
+            entries = manifest.Create(item_dir, "RJ1").files
+            self.assertEqual(manifest.CheckSizes(item_dir, entries), [])
+
+            (item_dir / "a.txt").write_bytes(b"x")
+            self.assertEqual(
+                manifest.CheckEntry(item_dir, entries[0], check_hash=True),
+                "a.txt does not match its hash.",
+            )
+            self.assertEqual(manifest.CheckSizes(item_dir, entries), [])
+
+            (item_dir / "b.txt").unlink()
+            self.assertEqual(
+                manifest.CheckSizes(item_dir, entries), ["b.txt is missing."]
+            )
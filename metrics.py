@@ -0,0 +1,180 @@
+"""Exports what instrument records in the Prometheus text format.
+
+For long running jobs, e.g. a nightly sync, so that a Prometheus server can
+scrape them over HTTP, or node_exporter can collect them from a textfile.
+
+    instrument.Enable()
+    with metrics.Exporter(port=9877, textfile=Path("dlsite.prom")):
+        ...
+
+Counters become dlsite_<name>_total, gauges dlsite_<name> and spans
+summaries dlsite_<name>_seconds with _count and _sum, where the dots in the
+names are replaced with underscores.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+from pathlib import Path
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import instrument
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_PREFIX = "dlsite_"
+
+# How often the textfile is rewritten while the job runs.
+_DEFAULT_TEXTFILE_INTERVAL = 15.0
+
+
+def _MetricName(name: str) -> str:
+    return _PREFIX + name.replace(".", "_").replace("-", "_")
+
+
+def _SplitLabels(key: str) -> Tuple[str, str]:
+    """Splits 'name{code="200"}' into 'name' and '{code="200"}'."""
+    name, brace, labels = key.partition("{")
+    return name, brace + labels
+
+
+def _Number(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def Render(summary: Optional[Dict] = None) -> str:
+    """Returns summary, by default instrument.Summary(), as Prometheus text."""
+    if summary is None:
+        summary = instrument.Summary()
+    lines: List[str] = []
+
+    counters: Dict[str, List[Tuple[str, int]]] = {}
+    for key, value in summary["counters"].items():
+        name, labels = _SplitLabels(key)
+        counters.setdefault(name, []).append((labels, value))
+    for name, samples in counters.items():
+        metric = _MetricName(name)
+        lines.append(f"# TYPE {metric}_total counter")
+        for labels, value in samples:
+            lines.append(f"{metric}_total{labels} {_Number(value)}")
+
+    for name, value in summary["gauges"].items():
+        metric = _MetricName(name)
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {_Number(value)}")
+
+    for name, stats in summary["spans"].items():
+        metric = _MetricName(name) + "_seconds"
+        lines.append(f"# TYPE {metric} summary")
+        lines.append(f"{metric}_count {stats['count']}")
+        lines.append(f"{metric}_sum {_Number(stats['total_seconds'])}")
+
+    lines.append(f"# TYPE {_PREFIX}wall_seconds gauge")
+    lines.append(f"{_PREFIX}wall_seconds {_Number(summary['wall_seconds'])}")
+    return "\n".join(lines) + "\n"
+
+
+def WriteTextfile(path: Path):
+    """Writes Render() to path for node_exporter's textfile collector.
+
+    The file is replaced atomically so that the collector never reads a half
+    written file.
+    """
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(Render())
+    os.replace(temp_path, path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        content = Render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics: " + format % args)
+
+
+class Exporter:
+    """Serves the metrics over HTTP and/or keeps a textfile up to date.
+
+    Both run in daemon threads until Stop(), which also writes the textfile
+    one last time so that it has the final values.
+    """
+
+    def __init__(
+        self,
+        port: Optional[int] = None,
+        textfile: Optional[Path] = None,
+        textfile_interval: float = _DEFAULT_TEXTFILE_INTERVAL,
+        host: str = "127.0.0.1",
+    ) -> None:
+        """
+        Args:
+            port: Port to serve /metrics on. 0 picks a free port. None does
+                not serve.
+            textfile: File to write the metrics to. None does not write.
+            textfile_interval: Seconds between textfile writes.
+            host: Address to serve on. Only local by default.
+        """
+        self._port = port
+        self._host = host
+        self._textfile = textfile
+        self._textfile_interval = textfile_interval
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.Start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.Stop()
+
+    @property
+    def address(self) -> Optional[Tuple[str, int]]:
+        if not self._server:
+            return None
+        return self._server.server_address[:2]
+
+    def Start(self):
+        if self._port is not None:
+            self._server = ThreadingHTTPServer((self._host, self._port), _Handler)
+            self._threads.append(
+                threading.Thread(target=self._server.serve_forever, daemon=True)
+            )
+        if self._textfile:
+            self._threads.append(
+                threading.Thread(target=self._WriteTextfileLoop, daemon=True)
+            )
+        for thread in self._threads:
+            thread.start()
+
+    def Stop(self):
+        self._stop.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._textfile:
+            WriteTextfile(self._textfile)
+
+    def _WriteTextfileLoop(self):
+        while not self._stop.wait(self._textfile_interval):
+            try:
+                WriteTextfile(self._textfile)
+            except OSError as e:
+                logging.warning(f"Failed to write metrics to {self._textfile}: {e}")
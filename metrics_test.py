@@ -0,0 +1,96 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+import urllib.request
+
+import downloader
+import fake_dlsite
+import instrument
+import login
+import metrics
+
+_USER = "user@example.com"
+_PASSWORD = "password"
+
+
+class RenderTest(unittest.TestCase):
+    def testRender(self):
+        summary = {
+            "wall_seconds": 2.5,
+            "spans": {
+                "extract.unarchive": {
+                    "count": 2,
+                    "total_seconds": 1.5,
+                    "mean_seconds": 0.75,
+                    "min_seconds": 0.5,
+                    "max_seconds": 1.0,
+                }
+            },
+            "counters": {
+                "download.bytes": 1024,
+                'http.responses{code="200"}': 3,
+                'http.responses{code="503"}': 1,
+            },
+            "gauges": {"download.active": 1},
+        }
+
+        self.assertEqual(
+            metrics.Render(summary),
+            "# TYPE dlsite_download_bytes_total counter\n"
+            "dlsite_download_bytes_total 1024\n"
+            "# TYPE dlsite_http_responses_total counter\n"
+            'dlsite_http_responses_total{code="200"} 3\n'
+            'dlsite_http_responses_total{code="503"} 1\n'
+            "# TYPE dlsite_download_active gauge\n"
+            "dlsite_download_active 1\n"
+            "# TYPE dlsite_extract_unarchive_seconds summary\n"
+            "dlsite_extract_unarchive_seconds_count 2\n"
+            "dlsite_extract_unarchive_seconds_sum 1.5\n"
+            "# TYPE dlsite_wall_seconds gauge\n"
+            "dlsite_wall_seconds 2.5\n",
+        )
+
+
+class ExporterTest(unittest.TestCase):
+    def setUp(self):
+        instrument.Enable()
+        self.addCleanup(instrument.Disable)
+
+    def testServesMetrics(self):
+        instrument.Count("session.relogins")
+        with metrics.Exporter(port=0) as exporter:
+            host, port = exporter.address
+            with urllib.request.urlopen(f"http://{host}:{port}/metrics") as response:
+                self.assertEqual(response.headers["Content-Type"], metrics.CONTENT_TYPE)
+                content = response.read().decode()
+
+        self.assertIn("dlsite_session_relogins_total 1\n", content)
+
+    def testWritesTextfileWhenStopped(self):
+        with TemporaryDirectory() as tmpdir:
+            textfile = Path(tmpdir) / "dlsite.prom"
+            with metrics.Exporter(textfile=textfile, textfile_interval=60):
+                instrument.SetGauge("download.queue_depth", 3)
+
+            self.assertIn("dlsite_download_queue_depth 3\n", textfile.read_text())
+            self.assertEqual([p.name for p in Path(tmpdir).iterdir()], ["dlsite.prom"])
+
+    def testDownloadMetrics(self):
+        with fake_dlsite.FakeDlsite() as fake:
+            fake.AddUser(_USER, _PASSWORD)
+            fake.AddWork("RJ01000001", [1000])
+            fake.FailNext(503, path_prefix="/get/")
+            dl = downloader.Downloader(login.Login(_USER, _PASSWORD))
+            with TemporaryDirectory() as tmpdir:
+                dl.DownloadTo("RJ01000001", tmpdir)
+
+        content = metrics.Render()
+        self.assertIn("dlsite_download_bytes_total 1000\n", content)
+        self.assertIn('dlsite_http_responses_total{code="200"}', content)
+        self.assertIn("dlsite_http_retries_total 1\n", content)
+        self.assertIn("dlsite_download_active 0\n", content)
+        self.assertIn("dlsite_download_file_seconds_count 1\n", content)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Profiles a command to see where a slow run spends its time.
+
+Two reports are written for each run:
+  - <name>.txt: cProfile stats of the main thread sorted by cumulative time.
+    <name>.prof has the raw stats, e.g. for snakeviz.
+  - <name>.collapsed: Stacks of all threads sampled every few milliseconds,
+    one "frame;frame;frame count" line per stack. This is the input of
+    flamegraph.pl and speedscope.
+
+cProfile only sees the thread it is enabled in, so the work of the download
+and purchase worker threads, and the time spent waiting for subprocesses
+like unar, is best seen in the sampled stacks.
+
+    with profiling.Profile(output_dir, "download"):
+        ...
+"""
+
+import collections
+import cProfile
+from contextlib import contextmanager
+import datetime
+import io
+import os
+from pathlib import Path
+import pstats
+import sys
+import threading
+from typing import Counter, Iterator, List
+
+_DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Lines of the sorted report.
+_REPORT_LIMIT = 80
+
+
+def _FrameName(frame) -> str:
+    code = frame.f_code
+    file_name = os.path.basename(code.co_filename)
+    # Semicolons separate frames in the collapsed format.
+    return f"{code.co_name} ({file_name}:{code.co_firstlineno})".replace(";", ":")
+
+
+class _Sampler:
+    """Samples the stacks of all threads from a daemon thread."""
+
+    def __init__(self, interval: float) -> None:
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._Run, daemon=True)
+        self.stacks: Counter[str] = collections.Counter()
+
+    def Start(self):
+        self._thread.start()
+
+    def Stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _Run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self._interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames: List[str] = []
+                while frame is not None:
+                    frames.append(_FrameName(frame))
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(frames))] += 1
+
+    def Write(self, path: Path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+
+def _WriteReport(profiler: cProfile.Profile, path: Path):
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(_REPORT_LIMIT)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(_REPORT_LIMIT)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(stream.getvalue())
+
+
+@contextmanager
+def Profile(
+    output_dir: Path,
+    name: str,
+    sample_interval: float = _DEFAULT_SAMPLE_INTERVAL,
+) -> Iterator[Path]:
+    """Profiles the block and writes the reports to output_dir.
+
+    The reports are written even if the block raises, e.g. when a slow run
+    is interrupted with Ctrl-C.
+
+    Args:
+        output_dir: Created if it does not exist.
+        name: Used in the file names, e.g. the subcommand.
+        sample_interval: Seconds between stack samples.
+
+    Yields:
+        The path of the reports without a suffix.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    base_path = output_dir / f"{timestamp}-{name}"
+
+    sampler = _Sampler(sample_interval)
+    profiler = cProfile.Profile()
+    sampler.Start()
+    profiler.enable()
+    try:
+        yield base_path
+    finally:
+        profiler.disable()
+        sampler.Stop()
+        profiler.dump_stats(base_path.with_suffix(".prof"))
+        _WriteReport(profiler, base_path.with_suffix(".txt"))
+        sampler.Write(base_path.with_suffix(".collapsed"))
+        # Not on stdout, which may have the progress events.
+        print(f"Profile is written to {base_path}.txt and .collapsed", file=sys.stderr)
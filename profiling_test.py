@@ -0,0 +1,56 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import threading
+import time
+import unittest
+
+import profiling
+
+
+def _BusyWait(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class ProfileTest(unittest.TestCase):
+    def testWritesReports(self):
+        with TemporaryDirectory() as tmpdir:
+            output_dir = Path(tmpdir) / "profiles"
+            with profiling.Profile(output_dir, "find", sample_interval=0.001) as path:
+                worker = threading.Thread(target=_BusyWait, args=(0.1,), name="worker")
+                worker.start()
+                _BusyWait(0.1)
+                worker.join()
+
+            self.assertEqual(
+                sorted(p.name for p in output_dir.iterdir()),
+                [f"{path.name}.collapsed", f"{path.name}.prof", f"{path.name}.txt"],
+            )
+            self.assertTrue(path.name.endswith("-find"))
+            self.assertIn("_BusyWait", path.with_suffix(".txt").read_text())
+
+            collapsed = path.with_suffix(".collapsed").read_text().splitlines()
+            self.assertTrue(collapsed)
+            for line in collapsed:
+                stack, count = line.rsplit(" ", 1)
+                self.assertGreater(int(count), 0)
+            roots = {line.split(";")[0] for line in collapsed}
+            self.assertIn("MainThread", roots)
+            self.assertIn("worker", roots)
+            self.assertTrue(
+                any(line.split(";")[-1].startswith("_BusyWait") for line in collapsed)
+            )
+
+    def testWritesReportsWhenInterrupted(self):
+        with TemporaryDirectory() as tmpdir:
+            with self.assertRaises(KeyboardInterrupt):
+                with profiling.Profile(Path(tmpdir), "sync") as path:
+                    raise KeyboardInterrupt()
+
+            self.assertTrue(path.with_suffix(".txt").exists())
+            self.assertTrue(path.with_suffix(".collapsed").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
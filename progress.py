@@ -0,0 +1,226 @@
+"""Progress events of downloads, extractions and verification, and where they
+are shown.
+
+Code that makes progress emits events and the sink set with SetSink()
+shows them:
+  - TqdmSink: progress bars and messages for a terminal. The default.
+  - NdjsonSink: one JSON object per line, e.g. for a supervisor process.
+  - QuietSink: nothing.
+
+    progress.Emit(progress.ITEM_STARTED, item_id="RJ01000001")
+    file_progress = progress.StartFile("RJ01000001", "RJ01000001.zip", size)
+    file_progress.Update(len(chunk))
+    file_progress.Finish()
+
+Byte progress is throttled in FileProgress, so updating it for every chunk
+costs a clock read unless an event is due.
+"""
+
+from dataclasses import asdict, dataclass, field
+import json
+import sys
+import threading
+import time
+from typing import Dict, Optional, TextIO, Tuple
+
+from tqdm import tqdm
+
+ITEM_STARTED = "item_started"
+ITEM_DONE = "item_done"
+FILE_STARTED = "file_started"
+BYTES = "bytes"
+# A file, e.g. one part of a split archive, is downloaded.
+FILE_DONE = "file_done"
+EXTRACT_STARTED = "extract_started"
+EXTRACT_FINISHED = "extract_finished"
+ERROR = "error"
+# Anything else worth telling, e.g. that an item is skipped.
+MESSAGE = "message"
+
+# Seconds between byte progress events of a file.
+_DEFAULT_BYTES_INTERVAL = 0.2
+
+
+@dataclass
+class Event:
+    kind: str
+    item_id: Optional[str] = None
+    file_name: Optional[str] = None
+    # Bytes of the file that are downloaded, including a resumed part.
+    done: Optional[int] = None
+    total: Optional[int] = None
+    # 1-based index of the file and the number of files of the item.
+    part: Optional[int] = None
+    num_parts: Optional[int] = None
+    # Human readable description. Sinks for terminals show this.
+    message: Optional[str] = None
+    time: float = field(default_factory=time.time)
+
+
+class QuietSink:
+    def Handle(self, event: Event):
+        pass
+
+    def Close(self):
+        pass
+
+
+class NdjsonSink:
+    """Writes each event as a line of JSON without the fields that are None."""
+
+    def __init__(self, stream: Optional[TextIO] = None) -> None:
+        self._stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def Handle(self, event: Event):
+        fields = {k: v for k, v in asdict(event).items() if v is not None}
+        line = json.dumps(fields, ensure_ascii=False)
+        with self._lock:
+            self._stream.write(line + "\n")
+            self._stream.flush()
+
+    def Close(self):
+        pass
+
+
+class TqdmSink:
+    """Shows a progress bar for each file being downloaded and the messages.
+
+    Files downloaded at the same time get their own bars.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._bars: Dict[Tuple[Optional[str], Optional[str]], tqdm] = {}
+
+    def Handle(self, event: Event):
+        key = (event.item_id, event.file_name)
+        with self._lock:
+            if event.message:
+                tqdm.write(event.message)
+            if event.kind == FILE_STARTED:
+                self._bars[key] = tqdm(
+                    unit="B",
+                    total=event.total,
+                    initial=event.done or 0,
+                    unit_scale=True,
+                )
+                return
+            bar = self._bars.get(key)
+            if bar is None or event.done is None:
+                return
+            bar.update(event.done - bar.n)
+            if event.kind in (FILE_DONE, ERROR):
+                bar.close()
+                del self._bars[key]
+
+    def Close(self):
+        with self._lock:
+            for bar in self._bars.values():
+                bar.close()
+            self._bars.clear()
+
+
+# Sinks by the names used on the command line.
+SINKS = {"bar": TqdmSink, "ndjson": NdjsonSink, "quiet": QuietSink}
+
+_sink = TqdmSink()
+
+
+def SetSink(sink) -> object:
+    """Sends the events to sink from now on and returns the previous sink."""
+    global _sink
+    previous = _sink
+    _sink = sink
+    return previous
+
+
+def Emit(kind: str, **fields):
+    _sink.Handle(Event(kind, **fields))
+
+
+def Message(message: str, item_id: Optional[str] = None):
+    Emit(MESSAGE, item_id=item_id, message=message)
+
+
+def StdoutIsReserved() -> bool:
+    """Whether the sink writes events to stdout.
+
+    Nothing else, e.g. the output of subprocesses, may be written there then.
+    """
+    return isinstance(_sink, NdjsonSink) and _sink._stream is sys.stdout
+
+
+class FileProgress:
+    """Reports the progress of downloading one file."""
+
+    def __init__(
+        self,
+        item_id: Optional[str],
+        file_name: str,
+        total: int,
+        done: int = 0,
+        part: Optional[int] = None,
+        num_parts: Optional[int] = None,
+        interval: float = _DEFAULT_BYTES_INTERVAL,
+    ) -> None:
+        self._item_id = item_id
+        self._file_name = file_name
+        self._total = total
+        self._done = done
+        self._part = part
+        self._num_parts = num_parts
+        self._interval = interval
+        self._last_emit = time.perf_counter()
+
+    def _Emit(self, kind: str):
+        Emit(
+            kind,
+            item_id=self._item_id,
+            file_name=self._file_name,
+            done=self._done,
+            total=self._total,
+            part=self._part,
+            num_parts=self._num_parts,
+        )
+
+    def Update(self, num_bytes: int):
+        self._done += num_bytes
+        now = time.perf_counter()
+        if now - self._last_emit < self._interval:
+            return
+        self._last_emit = now
+        self._Emit(BYTES)
+
+    def Finish(self, succeeded: bool = True):
+        """Call it when the download stops, even on failure.
+
+        Emits FILE_DONE, or ERROR if not succeeded.
+        """
+        if succeeded:
+            self._Emit(FILE_DONE)
+            return
+        Emit(
+            ERROR,
+            item_id=self._item_id,
+            file_name=self._file_name,
+            done=self._done,
+            total=self._total,
+            part=self._part,
+            num_parts=self._num_parts,
+            message=f"{self._file_name} stopped at {self._done:,} bytes.",
+        )
+
+
+def StartFile(
+    item_id: Optional[str],
+    file_name: str,
+    total: int,
+    done: int = 0,
+    part: Optional[int] = None,
+    num_parts: Optional[int] = None,
+) -> FileProgress:
+    """Emits FILE_STARTED and returns the object to report progress to."""
+    file_progress = FileProgress(item_id, file_name, total, done, part, num_parts)
+    file_progress._Emit(FILE_STARTED)
+    return file_progress
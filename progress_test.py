@@ -0,0 +1,155 @@
+import io
+import json
+from tempfile import TemporaryDirectory
+import unittest
+
+import downloader
+import fake_dlsite
+import login
+import progress
+
+_USER = "user@example.com"
+_PASSWORD = "password"
+
+
+class RecordingSink:
+    def __init__(self) -> None:
+        self.events = []
+
+    def Handle(self, event: progress.Event):
+        self.events.append(event)
+
+    def Close(self):
+        pass
+
+
+class ProgressTest(unittest.TestCase):
+    def setUp(self):
+        self.sink = RecordingSink()
+        previous = progress.SetSink(self.sink)
+        self.addCleanup(progress.SetSink, previous)
+
+    def testBytesAreThrottled(self):
+        file_progress = progress.FileProgress(
+            "RJ01000001", "RJ01000001.zip", 300, interval=60
+        )
+        for _ in range(3):
+            file_progress.Update(100)
+        file_progress.Finish()
+
+        self.assertEqual([e.kind for e in self.sink.events], [progress.FILE_DONE])
+        self.assertEqual(self.sink.events[0].done, 300)
+
+    def testBytesWithoutThrottling(self):
+        file_progress = progress.StartFile(
+            "RJ01000001", "RJ01000001.zip", 300, done=100, part=1, num_parts=2
+        )
+        file_progress._interval = 0
+        file_progress.Update(100)
+        file_progress.Update(100)
+        file_progress.Finish()
+
+        self.assertEqual(
+            [(e.kind, e.done) for e in self.sink.events],
+            [
+                (progress.FILE_STARTED, 100),
+                (progress.BYTES, 200),
+                (progress.BYTES, 300),
+                (progress.FILE_DONE, 300),
+            ],
+        )
+        self.assertTrue(all(e.part == 1 for e in self.sink.events))
+
+    def testFailedFile(self):
+        file_progress = progress.FileProgress("RJ01000001", "RJ01000001.zip", 300)
+        file_progress.Update(10)
+        file_progress.Finish(succeeded=False)
+
+        self.assertEqual(self.sink.events[-1].kind, progress.ERROR)
+        self.assertEqual(self.sink.events[-1].done, 10)
+        self.assertIn("RJ01000001.zip", self.sink.events[-1].message)
+
+    def testDownloadEvents(self):
+        with fake_dlsite.FakeDlsite() as fake:
+            fake.AddUser(_USER, _PASSWORD)
+            fake.AddWork("RJ01000001", [100, 200])
+            dl = downloader.Downloader(login.Login(_USER, _PASSWORD))
+            with TemporaryDirectory() as tmpdir:
+                dl.DownloadTo("RJ01000001", tmpdir)
+                dl.DownloadTo("RJ01000001", tmpdir)
+
+        file_events = [
+            (e.kind, e.part, e.done)
+            for e in self.sink.events
+            if e.kind in (progress.FILE_STARTED, progress.FILE_DONE)
+        ]
+        self.assertEqual(
+            file_events,
+            [
+                (progress.FILE_STARTED, 1, 0),
+                (progress.FILE_DONE, 1, 100),
+                (progress.FILE_STARTED, 2, 0),
+                (progress.FILE_DONE, 2, 200),
+                # Already downloaded.
+                (progress.FILE_DONE, 1, 100),
+                (progress.FILE_DONE, 2, 200),
+            ],
+        )
+        item_events = [
+            (e.kind, e.item_id)
+            for e in self.sink.events
+            if e.kind in (progress.ITEM_STARTED, progress.ITEM_DONE)
+        ]
+        self.assertEqual(
+            item_events,
+            [
+                (progress.ITEM_STARTED, "RJ01000001"),
+                (progress.ITEM_DONE, "RJ01000001"),
+            ]
+            * 2,
+        )
+
+
+class SinkTest(unittest.TestCase):
+    def testNdjsonSink(self):
+        stream = io.StringIO()
+        sink = progress.NdjsonSink(stream)
+        sink.Handle(progress.Event(progress.ITEM_STARTED, item_id="RJ01000001"))
+        sink.Handle(progress.Event(progress.MESSAGE, message="作品"))
+
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(lines[0]["kind"], progress.ITEM_STARTED)
+        self.assertEqual(lines[0]["item_id"], "RJ01000001")
+        self.assertNotIn("file_name", lines[0])
+        self.assertIn("time", lines[0])
+        self.assertEqual(lines[1]["message"], "作品")
+
+    def testStdoutIsReservedByNdjsonSink(self):
+        for sink, reserved in [
+            (progress.NdjsonSink(), True),
+            (progress.NdjsonSink(io.StringIO()), False),
+            (progress.TqdmSink(), False),
+        ]:
+            previous = progress.SetSink(sink)
+            try:
+                self.assertEqual(progress.StdoutIsReserved(), reserved)
+            finally:
+                progress.SetSink(previous)
+
+    def testTqdmSinkClosesBars(self):
+        sink = progress.TqdmSink()
+        for kind, done in [
+            (progress.FILE_STARTED, 0),
+            (progress.BYTES, 50),
+            (progress.FILE_DONE, 100),
+        ]:
+            sink.Handle(
+                progress.Event(
+                    kind, item_id="RJ01000001", file_name="a.zip", done=done, total=100
+                )
+            )
+        self.assertEqual(sink._bars, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+"""Bandwidth limiting shared by all download workers.
+
+The limit can depend on the time of day, e.g. unlimited at night and 5 MB/s
+during business hours. A schedule is written like
+
+    09:00-18:00=5M,18:00-22:00=20M
+
+Times outside of all windows are unlimited. A single rate without a window
+(e.g. "5M") applies all day. Rates are bytes per second and accept K, M, G
+suffixes (powers of 1024). "unlimited" can be used as a rate.
+"""
+
+from dataclasses import dataclass
+import datetime
+import logging
+from pathlib import Path
+import threading
+import time
+from typing import Callable, List, Optional
+
+_UNLIMITED = "unlimited"
+
+# How often the limiter checks the schedule and the schedule file.
+_REFRESH_INTERVAL = 5
+
+# Chunk size used while a limit is active. Small enough to keep the transfer
+# smooth, large enough to keep per-chunk overhead low.
+_LIMITED_CHUNK_SIZE = 1024 * 1024
+
+
+def ParseByteSize(size: str) -> int:
+    """Parses sizes like "500M" or "2G" (powers of 1024) into bytes."""
+    _UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = size.strip().upper().removesuffix("B")
+    if size and size[-1] in _UNITS:
+        return int(float(size[:-1]) * _UNITS[size[-1]])
+    return int(size)
+
+
+def _ParseRate(rate: str) -> Optional[int]:
+    rate = rate.strip().lower().removesuffix("/s")
+    if rate == _UNLIMITED:
+        return None
+    num_bytes = ParseByteSize(rate)
+    if num_bytes <= 0:
+        raise ValueError(
+            f"Rate must be more than 0 bytes per second, or {_UNLIMITED}: {rate}"
+        )
+    return num_bytes
+
+
+def _ParseTime(clock_time: str) -> datetime.time:
+    return datetime.datetime.strptime(clock_time.strip(), "%H:%M").time()
+
+
+@dataclass
+class TimeWindow:
+    start: datetime.time
+    end: datetime.time
+    rate: Optional[int]
+
+    def Contains(self, t: datetime.time) -> bool:
+        if self.start <= self.end:
+            return self.start <= t < self.end
+        # Crosses midnight.
+        return t >= self.start or t < self.end
+
+
+class Schedule:
+    def __init__(self, windows: List[TimeWindow]) -> None:
+        self.windows = windows
+
+    @classmethod
+    def Parse(cls, spec: str) -> "Schedule":
+        """Parses a schedule. Raises ValueError if it is malformed."""
+        windows = []
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            if "=" not in part:
+                windows.append(
+                    TimeWindow(datetime.time.min, datetime.time.max, _ParseRate(part))
+                )
+                continue
+            window, rate = part.split("=", 1)
+            start, end = window.split("-", 1)
+            windows.append(
+                TimeWindow(_ParseTime(start), _ParseTime(end), _ParseRate(rate))
+            )
+        return cls(windows)
+
+    def RateAt(self, t: datetime.time) -> Optional[int]:
+        """Returns the rate in bytes per second at t. None means unlimited."""
+        for window in self.windows:
+            if window.Contains(t):
+                return window.rate
+        return None
+
+
+class TokenBucket:
+    """Thread safe token bucket. Consume() blocks until the bytes are allowed.
+
+    Callers may take more than what is in the bucket. The bucket then goes
+    into debt and the caller sleeps until it is paid back, which keeps large
+    chunks from starving.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float],
+        sleep: Callable[[float], None] = time.sleep,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._lock = threading.Lock()
+        self._sleep = sleep
+        self._clock = clock
+        self._rate: Optional[float] = None
+        self._tokens = 0.0
+        self._last = clock()
+        self.SetRate(rate)
+
+    def _Refill(self, now: float):
+        if self._rate is not None:
+            self._tokens = min(
+                self._rate, self._tokens + (now - self._last) * self._rate
+            )
+        self._last = now
+
+    def SetRate(self, rate: Optional[float]):
+        """Changes the rate in bytes per second. None means unlimited."""
+        with self._lock:
+            if rate == self._rate:
+                return
+            self._Refill(self._clock())
+            self._rate = rate
+            if rate is None:
+                self._tokens = 0.0
+            else:
+                # Allow bursts of up to one second worth of bytes.
+                self._tokens = min(self._tokens, rate)
+
+    def Rate(self) -> Optional[float]:
+        return self._rate
+
+    def Consume(self, amount: int):
+        with self._lock:
+            if self._rate is None:
+                return
+            self._Refill(self._clock())
+            self._tokens -= amount
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait > 0:
+            self._sleep(wait)
+
+
+class ScheduledLimiter:
+    """Token bucket whose rate follows a schedule.
+
+    If schedule_file is specified, it is re-read whenever it changes, so the
+    limit can be adjusted while a batch is running.
+    """
+
+    def __init__(
+        self,
+        schedule: Optional[Schedule] = None,
+        schedule_file: Optional[Path] = None,
+        now: Callable[[], datetime.datetime] = datetime.datetime.now,
+        sleep: Callable[[float], None] = time.sleep,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._schedule = schedule or Schedule([])
+        self._schedule_file = schedule_file
+        self._schedule_file_mtime: Optional[int] = None
+        self._now = now
+        self._clock = clock
+        self._next_refresh = 0.0
+        self._refresh_lock = threading.Lock()
+        self._bucket = TokenBucket(None, sleep=sleep, clock=clock)
+        self._Refresh()
+
+    def _ReloadScheduleFile(self):
+        if not self._schedule_file:
+            return
+        try:
+            mtime = self._schedule_file.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._schedule_file_mtime:
+            return
+        self._schedule_file_mtime = mtime
+
+        if mtime is None:
+            self._schedule = Schedule([])
+            return
+        spec = self._schedule_file.read_text()
+        try:
+            self._schedule = Schedule.Parse(spec)
+            logging.info(f"Using bandwidth schedule: {spec.strip()}")
+        except ValueError:
+            logging.error(f"Ignoring malformed bandwidth schedule: {spec!r}")
+
+    def _Refresh(self):
+        with self._refresh_lock:
+            if self._clock() < self._next_refresh:
+                return
+            self._next_refresh = self._clock() + _REFRESH_INTERVAL
+            self._ReloadScheduleFile()
+            self._bucket.SetRate(self._schedule.RateAt(self._now().time()))
+
+    def Rate(self) -> Optional[float]:
+        return self._bucket.Rate()
+
+    def ChunkSize(self, default: int) -> int:
+        """Chunk size to read with, so that limiting stays smooth."""
+        if self._bucket.Rate() is None:
+            return default
+        return min(default, _LIMITED_CHUNK_SIZE)
+
+    def Consume(self, amount: int):
+        self._Refresh()
+        self._bucket.Consume(amount)
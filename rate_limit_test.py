@@ -0,0 +1,144 @@
+import datetime
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+import rate_limit
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.slept = []
+
+    def Time(self) -> float:
+        return self.now
+
+    def Sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class ParseTest(unittest.TestCase):
+    def testParseByteSize(self):
+        self.assertEqual(rate_limit.ParseByteSize("123"), 123)
+        self.assertEqual(rate_limit.ParseByteSize("2K"), 2048)
+        self.assertEqual(rate_limit.ParseByteSize("1.5M"), 1536 * 1024)
+        self.assertEqual(rate_limit.ParseByteSize("2gb"), 2 * 1024**3)
+
+    def testScheduleWindows(self):
+        schedule = rate_limit.Schedule.Parse("09:00-18:00=5M, 18:00-22:00=20M")
+        self.assertEqual(schedule.RateAt(datetime.time(8, 59)), None)
+        self.assertEqual(schedule.RateAt(datetime.time(9, 0)), 5 * 1024**2)
+        self.assertEqual(schedule.RateAt(datetime.time(18, 0)), 20 * 1024**2)
+        self.assertEqual(schedule.RateAt(datetime.time(23, 0)), None)
+
+    def testScheduleAcrossMidnight(self):
+        schedule = rate_limit.Schedule.Parse("22:00-06:00=1M")
+        self.assertEqual(schedule.RateAt(datetime.time(23, 0)), 1024**2)
+        self.assertEqual(schedule.RateAt(datetime.time(5, 59)), 1024**2)
+        self.assertEqual(schedule.RateAt(datetime.time(6, 0)), None)
+
+    def testScheduleWholeDay(self):
+        schedule = rate_limit.Schedule.Parse("500K")
+        self.assertEqual(schedule.RateAt(datetime.time(0, 0)), 500 * 1024)
+        self.assertEqual(schedule.RateAt(datetime.time(23, 59, 59)), 500 * 1024)
+        self.assertIsNone(
+            rate_limit.Schedule.Parse("unlimited").RateAt(datetime.time(12, 0))
+        )
+
+    def testMalformedSchedule(self):
+        for spec in ["fast", "9-18=5M", "09:00=5M"]:
+            with self.assertRaises(ValueError):
+                rate_limit.Schedule.Parse(spec)
+
+    def testZeroRateIsRejected(self):
+        for spec in ["0", "09:00-18:00=0", "0K/s"]:
+            with self.assertRaises(ValueError):
+                rate_limit.Schedule.Parse(spec)
+
+    def testNegativeRateIsRejected(self):
+        for spec in ["-5M", "09:00-18:00=-1"]:
+            with self.assertRaises(ValueError):
+                rate_limit.Schedule.Parse(spec)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def testUnlimitedDoesNotSleep(self):
+        clock = FakeClock()
+        bucket = rate_limit.TokenBucket(None, sleep=clock.Sleep, clock=clock.Time)
+        bucket.Consume(10**12)
+        self.assertEqual(clock.slept, [])
+
+    def testLimitsRate(self):
+        clock = FakeClock()
+        bucket = rate_limit.TokenBucket(100, sleep=clock.Sleep, clock=clock.Time)
+        for _ in range(10):
+            bucket.Consume(50)
+        # 500 bytes at 100 bytes per second.
+        self.assertAlmostEqual(clock.now, 5.0)
+
+    def testBurstIsCapped(self):
+        clock = FakeClock()
+        bucket = rate_limit.TokenBucket(100, sleep=clock.Sleep, clock=clock.Time)
+        clock.now = 1000
+        bucket.Consume(300)
+        # Only one second worth of tokens accumulated while idle.
+        self.assertAlmostEqual(clock.slept[-1], 2.0)
+
+    def testSetRate(self):
+        clock = FakeClock()
+        bucket = rate_limit.TokenBucket(100, sleep=clock.Sleep, clock=clock.Time)
+        bucket.SetRate(None)
+        bucket.Consume(1000)
+        self.assertEqual(clock.slept, [])
+        bucket.SetRate(1000)
+        bucket.Consume(2000)
+        self.assertAlmostEqual(clock.slept[-1], 2.0)
+
+
+class ScheduledLimiterTest(unittest.TestCase):
+    def testFollowsSchedule(self):
+        clock = FakeClock()
+        now = datetime.datetime(2024, 1, 1, 12, 0)
+        limiter = rate_limit.ScheduledLimiter(
+            schedule=rate_limit.Schedule.Parse("09:00-18:00=1K"),
+            now=lambda: now,
+            sleep=clock.Sleep,
+            clock=clock.Time,
+        )
+        self.assertEqual(limiter.Rate(), 1024)
+        self.assertEqual(limiter.ChunkSize(25 * 1024**2), 1024**2)
+
+        now = datetime.datetime(2024, 1, 1, 19, 0)
+        clock.now += rate_limit._REFRESH_INTERVAL
+        limiter.Consume(1)
+        self.assertIsNone(limiter.Rate())
+        self.assertEqual(limiter.ChunkSize(25 * 1024**2), 25 * 1024**2)
+
+    def testReloadsScheduleFile(self):
+        clock = FakeClock()
+        with TemporaryDirectory() as tmpdir:
+            schedule_file = Path(tmpdir) / "bandwidth_schedule"
+            limiter = rate_limit.ScheduledLimiter(
+                schedule_file=schedule_file, sleep=clock.Sleep, clock=clock.Time
+            )
+            self.assertIsNone(limiter.Rate())
+
+            schedule_file.write_text("2K")
+            clock.now += rate_limit._REFRESH_INTERVAL
+            limiter.Consume(1)
+            self.assertEqual(limiter.Rate(), 2048)
+
+            # A broken file keeps the previous schedule.
+            schedule_file.write_text("fast")
+            os.utime(schedule_file, ns=(0, 0))
+            clock.now += rate_limit._REFRESH_INTERVAL
+            limiter.Consume(1)
+            self.assertEqual(limiter.Rate(), 2048)
+
+            schedule_file.unlink()
+            clock.now += rate_limit._REFRESH_INTERVAL
+            limiter.Consume(1)
+            self.assertIsNone(limiter.Rate())
@@ -0,0 +1,247 @@
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+import instrument
+import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter, Retry
+
+# Small API response that requires a logged in session. Used to check whether
+# the cookies are still accepted.
+_VALIDATION_URL = "https://play.dlsite.com/api/product_count"
+
+# Cookies of the logged in session. Others in the jar, e.g. for tracking, do
+# not need a relogin when they expire.
+_SESSION_COOKIES = frozenset(["PHPSESSID"])
+
+# Refresh this many seconds before the session cookie expires.
+DEFAULT_REFRESH_MARGIN = 10 * 60
+
+# The background refresher wakes up at least this often, in case cookies were
+# replaced with ones that expire sooner.
+_MAX_REFRESH_SLEEP = 5 * 60
+
+
+def CreateAdapter(max_workers: int) -> HTTPAdapter:
+    """Creates an adapter with retries and a connection pool sized for workers.
+
+    It often gets status 500 and fails to get the content length. This should
+    recover after a few retries.
+
+    Args:
+        max_workers: Number of threads that may use the adapter at the same
+            time. The connection pool per host is sized to this, so that every
+            worker can keep its connection alive.
+
+    Returns:
+        An HTTPAdapter that can be shared between sessions.
+    """
+    retries = Retry(backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+    # pool_connections is the number of hosts to keep pools for. The login
+    # and download flows go through several dlsite.com hosts, so keep the
+    # default instead of shrinking it to the worker count.
+    return HTTPAdapter(
+        pool_connections=DEFAULT_POOLSIZE,
+        pool_maxsize=max(DEFAULT_POOLSIZE, max_workers),
+        max_retries=retries,
+    )
+
+
+def NumRetries(response: requests.Response) -> int:
+    """Number of times the adapter retried to get response."""
+    retries = getattr(response.raw, "retries", None)
+    history = getattr(retries, "history", None)
+    return len(history) if isinstance(history, tuple) else 0
+
+
+def RecordResponse(response: requests.Response):
+    """Counts the request, its retries and its status in instrument."""
+    if not instrument.IsEnabled():
+        return
+    instrument.Count("http.requests")
+    instrument.Count("http.retries", NumRetries(response))
+    instrument.Count("http.responses", labels={"code": str(response.status_code)})
+
+
+class SessionPool:
+    """Hands out a session per worker thread, all sharing the same login.
+
+    requests.Session is not guaranteed to be thread safe, so each thread gets
+    its own session with a copy of the main session's cookies. The sessions
+    share one HTTPAdapter, so connections are still reused between workers.
+
+    When the main session is replaced (e.g. after a relogin), every worker
+    picks up a fresh copy of the new cookies on its next Get().
+    """
+
+    def __init__(self, session: requests.Session, max_workers: int = 1) -> None:
+        self._lock = threading.Lock()
+        self._relogin_lock = threading.Lock()
+        self._stop_refresh = threading.Event()
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._local = threading.local()
+        self._main = session
+        self._generation = 0
+        self._worker_sessions: List[requests.Session] = []
+        self._adapter = CreateAdapter(max_workers)
+
+    def _Clone(self) -> requests.Session:
+        session = requests.Session()
+        session.headers.update(self._main.headers)
+        session.cookies.update(self._main.cookies)
+        session.mount("https://", self._adapter)
+        session.mount("http://", self._adapter)
+        return session
+
+    def Get(self) -> requests.Session:
+        """Returns the session for the calling thread."""
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            with self._lock:
+                local.session = self._Clone()
+                local.generation = self._generation
+                self._worker_sessions.append(local.session)
+        return local.session
+
+    def Generation(self) -> int:
+        """Number of times the main session has been replaced."""
+        return self._generation
+
+    def Replace(self, session: requests.Session):
+        """Replaces the main session, e.g. with a newly logged in one.
+
+        Workers that are in the middle of a request finish it with their old
+        session. Any Get() after this returns a session with the new cookies.
+        """
+        with self._lock:
+            logging.debug("Replacing the main session of the pool.")
+            self._main = session
+            self._worker_sessions = []
+            self._generation += 1
+
+    def MainSession(self) -> requests.Session:
+        """Returns the main session with cookies set on workers merged in.
+
+        Servers may update cookies (e.g. tokens) on any of the worker sessions.
+        Use this when saving the session so those updates are not lost.
+        """
+        with self._lock:
+            for worker_session in self._worker_sessions:
+                for cookie in worker_session.cookies:
+                    self._main.cookies.set_cookie(cookie)
+            return self._main
+
+    def ExpiresAt(self, now: Optional[float] = None) -> Optional[float]:
+        """Returns the earliest expiry time (epoch seconds) of the session cookies.
+
+        Only the cookies of the logged in session count. Of those, cookies
+        that have already expired are ignored unless all of them have, in
+        which case the latest expiry is returned. Returns None if no session
+        cookie has an expiry (browser session cookies).
+        """
+        if now is None:
+            now = time.time()
+        expiries = [
+            c.expires
+            for c in self._main.cookies
+            if c.name in _SESSION_COOKIES and c.expires is not None
+        ]
+        unexpired = [expires for expires in expiries if expires > now]
+        if unexpired:
+            return min(unexpired)
+        return max(expiries, default=None)
+
+    def NeedsRefresh(
+        self, margin: float = DEFAULT_REFRESH_MARGIN, now: Optional[float] = None
+    ) -> bool:
+        """Whether a session cookie expires within margin seconds."""
+        if now is None:
+            now = time.time()
+        expires_at = self.ExpiresAt(now)
+        if expires_at is None:
+            return False
+        return expires_at - margin <= now
+
+    def IsValid(self) -> bool:
+        """Checks with a single small request whether the login is accepted."""
+        try:
+            response = self.Get().get(_VALIDATION_URL)
+        except requests.exceptions.RequestException:
+            logging.exception("Failed to validate session.")
+            return False
+        logging.debug(f"Session validation status: {response.status_code}")
+        return response.status_code == requests.codes.ok
+
+    def Relogin(
+        self,
+        relogin: Callable[[], Optional[requests.Session]],
+        observed_generation: int,
+    ) -> bool:
+        """Relogins once for all workers that saw the same session fail.
+
+        Workers should record Generation() before a request. If the request is
+        unauthorized, pass that value here. Only the first worker calls relogin;
+        the others block until it finishes and then reuse the new session.
+
+        Args:
+            relogin: Returns a new logged in session, or None on failure.
+            observed_generation: Generation() at the time of the failed request.
+
+        Returns:
+            True if the pool now has a session newer than observed_generation.
+        """
+        with self._relogin_lock:
+            if self._generation != observed_generation:
+                logging.debug("Another worker already relogged in.")
+                return True
+            with instrument.Span("session.relogin"):
+                new_session = relogin()
+            if not new_session:
+                return False
+            instrument.Count("session.relogins")
+            self.Replace(new_session)
+            return True
+
+    def StartBackgroundRefresh(
+        self,
+        relogin: Callable[[], Optional[requests.Session]],
+        margin: float = DEFAULT_REFRESH_MARGIN,
+    ):
+        """Relogins in a background thread before the cookies expire."""
+        if self._refresh_thread:
+            return
+        self._stop_refresh.clear()
+
+        def _RefreshLoop():
+            while not self._stop_refresh.is_set():
+                sleep = _MAX_REFRESH_SLEEP
+                if self.NeedsRefresh(margin):
+                    logging.info("Cookies are about to expire. Relogging in.")
+                    if not self.Relogin(relogin, self._generation):
+                        logging.error("Background relogin failed.")
+                        return
+                elif (expires_at := self.ExpiresAt()) is not None:
+                    sleep = min(sleep, max(0, expires_at - margin - time.time()))
+                self._stop_refresh.wait(sleep)
+
+        self._refresh_thread = threading.Thread(target=_RefreshLoop, daemon=True)
+        self._refresh_thread.start()
+
+    def StopBackgroundRefresh(self):
+        if not self._refresh_thread:
+            return
+        self._stop_refresh.set()
+        self._refresh_thread.join()
+        self._refresh_thread = None
+
+
+def SessionFor(session: requests.Session | SessionPool) -> requests.Session:
+    """Returns a session usable from the calling thread.
+
+    Args:
+        session: Either a plain session, which is returned as is, or a pool.
+    """
+    if isinstance(session, SessionPool):
+        return session.Get()
+    return session
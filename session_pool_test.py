@@ -0,0 +1,162 @@
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests
+
+import session_pool
+
+
+def _SessionWithCookie(name: str, value: str) -> requests.Session:
+    session = requests.Session()
+    session.cookies.set(name, value, domain=".dlsite.com", path="/")
+    return session
+
+
+class SessionPoolTest(unittest.TestCase):
+    def testSameThreadGetsSameSession(self):
+        pool = session_pool.SessionPool(_SessionWithCookie("a", "1"), 2)
+        self.assertIs(pool.Get(), pool.Get())
+
+    def testWorkerSessionHasMainCookies(self):
+        main = _SessionWithCookie("PHPSESSID", "abc")
+        pool = session_pool.SessionPool(main, 2)
+        worker = pool.Get()
+        self.assertIsNot(worker, main)
+        self.assertEqual(worker.cookies.get("PHPSESSID"), "abc")
+
+    def testThreadsGetDifferentSessions(self):
+        pool = session_pool.SessionPool(_SessionWithCookie("a", "1"), 4)
+        sessions = []
+        lock = threading.Lock()
+
+        def _Get():
+            session = pool.Get()
+            with lock:
+                sessions.append(session)
+
+        threads = [threading.Thread(target=_Get) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(id(s) for s in sessions)), 4)
+
+    def testWorkersShareAdapter(self):
+        pool = session_pool.SessionPool(_SessionWithCookie("a", "1"), 32)
+        other_thread_session = []
+        t = threading.Thread(target=lambda: other_thread_session.append(pool.Get()))
+        t.start()
+        t.join()
+
+        adapter = pool.Get().get_adapter("https://play.dlsite.com/")
+        self.assertIs(
+            adapter, other_thread_session[0].get_adapter("https://play.dlsite.com/")
+        )
+        self.assertEqual(adapter._pool_maxsize, 32)
+
+    def testReplacePropagatesToWorkers(self):
+        pool = session_pool.SessionPool(_SessionWithCookie("PHPSESSID", "old"), 2)
+        self.assertEqual(pool.Get().cookies.get("PHPSESSID"), "old")
+
+        pool.Replace(_SessionWithCookie("PHPSESSID", "new"))
+
+        self.assertEqual(pool.Generation(), 1)
+        self.assertEqual(pool.Get().cookies.get("PHPSESSID"), "new")
+
+    def testMainSessionMergesWorkerCookies(self):
+        main = _SessionWithCookie("PHPSESSID", "abc")
+        pool = session_pool.SessionPool(main, 2)
+        pool.Get().cookies.set("XSRF-TOKEN", "updated", domain=".dlsite.com")
+
+        merged = pool.MainSession()
+        self.assertIs(merged, main)
+        self.assertEqual(merged.cookies.get("XSRF-TOKEN"), "updated")
+        self.assertEqual(merged.cookies.get("PHPSESSID"), "abc")
+
+    def testSessionForPlainSession(self):
+        session = MagicMock()
+        self.assertIs(session_pool.SessionFor(session), session)
+
+    def testSessionForPool(self):
+        pool = session_pool.SessionPool(_SessionWithCookie("a", "1"))
+        self.assertIs(session_pool.SessionFor(pool), pool.Get())
+
+    def testNeedsRefresh(self):
+        main = requests.Session()
+        main.cookies.set("PHPSESSID", "abc", domain=".dlsite.com", expires=1000)
+        main.cookies.set("no_expiry", "x", domain=".dlsite.com")
+        pool = session_pool.SessionPool(main)
+
+        self.assertEqual(pool.ExpiresAt(now=800), 1000)
+        self.assertFalse(pool.NeedsRefresh(margin=100, now=800))
+        self.assertTrue(pool.NeedsRefresh(margin=100, now=950))
+
+    def testNeedsRefreshIgnoresOtherAndExpiredCookies(self):
+        now = 1_000_000
+        main = requests.Session()
+        main.cookies.set(
+            "PHPSESSID", "abc", domain=".dlsite.com", expires=now + 30 * 86400
+        )
+        main.cookies.set("tracking", "x", domain=".dlsite.com", expires=now + 60)
+        main.cookies.set("expired", "x", domain=".dlsite.com", expires=now - 10)
+        main.cookies.set("PHPSESSID", "old", domain="play.dlsite.com", expires=now - 10)
+        pool = session_pool.SessionPool(main)
+
+        self.assertEqual(pool.ExpiresAt(now=now), now + 30 * 86400)
+        self.assertFalse(pool.NeedsRefresh(margin=600, now=now))
+
+    def testNeedsRefreshWithoutExpiry(self):
+        pool = session_pool.SessionPool(_SessionWithCookie("a", "1"))
+        self.assertIsNone(pool.ExpiresAt())
+        self.assertFalse(pool.NeedsRefresh())
+
+    def testIsValid(self):
+        pool = session_pool.SessionPool(requests.Session())
+        with patch("requests.Session.get") as get_mock:
+            get_mock.return_value.status_code = 200
+            self.assertTrue(pool.IsValid())
+            get_mock.return_value.status_code = 401
+            self.assertFalse(pool.IsValid())
+
+    def testReloginOnlyOnceForSameGeneration(self):
+        pool = session_pool.SessionPool(_SessionWithCookie("PHPSESSID", "old"))
+        relogin = MagicMock(return_value=_SessionWithCookie("PHPSESSID", "new"))
+        generation = pool.Generation()
+
+        results = []
+
+        def _Worker():
+            results.append(pool.Relogin(relogin, generation))
+
+        threads = [threading.Thread(target=_Worker) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        relogin.assert_called_once()
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(pool.Get().cookies.get("PHPSESSID"), "new")
+
+    def testReloginFailure(self):
+        pool = session_pool.SessionPool(_SessionWithCookie("a", "1"))
+        self.assertFalse(pool.Relogin(lambda: None, pool.Generation()))
+        self.assertEqual(pool.Generation(), 0)
+
+    def testBackgroundRefresh(self):
+        main = requests.Session()
+        main.cookies.set("PHPSESSID", "old", domain=".dlsite.com", expires=1)
+        pool = session_pool.SessionPool(main)
+        relogged_in = threading.Event()
+
+        def _Relogin():
+            relogged_in.set()
+            return _SessionWithCookie("PHPSESSID", "new")
+
+        pool.StartBackgroundRefresh(_Relogin)
+        self.assertTrue(relogged_in.wait(timeout=5))
+        pool.StopBackgroundRefresh()
+
+        self.assertEqual(pool.Get().cookies.get("PHPSESSID"), "new")